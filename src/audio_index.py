@@ -0,0 +1,368 @@
+# audio_index.py
+
+import os
+import json
+import mmap
+from errors import write_to_error_log
+from utils import format_chunk_ranges
+
+# Bitrates in kbps by (MPEG version 1 or 2, layer), indexed by the frame header's bitrate index
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates by the frame header's version bits (3 is MPEG 1, 2 is MPEG 2, 0 is MPEG 2.5)
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+class AudioIntegrityError(Exception):
+    """Raised when the headers of an audio file show it is empty, truncated or corrupt."""
+
+
+def parse_mp3_frame_header(data, position: int):
+    """Returns (frame_length, samples, sample_rate, channels) of the MPEG audio frame header at position, or None."""
+    if position + 4 > len(data) or data[position] != 0xFF or data[position + 1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (data[position + 1] >> 3) & 0x03
+    layer = 4 - ((data[position + 1] >> 1) & 0x03)
+    bitrate_index = data[position + 2] >> 4
+    sample_rate_index = (data[position + 2] >> 2) & 0x03
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    version = 1 if version_bits == 3 else 2
+    bitrate = MP3_BITRATES[(version, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (data[position + 2] >> 1) & 0x01
+    channels = 1 if data[position + 3] >> 6 == 3 else 2
+    if layer == 1:
+        return ((12 * bitrate // sample_rate + padding) * 4, 384, sample_rate, channels)
+    samples = 576 if layer == 3 and version == 2 else 1152
+    return (samples // 8 * bitrate // sample_rate + padding, samples, sample_rate, channels)
+
+
+def read_mp3_headers(data) -> dict:
+    """
+    Walks the frame headers of an MP3 file from one to the next without decoding any audio.
+
+    Raises AudioIntegrityError if a frame runs past the end of the file, a frame header is missing where
+    the previous frame ended, or the sample rate changes between frames.
+    """
+    position = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        # Skip the ID3v2 tag, whose size is stored in four 7-bit bytes
+        tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        position = 10 + tag_size + (10 if data[5] & 0x10 else 0)
+
+    frames = 0
+    samples = 0
+    sample_rate = None
+    channels = None
+    while position < len(data):
+        header = parse_mp3_frame_header(data, position)
+        if header is None:
+            remaining = data[position:position + 8]
+            if remaining[:3] == b"TAG" or remaining[:8] == b"APETAGEX" or remaining[:6] == b"LYRICS":
+                break
+            if len(data) - position < 4:
+                raise AudioIntegrityError(f"truncated: {len(data) - position} stray bytes after frame {frames}")
+            raise AudioIntegrityError(f"corrupt: no frame header at byte {position}, after frame {frames}")
+        frame_length, frame_samples, frame_sample_rate, frame_channels = header
+        if position + frame_length > len(data):
+            raise AudioIntegrityError(
+                f"truncated: frame {frames + 1} needs {frame_length} bytes but {len(data) - position} are left"
+            )
+        if sample_rate is None:
+            sample_rate, channels = frame_sample_rate, frame_channels
+            # A Xing or Info frame describes the stream and is not played
+            if data.find(b"Xing", position + 4, position + 40) != -1 or \
+                    data.find(b"Info", position + 4, position + 40) != -1:
+                position += frame_length
+                continue
+        elif frame_sample_rate != sample_rate:
+            raise AudioIntegrityError(f"corrupt: frame {frames + 1} changes the sample rate to {frame_sample_rate}")
+        frames += 1
+        samples += frame_samples
+        position += frame_length
+
+    if not frames:
+        raise AudioIntegrityError("empty: no audio frames")
+    return {
+        "format": "mp3",
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "duration_seconds": samples / sample_rate,
+    }
+
+
+def read_wav_headers(data) -> dict:
+    """Reads the fmt and data chunk headers of a WAV file, which the local TTS methods write, to get its duration."""
+    if len(data) < 12 or data[8:12] != b"WAVE":
+        raise AudioIntegrityError("corrupt: not a WAVE file")
+    position = 12
+    fmt = None
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        chunk_size = int.from_bytes(data[position + 4:position + 8], "little")
+        body = position + 8
+        if chunk_id == b"fmt ":
+            if body + 16 > len(data):
+                raise AudioIntegrityError("truncated: fmt chunk is cut short")
+            fmt = {
+                "channels": int.from_bytes(data[body + 2:body + 4], "little"),
+                "sample_rate": int.from_bytes(data[body + 4:body + 8], "little"),
+                "byte_rate": int.from_bytes(data[body + 8:body + 12], "little"),
+            }
+        elif chunk_id == b"data":
+            if fmt is None or not fmt["byte_rate"]:
+                raise AudioIntegrityError("corrupt: data chunk before a valid fmt chunk")
+            available = len(data) - body
+            if chunk_size in (0, 0xFFFFFFFF):
+                # Written by a stream that could not seek back to fill in the size
+                chunk_size = available
+            elif chunk_size > available:
+                raise AudioIntegrityError(f"truncated: data chunk holds {available} of {chunk_size} bytes")
+            if not chunk_size:
+                raise AudioIntegrityError("empty: no audio samples")
+            return {
+                "format": "wav",
+                "sample_rate": fmt["sample_rate"],
+                "channels": fmt["channels"],
+                "duration_seconds": chunk_size / fmt["byte_rate"],
+            }
+        # Chunks are padded to an even number of bytes
+        position = body + chunk_size + (chunk_size & 1)
+    raise AudioIntegrityError("truncated: no data chunk")
+
+
+def inspect_audio_file(file_path) -> dict:
+    """
+    Reads the headers of a chunk file to check it and get its duration, without decoding any audio.
+
+    The file is memory-mapped, so only the pages holding its headers are read from disk. Files are told
+    apart by their content rather than their extension, since the local TTS methods write WAV data to .mp3 files.
+
+    Returns:
+    - dict: The file's format, sample rate, channels and duration in seconds.
+
+    Raises:
+    - AudioIntegrityError: If the file is missing, empty, truncated or corrupt.
+    """
+    if not os.path.exists(file_path):
+        raise AudioIntegrityError("missing")
+    if os.path.getsize(file_path) == 0:
+        raise AudioIntegrityError("empty: 0 bytes")
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] == b"RIFF":
+            return read_wav_headers(data)
+        return read_mp3_headers(data)
+
+
+def get_chunk_number(file_name: str) -> int:
+    return int(os.path.splitext(file_name)[0])
+
+
+def get_chapters(documents: list, chunks: list, chunk_characters: list) -> list:
+    """
+    Estimates when each document (usually a chapter) starts, from where it starts in the plaintext.
+
+    The share of the plaintext before a document is mapped to the same share of the characters of the
+    chunks, and then to a time within that chunk by assuming its characters are read at an even pace.
+    """
+    total_characters = sum(chunk_characters)
+    document_characters = [document["characters"] + 2 for document in documents]  # With their blank line
+    total_document_characters = sum(document_characters)
+    if not total_characters or not total_document_characters:
+        return []
+
+    chapters = []
+    document_offset = 0
+    chunk_index = 0
+    chunk_offset = 0
+    for document, characters in zip(documents, document_characters):
+        position = document_offset / total_document_characters * total_characters
+        document_offset += characters
+        while chunk_index < len(chunks) - 1 and chunk_offset + chunk_characters[chunk_index] <= position:
+            chunk_offset += chunk_characters[chunk_index]
+            chunk_index += 1
+        chunk = chunks[chunk_index]
+        within_chunk = min(1.0, (position - chunk_offset) / max(chunk_characters[chunk_index], 1))
+        start_seconds = chunk["start_seconds"] + within_chunk * (chunk["duration_seconds"] or 0.0)
+        chapters.append({
+            "title": document["name"],
+            "start_seconds": round(start_seconds, 3),
+            "chunk": get_chunk_number(chunk["file"]),
+        })
+    return chapters
+
+
+def build_audio_index(paths: dict, audio_files_dir, extension: str) -> dict:
+    """
+    Checks every chunk file of a book from its headers and writes their durations to audio_index.json.
+
+    The chunk files expected are the ones listed in chunks.jsonl by Step 3 (with extension, so the
+    post-processed .wav files can be indexed too), or every file with extension in audio_files_dir if
+    there is no chunks.jsonl. Files whose size and modification time match the previous index are not
+    read again. The index records each chunk's duration and start time in the audiobook, the chunks that
+    are missing, empty, truncated or corrupt, and the start time of each document in documents.json.
+
+    Returns:
+    - dict: The index that was written.
+    """
+    previous = {}
+    if paths["audio_index"].exists():
+        with open(paths["audio_index"], "r", encoding="utf-8") as f:
+            previous_index = json.load(f)
+        if previous_index.get("directory") == audio_files_dir.name:
+            previous = {chunk["file"]: chunk for chunk in previous_index["chunks"]}
+
+    chunk_characters = None
+    if paths["chunks_jsonl"].exists():
+        with open(paths["chunks_jsonl"], "r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f]
+        file_names = [f"{os.path.splitext(entry['file'])[0]}{extension}" for entry in entries]
+        chunk_characters = [entry["characters"] for entry in entries]
+    else:
+        file_names = sorted(
+            (name for name in os.listdir(audio_files_dir) if name.lower().endswith(extension)
+             and os.path.splitext(name)[0].isdigit()),
+            key=get_chunk_number,
+        ) if audio_files_dir.exists() else []
+
+    chunks = []
+    bad_chunks = []
+    start_seconds = 0.0
+    for file_name in file_names:
+        file_path = audio_files_dir / file_name
+        stat = file_path.stat() if file_path.exists() else None
+        chunk = previous.get(file_name)
+        if not chunk or not stat or chunk["bytes"] != stat.st_size or chunk["mtime_ns"] != stat.st_mtime_ns:
+            chunk = {
+                "file": file_name,
+                "bytes": stat.st_size if stat else None,
+                "mtime_ns": stat.st_mtime_ns if stat else None,
+                "format": None,
+                "sample_rate": None,
+                "channels": None,
+                "duration_seconds": None,
+                "error": None,
+            }
+            try:
+                chunk.update(inspect_audio_file(file_path))
+                chunk["duration_seconds"] = round(chunk["duration_seconds"], 3)
+            except (AudioIntegrityError, OSError, ValueError) as e:
+                chunk["error"] = str(e)
+        chunk["start_seconds"] = round(start_seconds, 3)
+        start_seconds += chunk["duration_seconds"] or 0.0
+        if chunk["error"]:
+            bad_chunks.append(get_chunk_number(file_name))
+        chunks.append(chunk)
+
+    chapters = []
+    if chunks and chunk_characters and paths["documents_json"].exists():
+        with open(paths["documents_json"], "r", encoding="utf-8") as f:
+            chapters = get_chapters(json.load(f), chunks, chunk_characters)
+
+    index = {
+        "directory": audio_files_dir.name,
+        "total_seconds": round(start_seconds, 3),
+        "bad_chunks": bad_chunks,
+        "chapters": chapters,
+        "chunks": chunks,
+    }
+    paths["audio_index"].parent.mkdir(parents=True, exist_ok=True)
+    with open(paths["audio_index"], "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def check_audio_files(book_name: str, paths: dict, audio_files_dir, extension: str) -> dict:
+    """
+    Builds the audio index of a book's chunk files before they are assembled, reporting any bad chunks.
+
+    Returns:
+    - dict: The audio index. Its "bad_chunks" lists the numbers of the chunks that have to be re-synthesized.
+    """
+    print(f"Checking the headers of the chunk files in {audio_files_dir}...")
+    index = build_audio_index(paths, audio_files_dir, extension)
+    if index["bad_chunks"]:
+        error_message = (f"{book_name}: {len(index['bad_chunks'])} of {len(index['chunks'])} chunk files are "
+                         f"missing, empty, truncated or corrupt: {format_chunk_ranges(index['bad_chunks'])}")
+        print(error_message)
+        write_to_error_log(error_message)
+        for chunk in index["chunks"]:
+            if chunk["error"]:
+                write_to_error_log(f"{book_name}: {chunk['file']} is {chunk['error']}")
+    else:
+        print(f"All {len(index['chunks'])} chunk files are intact: {index['total_seconds'] / 3600:.2f} hours of audio "
+              f"in {len(index['chapters'])} chapter(s). Durations written to {paths['audio_index']}")
+    return index
+
+
+def repair_chunks(book_name: str, paths: dict, tts_method: str) -> bool:
+    """
+    Re-synthesizes only the chunks whose files are missing, empty, truncated or corrupt.
+
+    The chunks are planned again from the segment index and characters.json, and each bad chunk must still
+    match the text and voice recorded for it in chunks.jsonl. Otherwise the tagged text changed since Step 3,
+    and all of Step 3 has to run again.
+
+    Returns:
+    - bool: Whether every chunk file is intact afterwards.
+    """
+    from chunking import merge_tts_segments
+    from main import get_chunk_manifest_entry
+    from segment_index import load_segment_index
+    from autotune import get_tts_max_characters
+    from tts import generate_mp3_files
+
+    if not paths["chunks_jsonl"].exists():
+        print(f"No {paths['chunks_jsonl'].name} was found. Run Step 3 first.")
+        return False
+    index = check_audio_files(book_name, paths, paths["audio_files_dir"], ".mp3")
+    bad_chunks = set(index["bad_chunks"])
+    if not bad_chunks:
+        return True
+
+    with open(paths["chunks_jsonl"], "r", encoding="utf-8") as f:
+        recorded = {entry["file"]: entry for entry in map(json.loads, f)}
+    with open(paths["characters_json"], "r", encoding="utf-8") as f:
+        characters_json = json.load(f)
+
+    chunks = {}
+    segment_index = load_segment_index(paths)
+    try:
+        tts_chunks = merge_tts_segments(segment_index.iter_segments(characters_json), get_tts_max_characters(tts_method))
+        for chunk_number, chunk in enumerate(tts_chunks, 1):
+            if chunk_number in bad_chunks:
+                entry = get_chunk_manifest_entry(chunk_number, chunk)
+                if recorded.get(entry["file"]) == entry:
+                    chunks[chunk_number] = chunk
+    finally:
+        segment_index.close()
+    if len(chunks) != len(bad_chunks):
+        error_message = (f"{book_name}: the text or voices of the bad chunks changed since Step 3 ran. "
+                         f"Run Step 3 again instead of repairing them.")
+        print(error_message)
+        write_to_error_log(error_message)
+        return False
+
+    # Re-synthesize each run of consecutive chunks together, so the local method can still batch them
+    print(f"Re-synthesizing {len(chunks)} chunk(s)...")
+    chunk_numbers = sorted(chunks)
+    start = 0
+    for i in range(1, len(chunk_numbers) + 1):
+        if i == len(chunk_numbers) or chunk_numbers[i] != chunk_numbers[i - 1] + 1:
+            run = chunk_numbers[start:i]
+            for chunk_number in run:
+                (paths["audio_files_dir"] / f"{chunk_number}.mp3").unlink(missing_ok=True)
+            generate_mp3_files(
+                (chunks[chunk_number] for chunk_number in run), tts_method, paths["audio_files_dir"],
+                first_chunk_number=run[0],
+            )
+            start = i
+
+    return not check_audio_files(book_name, paths, paths["audio_files_dir"], ".mp3")["bad_chunks"]
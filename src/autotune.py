@@ -0,0 +1,207 @@
+# autotune.py
+
+import os
+import json
+import time
+import tempfile
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from config import CONFIG
+from errors import write_to_error_log
+from utils import split_text_into_chunks
+
+# Narration used to calibrate when no book's plaintext is passed, repeated to reach the largest chunk size
+CALIBRATION_TEXT = (
+    "The house stood at the end of the lane, where the road gave up and the fields began. Nobody had lived "
+    "there for years, but every evening a light still burned in the upper window, and the children of the "
+    "village dared one another to walk as far as the gate. Most of them turned back long before they reached "
+    "it. Those who did not came home quiet, and would not say what they had seen."
+)
+
+# Where the remote TTS methods send requests, so settings tuned against a stand-in are not used for the real API
+BACKEND_URLS = {
+    "openai": lambda: os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    "elevenlabs": lambda: os.getenv("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io"),
+}
+
+
+def tuning_path():
+    return CONFIG["outputs_path"] / "tts_tuning.json"
+
+
+def load_tuning() -> dict:
+    """Reads the settings tuned for each TTS method from outputs/tts_tuning.json."""
+    if not tuning_path().exists():
+        return {}
+    with open(tuning_path(), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_backend_url(tts_method: str):
+    return BACKEND_URLS[tts_method]() if tts_method in BACKEND_URLS else None
+
+
+def get_tuned_tts_settings(tts_method: str):
+    """
+    Returns the chunk length and concurrency tuned for a TTS method, or None if it was not tuned.
+
+    Settings tuned against another backend URL, such as a stand-in server, are ignored. The tuned chunk
+    length never exceeds CONFIG["token_limits"]["TTS_MAX_CHARACTERS"], which is the API limit.
+    """
+    settings = load_tuning().get(tts_method)
+    if not settings or settings.get("backend_url") != get_backend_url(tts_method):
+        return None
+    return {
+        "TTS_MAX_CHARACTERS": min(settings["TTS_MAX_CHARACTERS"], CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]),
+        "TTS_WORKERS": settings["TTS_WORKERS"],
+    }
+
+
+def get_tts_max_characters(tts_method: str) -> int:
+    """Returns the longest chunk Step 3 sends to a TTS method, tuned if autotune was run for it."""
+    settings = get_tuned_tts_settings(tts_method)
+    return settings["TTS_MAX_CHARACTERS"] if settings else CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+
+
+def get_tts_workers(tts_method: str) -> int:
+    """Returns how many TTS requests to send at once to a TTS method when sharing a pool between books."""
+    settings = get_tuned_tts_settings(tts_method)
+    return settings["TTS_WORKERS"] if settings else CONFIG["batch"]["TTS_WORKERS"][tts_method]
+
+
+def get_calibration_texts(size: int, count: int, source_text: str = None) -> list:
+    """Returns count different texts of about size characters, cut at sentence boundaries."""
+    source_text = source_text or CALIBRATION_TEXT
+    while len(source_text) < size * (count + 1):
+        source_text = f"{source_text} {source_text}"
+    texts = []
+    for i in range(count):
+        # Start each text at a different offset, so no backend can answer from a cache
+        window = source_text[i * size // 3:]
+        texts.append(split_text_into_chunks(window, size)[0])
+    return texts
+
+
+def measure(tts_method: str, voice: str, max_characters: int, texts: list, concurrency: int,
+            audio_files_dir: str) -> dict:
+    """Synthesizes texts with up to concurrency requests at once, and measures their latency and throughput."""
+    from tts import convert_text_to_speech
+
+    def synthesize(item):
+        i, text = item
+        start = time.perf_counter()
+        try:
+            convert_text_to_speech(text, voice, tts_method, output_file=os.path.join(audio_files_dir, f"{i}.mp3"))
+        except Exception as e:
+            write_to_error_log(f"Autotune request of {len(text)} characters failed: {e}")
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="autotune") as executor:
+        latencies = list(executor.map(synthesize, enumerate(texts)))
+    wall_seconds = time.perf_counter() - start
+
+    succeeded = [latency for latency in latencies if latency is not None]
+    characters = sum(len(text) for text, latency in zip(texts, latencies) if latency is not None)
+    return {
+        "max_characters": max_characters,
+        "mean_characters": round(sum(len(text) for text in texts) / len(texts)),
+        "concurrency": concurrency,
+        "requests": len(texts),
+        "failed": len(texts) - len(succeeded),
+        "mean_latency_seconds": round(sum(succeeded) / len(succeeded), 3) if succeeded else None,
+        "characters_per_second": round(characters / wall_seconds, 2) if succeeded else 0.0,
+    }
+
+
+def pick_best(measurements: list, key: str) -> dict:
+    """
+    Picks the measurement with the most characters per second, preferring the smallest key (chunk length
+    or concurrency) within CONFIG["autotune"]["TOLERANCE"] of it, since smaller chunks are retried more
+    cheaply and fewer concurrent requests leave more headroom under the rate limits.
+    """
+    usable = [measurement for measurement in measurements if not measurement["failed"]]
+    if not usable:
+        return None
+    best_rate = max(measurement["characters_per_second"] for measurement in usable)
+    return min(
+        (m for m in usable if m["characters_per_second"] >= best_rate * (1 - CONFIG["autotune"]["TOLERANCE"])),
+        key=lambda m: m[key],
+    )
+
+
+def run_autotune(tts_method: str, source_text: str = None) -> dict:
+    """
+    Finds the chunk length and concurrency with the highest throughput for a TTS method, and stores them.
+
+    First every chunk length in CONFIG["autotune"]["CHUNK_SIZES"] is measured with one request at a time,
+    then every concurrency in CONFIG["autotune"]["CONCURRENCY_LEVELS"] with the best chunk length, stopping
+    once more concurrency fails requests or no longer raises throughput. The results are written to
+    outputs/tts_tuning.json, where Step 3, batch mode and the job server pick them up.
+
+    Parameters:
+    - tts_method (str): "local", "onnx", "openai" or "elevenlabs".
+    - source_text (str, optional): Text to synthesize, such as a book's plaintext. Defaults to a short passage.
+
+    Returns:
+    - dict: The tuned settings and every measurement, or an empty dict if every calibration request failed.
+    """
+    autotune_config = CONFIG["autotune"]
+    requests_per_setting = autotune_config["REQUESTS_PER_SETTING"]
+    max_characters = CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+    sizes = [size for size in autotune_config["CHUNK_SIZES"] if size <= max_characters] or [max_characters]
+    voice = CONFIG["voice_identifiers"]["narrator_voice"]
+    backend_url = get_backend_url(tts_method)
+    print(f"Autotuning the {tts_method} TTS method{f' at {backend_url}' if backend_url else ''}...")
+
+    with tempfile.TemporaryDirectory() as audio_files_dir:
+        # Load models and open connections before anything is timed
+        measure(tts_method, voice, sizes[0], get_calibration_texts(sizes[0], 1, source_text), 1, audio_files_dir)
+
+        size_measurements = []
+        for size in sizes:
+            measurement = measure(
+                tts_method, voice, size, get_calibration_texts(size, requests_per_setting, source_text), 1,
+                audio_files_dir,
+            )
+            size_measurements.append(measurement)
+            print(f"  Up to {size} characters: {measurement['mean_latency_seconds']}s per request, "
+                  f"{measurement['characters_per_second']} characters/s, {measurement['failed']} failed")
+        best_size = pick_best(size_measurements, "max_characters")
+        if not best_size:
+            error_message = f"Autotune of {tts_method} failed: every calibration request failed."
+            print(error_message)
+            write_to_error_log(error_message)
+            return {}
+
+        concurrency_measurements = []
+        for concurrency in autotune_config["CONCURRENCY_LEVELS"]:
+            texts = get_calibration_texts(best_size["max_characters"], requests_per_setting * concurrency, source_text)
+            measurement = measure(tts_method, voice, best_size["max_characters"], texts, concurrency, audio_files_dir)
+            concurrency_measurements.append(measurement)
+            print(f"  {concurrency} at once: {measurement['characters_per_second']} characters/s, "
+                  f"{measurement['failed']} failed")
+            if measurement["failed"]:
+                break
+            if len(concurrency_measurements) > 1 and measurement["characters_per_second"] < \
+                    concurrency_measurements[-2]["characters_per_second"] * (1 + autotune_config["TOLERANCE"]):
+                break
+        best_concurrency = pick_best(concurrency_measurements, "concurrency") or {"concurrency": 1}
+
+    settings = {
+        "TTS_MAX_CHARACTERS": best_size["max_characters"],
+        "TTS_WORKERS": best_concurrency["concurrency"],
+        "backend_url": backend_url,
+        "tuned_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "measurements": size_measurements + concurrency_measurements,
+    }
+    tuning = load_tuning()
+    tuning[tts_method] = settings
+    tuning_path().parent.mkdir(parents=True, exist_ok=True)
+    with open(tuning_path(), "w", encoding="utf-8") as f:
+        json.dump(tuning, f, indent=2)
+
+    print(f"Tuned {tts_method}: chunks of up to {settings['TTS_MAX_CHARACTERS']} characters, "
+          f"{settings['TTS_WORKERS']} request(s) at once. Written to {tuning_path()}")
+    return settings
@@ -0,0 +1,163 @@
+# batch.py
+
+import json
+import time
+import threading
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from config import CONFIG
+from errors import write_to_error_log
+from utils import remove_suffix
+from fingerprints import STEP_FAILURE_STATS, record_step
+from autotune import get_tts_workers
+from main import get_book_paths, get_step_runners, plan_steps
+from tts import TTSWarmUp
+
+SUPPORTED_INPUT_EXTENSIONS = (".txt", ".epub", ".mobi", ".pdf")
+
+state_lock = threading.Lock()
+
+
+def find_batch_inputs() -> list:
+    """Returns the names of every supported book in the inputs directory, sorted by name."""
+    return sorted(
+        path.name for path in CONFIG["inputs_path"].iterdir()
+        if path.is_file() and path.suffix.lower() in SUPPORTED_INPUT_EXTENSIONS
+    )
+
+
+def write_book_state(paths: dict, state: dict):
+    """Writes a book's batch state to outputs/<book_name>/batch_state.json."""
+    paths["output_dir"].mkdir(parents=True, exist_ok=True)
+    with state_lock:
+        with open(paths["output_dir"] / "batch_state.json", "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+
+
+def process_book(openai_client, input_file: str, steps: list, args, llm_pool, tts_pool, tts_warm_up=None) -> dict:
+    """
+    Runs the requested steps for one book, submitting its tagging and synthesis work to the shared pools.
+    If tts_warm_up is passed, Step 3 waits for it to finish loading the TTS models first.
+
+    A book whose steps all finish but report failed blocks, chunks or encodes ends "partial", with the
+    failures in its error.
+    """
+    book_name = remove_suffix(input_file)
+    paths = get_book_paths(book_name)
+    state = {
+        "input_file": input_file,
+        "status": "running",
+        "completed_steps": [],
+        "step_seconds": {},
+        "stats": {},
+        "error": None,
+    }
+    failures = []
+    write_book_state(paths, state)
+
+    step_runners = get_step_runners(openai_client, input_file, book_name, paths, args, llm_pool, tts_pool)
+
+    for step, inputs in plan_steps(steps, input_file, book_name, paths, args, f"[{book_name}] "):
+        if step == 3 and tts_warm_up:
+            tts_warm_up.wait()
+        start = time.perf_counter()
+        try:
+            step_stats = step_runners[step]()
+            state["stats"].update(step_stats)
+            record_step(paths, step, inputs, step_stats)
+        except Exception as e:
+            error_message = f"[{book_name}] Step {step} failed: {e}"
+            print(error_message)
+            write_to_error_log(error_message)
+            state["status"] = "failed"
+            state["error"] = error_message
+            write_book_state(paths, state)
+            return state
+        state["step_seconds"][str(step)] = round(time.perf_counter() - start, 2)
+        state["completed_steps"].append(step)
+        failures += [f"Step {step}: {key} {step_stats[key]}" for key in STEP_FAILURE_STATS if step_stats.get(key)]
+        write_book_state(paths, state)
+
+    if failures:
+        error_message = f"[{book_name}] Finished with failures ({', '.join(failures)})"
+        print(error_message)
+        write_to_error_log(error_message)
+        state["status"] = "partial"
+        state["error"] = error_message
+    else:
+        state["status"] = "done"
+    write_book_state(paths, state)
+    return state
+
+
+def run_batch(openai_client, input_files: list, steps: list, args) -> dict:
+    """
+    Processes many books at once, sharing one LLM worker pool and one TTS worker pool between them.
+
+    Each book runs its steps in order on its own driver thread, while the blocks it tags and the chunks
+    it synthesizes are scheduled on the shared pools, so a book in Step 2 and a book in Step 3 keep both
+    the LLM and the TTS backends busy at the same time.
+
+    Parameters:
+    - openai_client (GitHubOpenAIClient): Client shared by every book for dialogue tagging.
+    - input_files (list): Names of the books in the inputs directory.
+    - steps (list): Steps to run for every book. Runs every step if empty.
+    - args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+    - dict: Aggregate report, also written to outputs/batch_report.json.
+    """
+    tts_method = args.tts_method.lower()
+    batch_config = CONFIG["batch"]
+    tts_workers = get_tts_workers(tts_method)
+    # A local LLM provider may serve more requests at once than the LLM pool would otherwise send
+    llm_workers = max(batch_config["LLM_WORKERS"], CONFIG["rate_limits"]["llm"]["MAX_CONCURRENCY"])
+    print(f"Batch processing {len(input_files)} book(s) with {llm_workers} LLM worker(s) "
+          f"and {tts_workers} TTS worker(s)")
+
+    # The models are loaded once for every book, while the first books run Steps 1 and 2
+    tts_warm_up = TTSWarmUp(tts_method).start() if not steps or 3 in steps else None
+    if tts_warm_up and args.extract_workers and args.extract_workers > 1:
+        # Step 1's extraction processes are forked, which is not safe while models are loading on a thread
+        print("Extracting each book in one process, since the TTS models load while the first books run Step 1")
+        args = Namespace(**{**vars(args), "extract_workers": None})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(llm_workers, thread_name_prefix="llm") as llm_pool, \
+            ThreadPoolExecutor(tts_workers, thread_name_prefix="tts") as tts_pool, \
+            ThreadPoolExecutor(batch_config["BOOK_WORKERS"], thread_name_prefix="book") as book_pool:
+        futures = [
+            book_pool.submit(process_book, openai_client, input_file, steps, args, llm_pool, tts_pool, tts_warm_up)
+            for input_file in input_files
+        ]
+        states = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "books": len(states),
+        "books_done": sum(1 for state in states if state["status"] == "done"),
+        "books_failed": [state["input_file"] for state in states if state["status"] in ("failed", "partial")],
+        "blocks": sum(state["stats"].get("blocks", 0) for state in states),
+        "chunks": sum(state["stats"].get("chunks", 0) for state in states),
+        "tts_characters": sum(state["stats"].get("tts_characters", 0) for state in states),
+        "wall_seconds": round(elapsed, 2),
+    }
+    minutes = max(elapsed, 1e-9) / 60
+    report["books_per_hour"] = round(report["books_done"] / (minutes / 60), 2)
+    report["blocks_per_minute"] = round(report["blocks"] / minutes, 2)
+    report["chunks_per_minute"] = round(report["chunks"] / minutes, 2)
+    report["tts_characters_per_second"] = round(report["tts_characters"] / (minutes * 60), 2)
+
+    CONFIG["outputs_path"].mkdir(parents=True, exist_ok=True)
+    report_path = CONFIG["outputs_path"] / "batch_report.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nBatch complete: {report['books_done']}/{report['books']} book(s) in {report['wall_seconds']}s")
+    print(f"  Blocks tagged: {report['blocks']} ({report['blocks_per_minute']}/min)")
+    print(f"  TTS chunks: {report['chunks']} ({report['chunks_per_minute']}/min, "
+          f"{report['tts_characters_per_second']} characters/s)")
+    if report["books_failed"]:
+        print(f"  Failed: {', '.join(report['books_failed'])}")
+    print(f"Batch report written to {report_path}")
+    return report
@@ -0,0 +1,207 @@
+# batch_api.py
+
+import json
+import time
+from config import CONFIG
+from errors import write_to_error_log
+from utils import clean_markdown_code_blocks, validate_tagged_block
+from fingerprints import fingerprint_value
+from github_openai_client import BLOCK_TOP_P
+
+# Statuses of a batch that will not change any more
+FINISHED_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_batch_api_paths(paths: dict) -> dict:
+    """Returns the files a book's batch submissions are tracked in, under outputs/<book_name>/batch_api/."""
+    batch_api_dir = paths["output_dir"] / "batch_api"
+    return {
+        "dir": batch_api_dir,
+        "state": batch_api_dir / "state.json",
+        "results": batch_api_dir / "results.jsonl",
+    }
+
+
+def write_batch_input(openai_client, blocks: list, block_indexes: list, round_number: int, input_path):
+    """Writes a chat completion request for each of the blocks to a batch input JSONL file."""
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in block_indexes:
+            f.write(json.dumps({
+                "custom_id": f"block-{i}-round-{round_number}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": openai_client.get_completion_body(openai_client.get_block_prompt(blocks[i]), BLOCK_TOP_P),
+            }) + "\n")
+
+
+def submit_batch(openai_client, input_path) -> str:
+    """Uploads a batch input file and creates a batch that runs it. Returns the batch's id."""
+    openai, governor = openai_client.openai, openai_client.governor
+    content = input_path.read_bytes()
+    request_count = content.count(b"\n")
+    input_file = governor.call(
+        lambda: openai.files.create(file=(input_path.name, content), purpose="batch"),
+        description="uploading batch input",
+    )
+    batch = governor.call(
+        lambda: openai.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=CONFIG["batch_api"]["COMPLETION_WINDOW"],
+        ),
+        description="creating batch",
+    )
+    print(f"Submitted batch {batch.id} with {request_count} block(s)")
+    return batch.id
+
+
+def wait_for_batch(openai_client, batch_id: str):
+    """Polls a batch until it finishes, printing its progress. Returns the finished batch."""
+    while True:
+        batch = openai_client.governor.call(
+            lambda: openai_client.openai.batches.retrieve(batch_id), description="checking batch"
+        )
+        counts = batch.request_counts
+        if counts:
+            print(f"Batch {batch_id} is {batch.status}: {counts.completed}/{counts.total} done, {counts.failed} failed")
+        else:
+            print(f"Batch {batch_id} is {batch.status}")
+        if batch.status in FINISHED_BATCH_STATUSES:
+            return batch
+        time.sleep(CONFIG["batch_api"]["POLL_SECONDS"])
+
+
+def read_batch_results(openai_client, batch) -> dict:
+    """Returns the content of every successful completion of a finished batch, by custom_id."""
+    results = {}
+    if not batch.output_file_id:
+        return results
+    content = openai_client.governor.call(
+        lambda: openai_client.openai.files.content(batch.output_file_id), description="downloading batch output"
+    ).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get("response") or {}
+        if response.get("status_code") == 200 and not entry.get("error"):
+            results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+
+def tag_blocks_with_batch_api(openai_client, blocks, max_retries: int, paths: dict, processed_blocks_dir=None) -> list:
+    """
+    Tags blocks through an OpenAI-style batch endpoint instead of one chat completion per block.
+
+    Every block's request is written to a batch input file, which is uploaded and run as one batch. The batch
+    is polled until it finishes, and its completions are mapped back to their blocks by custom_id and validated
+    like tag_block does. Blocks whose request failed or whose tagged text failed validation are submitted again
+    in a new batch with only those blocks, up to CONFIG["batch_api"]["MAX_RESUBMITS"] times. A block that
+    fails validation more than max_retries times, or is still missing after the last batch, is kept as its
+    untagged source text.
+
+    Submitted batches and their completions are recorded in outputs/<book_name>/batch_api/, so if the run is
+    interrupted, the next run with the same blocks waits for the batch in flight instead of submitting again.
+
+    Returns:
+        list: (tagged_block, is_valid) for every block, in order, like tag_blocks.
+    """
+    MIN_SIMILARITY = CONFIG["tag_validation"]["MIN_SIMILARITY"]
+    blocks = list(blocks)
+    batch_api_paths = get_batch_api_paths(paths)
+    batch_api_paths["dir"].mkdir(parents=True, exist_ok=True)
+
+    # Completions recorded for other blocks, prompts or models are not reused
+    fingerprint = fingerprint_value({
+        "blocks": blocks,
+        "request": openai_client.get_completion_body(openai_client.get_block_prompt(""), BLOCK_TOP_P),
+        "base_url": CONFIG["base_url"],
+    })
+    state = None
+    if batch_api_paths["state"].exists():
+        with open(batch_api_paths["state"], "r", encoding="utf-8") as f:
+            state = json.load(f)
+    if not state or state["fingerprint"] != fingerprint:
+        state = {"fingerprint": fingerprint, "rounds": []}
+        batch_api_paths["results"].unlink(missing_ok=True)
+
+    def save_state():
+        with open(batch_api_paths["state"], "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+
+    tagged = {}
+    validation_failures = [0] * len(blocks)
+
+    def add_completion(i: int, content: str):
+        if processed_blocks_dir:
+            processed_blocks_dir.mkdir(parents=True, exist_ok=True)
+            with open(processed_blocks_dir / f"processed_{i + 1}.txt", "w", encoding="utf-8") as f:
+                f.write(content.strip())
+        processed_block = clean_markdown_code_blocks(content.strip())
+        is_valid, similarity = validate_tagged_block(blocks[i], processed_block, MIN_SIMILARITY)
+        if is_valid:
+            tagged[i] = processed_block
+        else:
+            validation_failures[i] += 1
+            print(f"Block {i + 1} failed validation (similarity {similarity:.3f}).")
+
+    # Replay the completions of batches collected by an earlier, interrupted run
+    if batch_api_paths["results"].exists():
+        with open(batch_api_paths["results"], "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["block"] not in tagged:
+                    add_completion(entry["block"], entry["content"])
+
+    def collect(round_state: dict):
+        batch = wait_for_batch(openai_client, round_state["batch_id"])
+        results = read_batch_results(openai_client, batch)
+        failed = 0
+        with open(batch_api_paths["results"], "a", encoding="utf-8") as f:
+            for i in round_state["blocks"]:
+                content = results.get(f"block-{i}-round-{round_state['round']}")
+                if content is None:
+                    failed += 1
+                    continue
+                f.write(json.dumps({"block": i, "content": content}) + "\n")
+                add_completion(i, content)
+        if batch.status != "completed" or failed:
+            error_message = f"Batch {batch.id} ended {batch.status}: {failed} of {len(round_state['blocks'])} requests failed."
+            print(error_message)
+            write_to_error_log(error_message)
+        round_state["collected"] = True
+        save_state()
+
+    if state["rounds"] and not state["rounds"][-1]["collected"]:
+        print(f"Resuming batch {state['rounds'][-1]['batch_id']} submitted by an earlier run")
+        collect(state["rounds"][-1])
+
+    while True:
+        pending = [i for i in range(len(blocks)) if i not in tagged and validation_failures[i] <= max_retries]
+        if not pending or len(state["rounds"]) > CONFIG["batch_api"]["MAX_RESUBMITS"]:
+            break
+        round_number = len(state["rounds"])
+        if round_number > 0:
+            print(f"Resubmitting {len(pending)} block(s) that failed (resubmission {round_number})...")
+        input_path = batch_api_paths["dir"] / f"input-{round_number}.jsonl"
+        write_batch_input(openai_client, blocks, pending, round_number, input_path)
+        round_state = {
+            "round": round_number,
+            "batch_id": submit_batch(openai_client, input_path),
+            "blocks": pending,
+            "collected": False,
+        }
+        state["rounds"].append(round_state)
+        save_state()
+        collect(round_state)
+
+    tagged_blocks = []
+    for i, block in enumerate(blocks):
+        if i in tagged:
+            tagged_blocks.append((tagged[i], True))
+            continue
+        error_message = f"Block {i + 1} was not tagged by any batch. Using untagged source text for this block."
+        print(error_message)
+        write_to_error_log(error_message)
+        tagged_blocks.append((block, False))
+    return tagged_blocks
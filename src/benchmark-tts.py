@@ -0,0 +1,69 @@
+import os
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from tts import convert_text_to_speech
+from postprocess import read_chunk_samples
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Dialogue and narration of typical TTS chunk lengths
+BENCHMARK_TEXTS = [
+    "No, said Harry.",
+    "Did you ask an older student to put it into the Goblet of Fire for you?",
+    "Professor Dumbledore was now looking down at Harry, who looked right back at him, trying to discern "
+    "the expression of the eyes behind the half-moon spectacles.",
+    "It is possible, of course, said Dumbledore politely. Dumbledore, you know perfectly well you did not "
+    "make a mistake! said Professor McGonagall angrily. Really, what nonsense! The boy could not have "
+    "crossed the Age Line himself, and as Professor Dumbledore believes that he did not persuade an older "
+    "student to do it for him, I am sure that should be good enough for everybody else!",
+]
+
+
+def benchmark_method(method: str, voice: str, repeat: int) -> dict:
+    """
+    Measures the real-time factor (synthesis time / audio duration) of a TTS method.
+
+    The first synthesis is a warm-up that loads (and for onnx, exports) the model, and is not counted.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_file = os.path.join(temp_dir, "benchmark.mp3")
+
+        start = time.perf_counter()
+        convert_text_to_speech(BENCHMARK_TEXTS[0], voice, method, output_file=output_file)
+        warm_up_seconds = time.perf_counter() - start
+
+        synthesis_seconds = 0.0
+        audio_seconds = 0.0
+        for _ in range(repeat):
+            for text in BENCHMARK_TEXTS:
+                start = time.perf_counter()
+                convert_text_to_speech(text, voice, method, output_file=output_file)
+                synthesis_seconds += time.perf_counter() - start
+                samples, sample_rate = read_chunk_samples(output_file)
+                audio_seconds += len(samples) / sample_rate
+
+    return {
+        "method": method,
+        "warm_up_seconds": warm_up_seconds,
+        "synthesis_seconds": synthesis_seconds,
+        "audio_seconds": audio_seconds,
+        "real_time_factor": synthesis_seconds / audio_seconds if audio_seconds else float("inf"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the real-time factor of local TTS backends.")
+    parser.add_argument("-m", "--methods", nargs="+", default=["local", "onnx"], help="TTS methods to compare.")
+    parser.add_argument("-v", "--voice", default="male_1", help="Voice identifier from the voice mapping.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Times the benchmark texts are synthesized.")
+    args = parser.parse_args()
+
+    results = [benchmark_method(method, args.voice, args.repeat) for method in args.methods]
+
+    print(f"\n{'method':<12}{'warm-up (s)':>14}{'synthesis (s)':>16}{'audio (s)':>12}{'RTF':>8}")
+    for result in results:
+        print(f"{result['method']:<12}{result['warm_up_seconds']:>14.2f}{result['synthesis_seconds']:>16.2f}"
+              f"{result['audio_seconds']:>12.2f}{result['real_time_factor']:>8.3f}")
+    print("\nRTF below 1 is faster than real time. Lower is better.")
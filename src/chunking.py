@@ -0,0 +1,150 @@
+# chunking.py
+
+import re
+import hashlib
+from config import CONFIG
+from utils import count_tokens, split_into_sentences, iter_speaker_segments, split_text_into_chunks
+
+
+def is_anchor_paragraph(paragraph: str, paragraph_token_count: int) -> bool:
+    """Returns whether a block may end after a paragraph, decided by a hash of its text alone.
+
+    Paragraphs are anchors with a probability proportional to their length, so there is an anchor
+    about every CONFIG["block_boundaries"]["ANCHOR_TOKENS"] tokens whatever the paragraph lengths.
+    """
+    digest = hashlib.sha256(paragraph.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < paragraph_token_count / CONFIG["block_boundaries"]["ANCHOR_TOKENS"]
+
+
+def iter_blocks(paragraphs):
+    """Lazily packs paragraphs into manageable blocks based on token limits.
+
+    Yields each block as soon as it is full, so only one block is held in memory at a time.
+
+    With CONFIG["block_boundaries"]["CONTENT_DEFINED"], a block also ends after an anchor paragraph once
+    it holds MIN_BLOCK_FRACTION of the prompt token limit. Since anchors depend only on the text of the
+    paragraphs, an edit to the plaintext changes the blocks up to the next anchor after it, and every
+    later block comes out the same as before, so Step 2 can reuse their tagged text.
+    """
+    MODEL_MAX_TOKENS = CONFIG["token_limits"]["MODEL_MAX_TOKENS"]
+    MAX_COMPLETION_TOKENS = CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"]
+    TOKEN_BUFFER = CONFIG["token_limits"]["TOKEN_BUFFER"]
+    TTS_MAX_CHARACTERS = CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+
+    MAX_PROMPT_TOKENS = MODEL_MAX_TOKENS - MAX_COMPLETION_TOKENS - TOKEN_BUFFER
+
+    system_message_token_count = count_tokens(CONFIG["system_message"])
+    user_message_token_count = count_tokens(
+        CONFIG["user_message_prefix"] + CONFIG["user_message_suffix"]
+    )
+    content_defined = CONFIG["block_boundaries"]["CONTENT_DEFINED"]
+    min_block_tokens = CONFIG["block_boundaries"]["MIN_BLOCK_FRACTION"] * (
+        MAX_PROMPT_TOKENS - system_message_token_count - user_message_token_count
+    )
+
+    current_block = ""
+    current_block_token_count = 0
+
+    for paragraph in paragraphs:
+        paragraph_token_count = count_tokens(paragraph)
+
+        if (current_block_token_count + paragraph_token_count + system_message_token_count +
+                user_message_token_count) <= MAX_PROMPT_TOKENS:
+            current_block += ("\n\n" if current_block else "") + paragraph
+            current_block_token_count += paragraph_token_count
+            if content_defined and current_block_token_count >= min_block_tokens and \
+                    is_anchor_paragraph(paragraph, paragraph_token_count):
+                yield current_block
+                current_block = ""
+                current_block_token_count = 0
+        else:
+            if (paragraph_token_count + system_message_token_count +
+                    user_message_token_count) > MAX_PROMPT_TOKENS:
+                sentences = split_into_sentences(paragraph)
+                for sentence in sentences:
+                    sentence_token_count = count_tokens(sentence)
+                    if (current_block_token_count + sentence_token_count +
+                            system_message_token_count + user_message_token_count) <= MAX_PROMPT_TOKENS:
+                        current_block += (" " if current_block else "") + sentence
+                        current_block_token_count += sentence_token_count
+                    else:
+                        if current_block:
+                            yield current_block
+                        current_block = sentence
+                        current_block_token_count = sentence_token_count
+            else:
+                if current_block:
+                    yield current_block
+                current_block = paragraph
+                current_block_token_count = paragraph_token_count
+
+    if current_block:
+        yield current_block
+
+
+def split_into_blocks(input_text: str) -> list:
+    """Splits the input text into manageable blocks based on token limits."""
+    return list(iter_blocks(re.split(r'\n\s*\n', input_text)))
+
+
+def iter_tts_segments(processed_text: str, characters_map: dict):
+    """Yields the narrator and dialogue segments of a piece of tagged text, with their voices."""
+    narrator_voice = characters_map.get("narrator", CONFIG["voice_identifiers"]["narrator_voice"])
+    for text, name in iter_speaker_segments(processed_text):
+        if name is None:
+            yield {"text": text, "voice": narrator_voice}
+        else:
+            yield {"text": text, "voice": characters_map.get(name, CONFIG["voice_identifiers"]["default_voice"])}
+
+
+def merge_tts_segments(segments, max_characters=None):
+    """Lazily merges consecutive segments with the same voice into chunks suitable for TTS API requests.
+
+    Chunks are at most max_characters long, CONFIG["token_limits"]["TTS_MAX_CHARACTERS"] if not passed.
+    """
+    TTS_MAX_CHARACTERS = max_characters or CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+
+    # Split segments into chunks not exceeding TTS_MAX_CHARACTERS
+    current_chunk = ""
+    current_voice = None
+
+    for segment in segments:
+        text = segment["text"]
+        voice = segment["voice"]
+
+        if current_voice and voice != current_voice:
+            if current_chunk.strip():
+                yield {"text": current_chunk.strip(), "voice": current_voice}
+            current_chunk = text
+            current_voice = voice
+        else:
+            current_chunk += " " + text if current_chunk else text
+            current_voice = voice
+
+        # If the current chunk exceeds the max length, split it
+        if len(current_chunk) > TTS_MAX_CHARACTERS:
+            split_chunks = split_text_into_chunks(current_chunk, TTS_MAX_CHARACTERS)
+            for split_text in split_chunks:
+                yield {"text": split_text, "voice": current_voice}
+            current_chunk = ""
+            current_voice = None
+
+    if current_chunk.strip():
+        yield {"text": current_chunk.strip(), "voice": current_voice}
+
+
+def iter_tts_chunks(tagged_units, characters_map: dict, max_characters=None):
+    """Lazily splits tagged text into chunks suitable for TTS API requests.
+
+    tagged_units is an iterable of pieces of tagged text that do not split a tag, such as the
+    units yielded by iter_tagged_units, so the whole book never has to be held in memory.
+    Consecutive segments with the same voice are merged across units.
+    """
+    return merge_tts_segments(
+        (segment for unit in tagged_units for segment in iter_tts_segments(unit, characters_map)), max_characters
+    )
+
+
+def split_text_for_tts(processed_text: str, characters_map: dict) -> list:
+    """Splits the processed text into segments suitable for TTS API requests."""
+    return list(iter_tts_chunks([processed_text], characters_map))
@@ -11,11 +11,13 @@ BASE_DIR = Path(__file__).resolve().parent
 
 # Configuration and Constants
 CONFIG = {
-    "api_key": os.getenv("GITHUB_TOKEN"),
     "inputs_path": BASE_DIR.parent / "inputs",
     "outputs_path": BASE_DIR.parent / "outputs",
-    "base_url": "https://models.inference.ai.azure.com",
-    "model": "gpt-4o",
+    "llm_provider": os.getenv("LLM_PROVIDER", "github"),  # Selected with --llm-provider, see "llm_providers"
+    # Set from the selected LLM provider by use_llm_provider
+    "api_key": None,
+    "base_url": None,
+    "model": None,
     "system_message": """You are given a block of text that may contain dialogue. Your task is to identify the dialogue spoken by characters and wrap each spoken line with a tag labeled with the speaker’s name in snake_case, appending '-m' if the character is male or '-f' if the character is female.
 
 Important Rules:
@@ -129,11 +131,205 @@ User input:\n\n```\n""",
     "user_message_prefix": "Actual input:\n\n```",
     "user_message_suffix": "\n```",
     "token_limits": {
-        "MODEL_MAX_TOKENS": 8192,  # For GPT-4
-        "MAX_COMPLETION_TOKENS": 2048,
+        "MODEL_MAX_TOKENS": 8192,  # Set from the selected LLM provider's model profile
+        "MAX_COMPLETION_TOKENS": 2048,  # Set from the selected LLM provider's model profile
         "TOKEN_BUFFER": 100,  # Buffer to account for additional tag characters
         "TTS_MAX_CHARACTERS": 4096,  # Max characters per TTS request
     },
+    "block_boundaries": {  # Where Step 2 ends one block and starts the next
+        "CONTENT_DEFINED": True,  # End blocks after anchor paragraphs, so an edit to the plaintext only moves the blocks around it
+        "MIN_BLOCK_FRACTION": 0.5,  # Fraction of the prompt token limit a block reaches before an anchor can end it
+        "ANCHOR_TOKENS": 1000,  # Average tokens between anchor paragraphs. Paragraphs are anchors in proportion to their length
+    },
+    "tag_validation": {
+        "MAX_RETRIES": 2,  # Times a block that fails validation is re-requested
+        "MIN_SIMILARITY": 0.98,  # Ratio of source words that must survive tagging unchanged
+    },
+    "post_processing": {  # Used when --post-process is passed
+        "SILENCE_THRESHOLD_DBFS": -45,  # Frames quieter than this are treated as silence
+        "FRAME_MS": 10,  # Frame length used to detect silence and measure loudness
+        "KEEP_SILENCE_MS": 60,  # Silence kept before and after the speech of each chunk
+        "TARGET_DBFS": -20,  # Loudness of the speech of every voice after normalization
+        "MAX_GAIN_DB": 15,  # Largest boost or cut applied to a voice
+        "PEAK_CEILING_DBFS": -1,  # A chunk's gain is lowered if its peak would exceed this
+        "PAUSE_MS": 350,  # Silence added after every chunk
+        "BATCH_SIZE": 64,  # Chunks processed together in one vectorized pass
+    },
+    "encoding_profiles": {  # Selected with --encoding-profile in Step 4
+        "speech": {  # Mono AAC-LC, transparent for TTS speech, at the native sample rate of the audio files
+            "CODEC": "aac",
+            "BITRATE": "64k",
+            "CHANNELS": 1,
+            "SAMPLE_RATE": None,  # None keeps the sample rate of the audio files
+            "PROFILE": None,  # Encoder profile passed to ffmpeg's -profile:a
+        },
+        "speech-small": {  # Mono AAC-LC at a low speech bitrate, resampled to 22.05 kHz
+            "CODEC": "aac",
+            "BITRATE": "40k",
+            "CHANNELS": 1,
+            "SAMPLE_RATE": 22050,
+            "PROFILE": None,
+        },
+        "speech-he-aac": {  # Mono HE-AAC, smallest. Requires an ffmpeg built with libfdk_aac
+            "CODEC": "libfdk_aac",
+            "BITRATE": "32k",
+            "CHANNELS": 1,
+            "SAMPLE_RATE": None,
+            "PROFILE": "aac_he",
+        },
+        "pydub-default": {  # The encoder defaults, which is how the m4b was encoded before profiles existed
+            "CODEC": "aac",
+            "BITRATE": None,
+            "CHANNELS": None,
+            "SAMPLE_RATE": None,
+            "PROFILE": None,
+        },
+    },
+    "local_batching": {  # Used by the 'local' TTS method
+        "BATCH_SIZE": 16,  # Most sentences in one forward pass. 1 synthesizes chunk by chunk instead
+        "MAX_BATCH_TOKENS": 2048,  # Most tokens in one padded batch (batch size x longest sentence)
+        "MAX_LENGTH_RATIO": 1.5,  # Longest sentence in a batch is at most this many times the shortest
+        "WINDOW_CHUNKS": 32,  # Chunks whose sentences are grouped and batched together
+        "SENTENCE_PAUSE_MS": 450,  # Silence after each sentence, matching Coqui's own synthesizer
+    },
+    "onnx": {  # Used by the 'onnx' TTS method
+        "CACHE_DIR": BASE_DIR.parent / "models" / "onnx",  # Where exported models are cached
+        "INTRA_OP_THREADS": os.cpu_count() or 1,  # Threads used inside each operator
+        "INTER_OP_THREADS": 1,  # Operators run one at a time, VITS has little graph parallelism
+        "SENTENCE_PAUSE_MS": 450,  # Silence after each sentence, matching Coqui's own synthesizer
+    },
+    "planner": {  # Used by --dry-run
+        "TAG_TOKEN_OVERHEAD": 0.15,  # Extra completion tokens the tags add to a block, as a share of its tokens
+        "DEFAULT_THROUGHPUT": {  # Used until a step has been timed on this machine (outputs/throughput.json)
+            "llm": {"gpt-4o": 150},  # Tokens of source text tagged per second
+            "tts": {  # Characters synthesized per second
+                "local": 60,
+                "onnx": 90,
+                "openai": 250,
+                "elevenlabs": 150,
+            },
+        },
+        "PRICING": {  # In USD. Backends missing here are treated as free
+            "llm": {"gpt-4o": {"PROMPT_PER_1M_TOKENS": 2.5, "COMPLETION_PER_1M_TOKENS": 10.0}},
+            "tts": {  # Per 1M characters
+                "openai": 15.0,
+                "elevenlabs": 180.0,
+            },
+        },
+    },
+    "profiling": {  # Used by --profile
+        "SAMPLE_INTERVAL_SECONDS": 0.01,  # How often the stacks of every thread are sampled for the collapsed stacks
+        "DETERMINISTIC": True,  # Also trace every call of the main thread with cProfile, which slows pure Python code down
+        "TRACEMALLOC": True,  # Trace Python allocations for the peak memory of each step, which slows allocations down
+        "TOP_FRAMES": 10,  # Hottest frames reported for each step
+    },
+    "llm_providers": {  # OpenAI-compatible chat completion servers that can tag dialogue
+        "github": {  # GitHub Models
+            "BASE_URL": os.getenv("GITHUB_MODELS_BASE_URL", "https://models.inference.ai.azure.com"),
+            "API_KEY_ENV": "GITHUB_TOKEN",
+            "API_KEY_REQUIRED": True,
+            "MODEL": "gpt-4o",
+            "PROFILE": "gpt-4o",  # Key in "llm_model_profiles"
+            "RATE_LIMITS": {  # Units are prompt tokens plus the completion token limit
+                "REQUESTS_PER_MINUTE": 10,  # GitHub Models free tier for gpt-4o
+                "UNITS_PER_MINUTE": None,  # None for no limit
+                "MAX_CONCURRENCY": 1,  # Also the requests Step 2 sends at once outside of batch mode
+            },
+        },
+        "openai": {  # The OpenAI API, which also accepts --batch-api
+            "BASE_URL": os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+            "API_KEY_ENV": "OPENAI_API_KEY",
+            "API_KEY_REQUIRED": True,
+            "MODEL": "gpt-4o",
+            "PROFILE": "gpt-4o",
+            "RATE_LIMITS": {"REQUESTS_PER_MINUTE": 500, "UNITS_PER_MINUTE": 30000, "MAX_CONCURRENCY": 8},  # Tier 1
+        },
+        "llama.cpp": {  # llama-server, started with --parallel matching MAX_CONCURRENCY
+            "BASE_URL": os.getenv("LLAMA_CPP_BASE_URL", "http://127.0.0.1:8080/v1"),
+            "API_KEY_ENV": "LLAMA_CPP_API_KEY",  # Only if the server was started with --api-key
+            "API_KEY_REQUIRED": False,
+            "MODEL": os.getenv("LLAMA_CPP_MODEL", "local-model"),  # llama-server answers with whatever it loaded
+            "PROFILE": os.getenv("LLAMA_CPP_PROFILE", "llama-3.1-8b-instruct"),
+            "RATE_LIMITS": {"REQUESTS_PER_MINUTE": None, "UNITS_PER_MINUTE": None, "MAX_CONCURRENCY": 4},
+        },
+        "vllm": {  # vLLM's OpenAI-compatible server, which batches concurrent requests on the GPU
+            "BASE_URL": os.getenv("VLLM_BASE_URL", "http://127.0.0.1:8000/v1"),
+            "API_KEY_ENV": "VLLM_API_KEY",  # Only if the server was started with --api-key
+            "API_KEY_REQUIRED": False,
+            "MODEL": os.getenv("VLLM_MODEL", "meta-llama/Llama-3.1-8B-Instruct"),
+            "PROFILE": os.getenv("VLLM_PROFILE", "llama-3.1-8b-instruct"),
+            "RATE_LIMITS": {"REQUESTS_PER_MINUTE": None, "UNITS_PER_MINUTE": None, "MAX_CONCURRENCY": 16},
+        },
+        "ollama": {  # Ollama's OpenAI-compatible endpoint
+            "BASE_URL": os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434/v1"),
+            "API_KEY_ENV": None,
+            "API_KEY_REQUIRED": False,
+            "MODEL": os.getenv("OLLAMA_MODEL", "llama3.1:8b"),
+            "PROFILE": os.getenv("OLLAMA_PROFILE", "llama-3.1-8b-instruct"),
+            "RATE_LIMITS": {"REQUESTS_PER_MINUTE": None, "UNITS_PER_MINUTE": None, "MAX_CONCURRENCY": 2},
+        },
+    },
+    "llm_model_profiles": {  # Context size and sampling of the models providers serve
+        "gpt-4o": {
+            "MODEL_MAX_TOKENS": 8192,
+            "MAX_COMPLETION_TOKENS": 2048,
+            "TEMPERATURE": 0.2,
+        },
+        "llama-3.1-8b-instruct": {  # Also a reasonable start for other 7-14B instruct models
+            "MODEL_MAX_TOKENS": 8192,  # Keep at or below the server's context size (llama-server -c)
+            "MAX_COMPLETION_TOKENS": 2048,
+            "TEMPERATURE": 0.1,  # Small models rewrite the text less at lower temperatures
+        },
+        "qwen2.5-14b-instruct": {
+            "MODEL_MAX_TOKENS": 16384,
+            "MAX_COMPLETION_TOKENS": 4096,
+            "TEMPERATURE": 0.1,
+        },
+    },
+    "batch_api": {  # Used by --batch-api
+        "COMPLETION_WINDOW": "24h",  # How long the provider may take to run a batch
+        "POLL_SECONDS": 30,  # Time between checks of a submitted batch's status
+        "MAX_RESUBMITS": 3,  # Times the entries of a batch that failed are submitted again in a new batch
+    },
+    "rate_limits": {  # Shared by every request to each API, see src/rate_governor.py
+        "MAX_RETRIES": 6,  # Times a throttled or failed request is sent again
+        "BASE_DELAY_SECONDS": 1.0,  # Backoff before the first retry, doubled for each retry and jittered
+        "MAX_DELAY_SECONDS": 60.0,  # Longest backoff between retries
+        "llm": None,  # Tagging requests. Set from the RATE_LIMITS of the selected LLM provider
+        "openai": {  # OpenAI TTS requests. Units are characters
+            "REQUESTS_PER_MINUTE": 50,
+            "UNITS_PER_MINUTE": None,
+            "MAX_CONCURRENCY": 4,
+        },
+        "elevenlabs": {  # ElevenLabs TTS requests. Units are characters
+            "REQUESTS_PER_MINUTE": None,
+            "UNITS_PER_MINUTE": None,
+            "MAX_CONCURRENCY": 2,  # Concurrent request limit of the Starter and Creator plans
+        },
+    },
+    "streaming": {
+        "MAX_IN_FLIGHT": 16,  # Blocks or chunks submitted to a worker pool ahead of the one being written
+    },
+    "batch": {
+        "BOOK_WORKERS": 4,  # Books whose steps run at the same time
+        "LLM_WORKERS": 4,  # Concurrent tagging requests shared by every book
+        "TTS_WORKERS": {  # Concurrent TTS requests shared by every book, per TTS method
+            "local": 1,  # Local models are loaded once and synthesize one chunk at a time
+            "onnx": 1,  # Each ONNX session already uses every core
+            "openai": 4,
+            "elevenlabs": 2,
+        },
+    },
+    "autotune": {
+        "CHUNK_SIZES": [250, 500, 1000, 2000, 4000],  # Chunk lengths measured, up to TTS_MAX_CHARACTERS
+        "CONCURRENCY_LEVELS": [1, 2, 4, 8, 16],  # Concurrent requests measured, until throughput stops rising
+        "REQUESTS_PER_SETTING": 3,  # Requests timed per chunk length, and per concurrent request slot
+        "TOLERANCE": 0.05,  # Prefer smaller settings within this share of the best throughput
+    },
+    "job_server": {
+        "JOB_WORKERS": 2,  # Jobs converted at the same time. Tagging and synthesis use the batch LLM and TTS pools
+        "MAX_UPLOAD_MB": 200,  # Largest book accepted by POST /jobs
+    },
     "voice_identifiers": {
         "male_voices": ["male_2", "male_3", "male_4"],
         "female_voices": ["female_1", "female_2"],
@@ -198,4 +394,35 @@ def get_openai_voice_map():
 
 def get_elevenlabs_voice_map():
   global elevenlabs_voice_mapping
-  return elevenlabs_voice_mapping
\ No newline at end of file
+  return elevenlabs_voice_mapping
+
+def use_llm_provider(name):
+  """Points dialogue tagging at an LLM provider in CONFIG["llm_providers"], with its model profile and rate limits."""
+  if name not in CONFIG["llm_providers"]:
+    raise ValueError(f'Unknown LLM provider "{name}". Choose one of: {", ".join(CONFIG["llm_providers"])}')
+  provider = CONFIG["llm_providers"][name]
+  profile = CONFIG["llm_model_profiles"][provider["PROFILE"]]
+  CONFIG["llm_provider"] = name
+  CONFIG["base_url"] = provider["BASE_URL"]
+  CONFIG["api_key"] = os.getenv(provider["API_KEY_ENV"]) if provider["API_KEY_ENV"] else None
+  CONFIG["model"] = provider["MODEL"]
+  CONFIG["token_limits"]["MODEL_MAX_TOKENS"] = profile["MODEL_MAX_TOKENS"]
+  CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"] = profile["MAX_COMPLETION_TOKENS"]
+  CONFIG["rate_limits"]["llm"] = provider["RATE_LIMITS"]
+
+def get_llm_profile():
+  """Returns the model profile of the selected LLM provider."""
+  return CONFIG["llm_model_profiles"][CONFIG["llm_providers"][CONFIG["llm_provider"]]["PROFILE"]]
+
+def get_missing_llm_api_key():
+  """Returns the environment variable of the selected LLM provider's API key if it is required and not set."""
+  provider = CONFIG["llm_providers"][CONFIG["llm_provider"]]
+  if provider["API_KEY_REQUIRED"] and not CONFIG["api_key"]:
+    return provider["API_KEY_ENV"]
+  return None
+
+if CONFIG["llm_provider"] not in CONFIG["llm_providers"]:
+  print(f'LLM_PROVIDER is set to the unknown provider "{CONFIG["llm_provider"]}", using "github". '
+        f'Choose one of: {", ".join(CONFIG["llm_providers"])}')
+  CONFIG["llm_provider"] = "github"
+use_llm_provider(CONFIG["llm_provider"])
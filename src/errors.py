@@ -1,23 +1,26 @@
+import threading
 from config import BASE_DIR
 
 has_new_errors = False
+error_log_lock = threading.Lock()
 
-# Clear the existing error log
-with open(BASE_DIR.parent / "error.log", 'w') as f:
-  f.write('')
+def clear_error_log():
+  """Clears the existing error log. Called by entry points when a run starts, not on import, so tools and
+  worker processes that import this module do not wipe the log of a run."""
+  with error_log_lock:
+    with open(BASE_DIR.parent / "error.log", 'w') as f:
+      f.write('')
 
 def write_to_error_log(contents):
   """Write contents to an error log file."""
   global has_new_errors
   error_log_path = BASE_DIR.parent / "error.log"
-  has_new_errors = True
-  if not error_log_path.exists():
-    with open(error_log_path, 'w') as f:
-      f.write('')
-  with open(error_log_path, 'a') as f:
-    if not contents.endswith('\n'):
-      contents += '\n'
-    f.write(contents)
+  if not contents.endswith('\n'):
+    contents += '\n'
+  with error_log_lock:
+    has_new_errors = True
+    with open(error_log_path, 'a') as f:
+      f.write(contents)
   
 def error_log_has_new_errors():
   """Returns true if the error log has new errors during this run."""
@@ -0,0 +1,149 @@
+# fingerprints.py
+
+import hashlib
+import json
+from config import CONFIG, get_vits_voice_map, get_openai_voice_map, get_elevenlabs_voice_map
+from autotune import get_tts_max_characters
+
+# The files (keys of get_book_paths) each step writes
+STEP_OUTPUTS = {
+    1: ["plaintext", "documents_json"],
+    2: ["tagged", "characters_json", "metadata_json"],
+    3: ["audio_files_dir"],
+    4: ["m4b"],
+}
+
+# Stats returned by a step that mean its outputs are incomplete and it should run again
+STEP_FAILURE_STATS = ["failed_blocks", "failed_chunks", "bad_chunks", "failed_encode"]
+
+VOICE_MAP_GETTERS = {
+    "local": get_vits_voice_map,
+    "onnx": get_vits_voice_map,
+    "openai": get_openai_voice_map,
+    "elevenlabs": get_elevenlabs_voice_map,
+}
+
+
+def fingerprint_file(path):
+    """Returns the sha256 of a file's contents, or None if it does not exist."""
+    if path is None or not path.exists():
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_directory(path, suffix):
+    """Returns a fingerprint of the name, size and modification time of every file with suffix in a directory."""
+    if not path.exists():
+        return None
+    digest = hashlib.sha256()
+    for file_path in sorted(path.iterdir()):
+        if file_path.suffix.lower() == suffix:
+            stat = file_path.stat()
+            digest.update(f"{file_path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def fingerprint_value(value):
+    """Returns the sha256 of a JSON-serializable value, such as a section of the config."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_tagging_fingerprint():
+    """Returns the fingerprint of the config that decides how Step 2 splits and tags the plaintext."""
+    return fingerprint_value({
+        key: CONFIG[key] for key in (
+            "base_url", "model", "system_message", "characters_json_system_message",
+            "user_message_prefix", "user_message_suffix", "token_limits", "block_boundaries", "tag_validation",
+            "voice_identifiers",
+        )
+    })
+
+
+def get_step_inputs(step: int, input_file: str, paths: dict, tts_method: str, m4b_method: str, cover_image=None,
+                    post_process=False, encoding_profile=None) -> dict:
+    """Returns the fingerprint of every input that a step's outputs depend on."""
+    if step == 1:
+        return {
+            "source file": fingerprint_file(CONFIG["inputs_path"] / input_file),
+        }
+    if step == 2:
+        return {
+            "plaintext": fingerprint_file(paths["plaintext"]),
+            "tagging config": get_tagging_fingerprint(),
+        }
+    if step == 3:
+        return {
+            "tagged text": fingerprint_file(paths["tagged"]),
+            "characters.json": fingerprint_file(paths["characters_json"]),
+            "tts config": fingerprint_value({
+                "tts_method": tts_method,
+                "voice_map": VOICE_MAP_GETTERS[tts_method](),
+                "voice_identifiers": CONFIG["voice_identifiers"],
+                "TTS_MAX_CHARACTERS": get_tts_max_characters(tts_method),
+            }),
+        }
+    if step == 4:
+        return {
+            "audio files": fingerprint_directory(paths["audio_files_dir"], ".mp3"),
+            "metadata.json": fingerprint_file(paths["metadata_json"]),
+            "cover image": fingerprint_file(cover_image),
+            "chunks.jsonl": fingerprint_file(paths["chunks_jsonl"]) if post_process else None,
+            "m4b config": fingerprint_value({
+                "m4b_method": m4b_method,
+                "encoding_profile": CONFIG["encoding_profiles"].get(encoding_profile),
+                "post_processing": CONFIG["post_processing"] if post_process else None,
+            }),
+        }
+    raise ValueError(f"Unknown step {step}.")
+
+
+def load_fingerprints(paths: dict) -> dict:
+    """Reads the fingerprints recorded for a book's steps from outputs/<book_name>/fingerprints.json."""
+    fingerprints_path = paths["output_dir"] / "fingerprints.json"
+    if not fingerprints_path.exists():
+        return {}
+    with open(fingerprints_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def record_step(paths: dict, step: int, inputs: dict, stats: dict):
+    """Records the input fingerprints a step ran with, unless it finished with failures.
+
+    A step with failures, or that did not write all of its outputs, has its fingerprint removed so the
+    next default run repeats it.
+    """
+    fingerprints = load_fingerprints(paths)
+    if any(stats.get(key) for key in STEP_FAILURE_STATS) or \
+            any(not paths[key].exists() for key in STEP_OUTPUTS[step]):
+        fingerprints.pop(str(step), None)
+    else:
+        fingerprints[str(step)] = {"inputs": inputs}
+    paths["output_dir"].mkdir(parents=True, exist_ok=True)
+    with open(paths["output_dir"] / "fingerprints.json", "w", encoding="utf-8") as f:
+        json.dump(fingerprints, f, indent=2)
+
+
+def check_step(step: int, paths: dict, inputs: dict) -> tuple:
+    """
+    Decides whether a step needs to run, like make.
+
+    Returns a tuple of (should_run, reason). A step runs when one of its outputs is missing, when it
+    has no recorded fingerprint, or when the fingerprint of one of its inputs changed since it last ran.
+    """
+    missing = [paths[key].name for key in STEP_OUTPUTS[step] if not paths[key].exists()]
+    if missing:
+        return (True, f"missing {', '.join(missing)}")
+
+    recorded = load_fingerprints(paths).get(str(step))
+    if not recorded:
+        return (True, "no record of a previous successful run")
+
+    changed = [name for name, fingerprint in inputs.items() if recorded["inputs"].get(name) != fingerprint]
+    if changed:
+        return (True, f"{', '.join(changed)} changed")
+
+    return (False, "outputs are up to date")
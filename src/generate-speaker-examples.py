@@ -1,17 +1,103 @@
 import os
+import json
+import hashlib
 import logging
+import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from TTS.api import TTS  # Ensure you have the TTS library installed
+from postprocess import read_chunk_samples
 
-def generate_speech_for_speakers(start: int, end: int, output_dir: str, text: str):
+MODEL_NAME = "tts_models/en/vctk/vits"
+
+# TTS model loaded once per worker process
+worker_tts = None
+
+
+def init_worker(model_name: str):
+    """Loads the TTS model once in each worker process."""
+    global worker_tts
+    worker_tts = TTS(model_name)
+
+
+def estimate_pitch(samples: np.ndarray, sample_rate: int, min_hz: float = 60.0, max_hz: float = 400.0) -> np.ndarray:
+    """
+    Estimates the pitch of every voiced frame with autocorrelation, computed for all frames at once.
+
+    Args:
+        samples (np.ndarray): Mono float32 samples.
+        sample_rate (int): Sample rate of the samples.
+
+    Returns:
+        np.ndarray: Pitch in Hz of each voiced frame.
+    """
+    frame_length = int(sample_rate * 0.04)
+    hop_length = int(sample_rate * 0.01)
+    if len(samples) < frame_length:
+        return np.zeros(0)
+
+    frame_count = 1 + (len(samples) - frame_length) // hop_length
+    frame_index = np.arange(frame_length)[None, :] + hop_length * np.arange(frame_count)[:, None]
+    frames = samples[frame_index] * np.hanning(frame_length)[None, :]
+
+    # Only keep frames loud enough to be speech
+    energy = np.sqrt((frames ** 2).mean(axis=1))
+    frames = frames[energy > max(energy.max() * 0.1, 1e-4)]
+    if len(frames) == 0:
+        return np.zeros(0)
+
+    spectrum = np.fft.rfft(frames, n=2 * frame_length, axis=1)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2, axis=1)[:, :frame_length]
+
+    min_lag = int(sample_rate / max_hz)
+    max_lag = min(int(sample_rate / min_hz), frame_length - 1)
+    lags = min_lag + np.argmax(autocorrelation[:, min_lag:max_lag], axis=1)
+
+    # Frames without a clear periodic peak are unvoiced
+    peak_strength = autocorrelation[np.arange(len(lags)), lags] / np.maximum(autocorrelation[:, 0], 1e-12)
+    return sample_rate / lags[peak_strength > 0.3]
+
+
+def analyze_speaker_sample(file_path) -> dict:
+    """Measures the duration, loudness and pitch statistics of a speaker sample."""
+    samples, sample_rate = read_chunk_samples(file_path)
+    rms = np.sqrt(np.mean(samples ** 2)) if len(samples) else 0.0
+    pitch = estimate_pitch(samples, sample_rate)
+    return {
+        "duration_seconds": round(len(samples) / sample_rate, 2),
+        "loudness_dbfs": round(float(20 * np.log10(max(rms, 1e-9))), 1),
+        "pitch_mean_hz": round(float(pitch.mean()), 1) if len(pitch) else None,
+        "pitch_median_hz": round(float(np.median(pitch)), 1) if len(pitch) else None,
+        "pitch_std_hz": round(float(pitch.std()), 1) if len(pitch) else None,
+    }
+
+
+def synthesize_speaker(speaker_id: str, output_file: str, text: str) -> dict:
+    """Generates the sample for one speaker in a worker process and returns its analysis."""
+    worker_tts.tts_to_file(
+        text=text,
+        speaker=speaker_id,
+        file_path=output_file
+    )
+    return analyze_speaker_sample(output_file)
+
+
+def generate_speech_for_speakers(start: int, end: int, output_dir: str, text: str, workers: int = 1, force: bool = False):
     """
-    Generates speech files for speaker IDs from p{start} to p{end}.
+    Generates speech files for speaker IDs from p{start} to p{end}, along with an index.json of
+    the duration, loudness and pitch statistics of every speaker.
+
+    Speakers whose sample already exists for the same model and text are skipped unless force is
+    passed. The rest are synthesized across worker processes that each load the model once.
 
     Args:
         start (int): Starting number for speaker IDs.
         end (int): Ending number for speaker IDs.
         output_dir (str): Directory where the audio files will be saved.
         text (str): The text to convert to speech.
+        workers (int): Number of worker processes.
+        force (bool): Regenerate every speaker even if its sample is up to date.
     """
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -21,31 +107,56 @@ def generate_speech_for_speakers(start: int, end: int, output_dir: str, text: st
                         level=logging.INFO,
                         format='%(asctime)s:%(levelname)s:%(message)s')
 
-    # Initialize TTS model once if possible
-    model_name = "tts_models/en/vctk/vits"
-    try:
-        tts = TTS(model_name)
-        logging.info(f"Initialized TTS model: {model_name}")
-    except Exception as e:
-        error_msg = f"Failed to initialize TTS model '{model_name}': {e}"
-        logging.error(error_msg)
-        return
+    index_path = Path(output_dir) / "index.json"
+    index = {}
+    if index_path.exists():
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+
+    text_hash = hashlib.sha256(f"{MODEL_NAME}\n{text}".encode("utf-8")).hexdigest()
 
+    pending = []
     for num in range(start, end + 1):
         speaker_id = f"p{num}"
         output_file = os.path.join(output_dir, f"{speaker_id}.wav")
+        entry = index.get(speaker_id)
+        if not force and entry and entry.get("text_hash") == text_hash and os.path.exists(output_file):
+            continue
+        pending.append((speaker_id, output_file))
+
+    print(f"{len(pending)} speaker(s) to generate, {end - start + 1 - len(pending)} already up to date.")
+
+    if pending:
         try:
-            # Generate speech and save to file
-            tts.tts_to_file(
-                text=text,
-                speaker=speaker_id,
-                file_path=output_file
-            )
-            logging.info(f"Successfully generated {output_file}")
+            executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(MODEL_NAME,))
         except Exception as e:
-            error_msg = f"Failed to generate speech for speaker '{speaker_id}': {e}"
+            error_msg = f"Failed to start workers for TTS model '{MODEL_NAME}': {e}"
             logging.error(error_msg)
-            continue  # Proceed with the next speaker
+            return
+
+        with executor:
+            futures = {
+                executor.submit(synthesize_speaker, speaker_id, output_file, text): speaker_id
+                for speaker_id, output_file in pending
+            }
+            for future in as_completed(futures):
+                speaker_id = futures[future]
+                try:
+                    index[speaker_id] = {"text_hash": text_hash, **future.result()}
+                    logging.info(f"Successfully generated {speaker_id}")
+                    print(f"Generated {speaker_id} ({len(index)} indexed)")
+                except Exception as e:
+                    error_msg = f"Failed to generate speech for speaker '{speaker_id}': {e}"
+                    logging.error(error_msg)
+                    index.pop(speaker_id, None)
+                    continue  # Proceed with the next speaker
+
+                # Save progress as we go so an interrupted run can pick up where it left off
+                with open(index_path, "w", encoding="utf-8") as f:
+                    json.dump(dict(sorted(index.items())), f, indent=2)
+
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(index.items())), f, indent=2)
 
 if __name__ == "__main__":
     # Define the range of speaker IDs
@@ -56,6 +167,17 @@ if __name__ == "__main__":
     BASE_DIR = Path(__file__).resolve().parent
     OUTPUT_DIRECTORY = BASE_DIR.parent / "local-voice-examples"
 
+    parser = argparse.ArgumentParser(description="Generate a sample of every local VCTK speaker.")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+        help="Number of worker processes, each loading its own copy of the model.",
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Regenerate every speaker even if its sample is already up to date.",
+    )
+    args = parser.parse_args()
+
     # Define the text to convert to speech
     EXAMPLE_TEXT = """
     This is a test of the text to speech conversion. 
@@ -68,7 +190,10 @@ if __name__ == "__main__":
         start=START_SPEAKER_NUM,
         end=END_SPEAKER_NUM,
         output_dir=OUTPUT_DIRECTORY,
-        text=EXAMPLE_TEXT
+        text=EXAMPLE_TEXT,
+        workers=args.workers,
+        force=args.force,
     )
 
-    print(f"Speech generation completed. Check the '{OUTPUT_DIRECTORY}' directory for output files.")
+    print(f"Speech generation completed. Check the '{OUTPUT_DIRECTORY}' directory for output files "
+          f"and '{OUTPUT_DIRECTORY / 'index.json'}' for the duration, loudness and pitch of each speaker.")
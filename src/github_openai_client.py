@@ -1,42 +1,61 @@
 # openai_client.py
 
-import os
 from errors import write_to_error_log
 from openai import OpenAI
 import json
-from config import CONFIG
-from utils import clean_json_code_blocks
+from config import CONFIG, get_llm_profile
+from utils import clean_json_code_blocks, count_tokens
+from rate_governor import get_rate_governor
+
+# Nucleus sampling of tagging requests
+BLOCK_TOP_P = .5
 
 
 class GitHubOpenAIClient:
+    """
+    Tags dialogue with the selected LLM provider: GitHub Models by default, or any OpenAI-compatible
+    server in CONFIG["llm_providers"], such as a local llama.cpp, vLLM or Ollama server.
+    """
+
     def __init__(self):
+        # Retries are left to the rate governor, which sees every 429 and paces all threads together
         self.openai = OpenAI(
             base_url=CONFIG["base_url"],
-            api_key=CONFIG["api_key"],
-        )
-
-        client = OpenAI(
-            base_url="https://models.inference.ai.azure.com",
-            api_key=os.getenv("GITHUB_TOKEN")
+            # Local servers ignore the key, but the client requires one
+            api_key=CONFIG["api_key"] or "not-needed",
+            max_retries=0,
         )
+        self.profile = get_llm_profile()
+        self.governor = get_rate_governor("llm")
 
-        client
+    def get_completion_body(self, prompt: str, top_p: float) -> dict:
+        """Returns the body of a chat completion request, as sent on its own or in a batch input file."""
+        return {
+            "model": CONFIG["model"],
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"],
+            "temperature": self.profile["TEMPERATURE"],
+            "top_p": top_p,
+        }
 
-    def process_block(self, block: str) -> str:
+    def get_block_prompt(self, block: str) -> str:
         user_message = f"{CONFIG['user_message_prefix']}{block}{CONFIG['user_message_suffix']}"
-        prompt = f"{CONFIG['system_message']}\n\n{user_message}"
+        return f"{CONFIG['system_message']}\n\n{user_message}"
+
+    def create_completion(self, prompt: str, top_p: float, description: str) -> str:
+        """Sends a chat completion through the rate governor and returns the content of its first choice."""
+        response = self.governor.call(
+            lambda: self.openai.chat.completions.with_raw_response.create(**self.get_completion_body(prompt, top_p)),
+            units=count_tokens(prompt) + CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"],
+            description=description,
+        ).parse()
+        return response.choices[0].message.content
 
+    def process_block(self, block: str) -> str:
         try:
-            response = self.openai.chat.completions.create(
-                model=CONFIG["model"],
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"],
-                temperature=.2,
-                top_p=.5
-            )
-            completion = response.choices[0].message.content
+            completion = self.create_completion(self.get_block_prompt(block), BLOCK_TOP_P, "tagging block")
             return completion.strip()
         except Exception as e:
             error_message = f"Error processing block: {e}"
@@ -48,17 +67,8 @@ class GitHubOpenAIClient:
         prompt = f"{CONFIG['characters_json_system_message']}{json.dumps(characters_json, indent=2)}{CONFIG['user_message_suffix']}"
 
         try:
-            response = self.openai.chat.completions.create(
-                model=CONFIG["model"],
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"],
-                temperature=.2,
-                top_p=.8
-            )
             # Extract the content
-            processed_json_str = clean_json_code_blocks(response.choices[0].message.content.strip())
+            processed_json_str = clean_json_code_blocks(self.create_completion(prompt, .8, "processing characters.json").strip())
 
             # Parse the JSON
             try:
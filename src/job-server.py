@@ -0,0 +1,326 @@
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+from pathlib import Path
+from argparse import Namespace
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from config import CONFIG, use_llm_provider, get_missing_llm_api_key
+from errors import clear_error_log, write_to_error_log
+from fingerprints import record_step, STEP_FAILURE_STATS
+from autotune import get_tts_workers
+from batch import SUPPORTED_INPUT_EXTENSIONS
+from main import STEP_TITLES, get_book_paths, get_step_runners, plan_steps
+from tts import TTSWarmUp
+
+TTS_METHODS = ["local", "onnx", "openai", "elevenlabs"]
+M4B_METHODS = ["ffmpeg", "av"]
+
+# Jobs that were not finished when the server stopped, and are queued again when it starts
+UNFINISHED_STATUSES = ("queued", "running")
+
+
+def get_jobs_dir() -> Path:
+    return CONFIG["outputs_path"] / "jobs"
+
+
+class JobServer:
+    """
+    Queues conversion jobs and runs them on a bounded pool of job workers.
+
+    Every job is a book uploaded to the inputs directory under a name unique to the job, converted with
+    the same steps, fingerprints and output layout as main.py. The jobs share one GitHubOpenAIClient, one
+    LLM worker pool and one TTS worker pool per TTS method, so clients, rate governors and loaded TTS
+    models stay warm between jobs. Job records are written to outputs/jobs/<job_id>.json whenever they
+    change, and jobs that were queued or running when the server stopped are queued again when it starts.
+    Since finished steps are fingerprinted, a resumed job continues from the step it was interrupted in.
+    """
+
+    def __init__(self, job_workers: int):
+        self.job_workers = job_workers
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.workers = []
+        self.openai_client = None
+        self.llm_pool = None
+        self.tts_pools = {}
+
+    def start(self):
+        from github_openai_client import GitHubOpenAIClient
+
+        self.openai_client = GitHubOpenAIClient()
+        self.llm_pool = ThreadPoolExecutor(
+            max(CONFIG["batch"]["LLM_WORKERS"], CONFIG["rate_limits"]["llm"]["MAX_CONCURRENCY"]), thread_name_prefix="llm"
+        )
+        self.tts_pools = {
+            tts_method: ThreadPoolExecutor(get_tts_workers(tts_method), thread_name_prefix=f"tts-{tts_method}")
+            for tts_method in TTS_METHODS
+        }
+        self.resume_jobs()
+        for worker_number in range(self.job_workers):
+            worker = threading.Thread(target=self.work, name=f"job-{worker_number + 1}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.llm_pool.shutdown()
+        for tts_pool in self.tts_pools.values():
+            tts_pool.shutdown()
+
+    def resume_jobs(self):
+        """Loads every job record, and queues the ones that did not finish, in the order they were submitted."""
+        jobs_dir = get_jobs_dir()
+        jobs_dir.mkdir(parents=True, exist_ok=True)
+        for job_path in jobs_dir.glob("*.json"):
+            with open(job_path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+            self.jobs[job["id"]] = job
+
+        unfinished = sorted(
+            (job for job in self.jobs.values() if job["status"] in UNFINISHED_STATUSES),
+            key=lambda job: job["created_at"],
+        )
+        for job in unfinished:
+            print(f"Resuming job {job['id']} ({job['filename']}), which was {job['status']} when the server stopped")
+            self.update_job(job["id"], status="queued")
+            self.queue.put(job["id"])
+
+    def get_job(self, job_id: str) -> dict:
+        with self.jobs_lock:
+            if job_id not in self.jobs:
+                raise HTTPException(status_code=404, detail=f"No job with id {job_id}.")
+            return json.loads(json.dumps(self.jobs[job_id]))
+
+    def list_jobs(self) -> list:
+        with self.jobs_lock:
+            jobs = [json.loads(json.dumps(job)) for job in self.jobs.values()]
+        return sorted(jobs, key=lambda job: job["created_at"])
+
+    def update_job(self, job_id: str, progress=None, **fields):
+        """Updates a job's record, in memory and in outputs/jobs/<job_id>.json."""
+        with self.jobs_lock:
+            job = self.jobs[job_id]
+            job.update(fields)
+            if progress:
+                job["progress"].update(progress)
+            job_path = get_jobs_dir() / f"{job_id}.json"
+            with open(job_path.with_suffix(".tmp"), "w", encoding="utf-8") as f:
+                json.dump(job, f, indent=2)
+            job_path.with_suffix(".tmp").replace(job_path)
+
+    def submit(self, job_id: str, filename: str, input_file: str, options: dict) -> dict:
+        """Records a new job for a book already written to the inputs directory as input_file, and queues it."""
+        job = {
+            "id": job_id,
+            "filename": filename,
+            "input_file": input_file,
+            "book_name": job_id,
+            "options": options,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "stats": {},
+            "progress": {"step": None, "step_title": None, "completed_steps": [], "chunks_done": 0, "chunks_total": None},
+        }
+        with self.jobs_lock:
+            self.jobs[job_id] = job
+        self.update_job(job_id)
+        self.queue.put(job_id)
+        return self.get_job(job_id)
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+            try:
+                self.run_job(job_id)
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, job_id: str):
+        """Runs every step of a job whose outputs are missing or out of date."""
+        job = self.get_job(job_id)
+        input_file, book_name = job["input_file"], job["book_name"]
+        options = job["options"]
+        paths = get_book_paths(book_name)
+        args = Namespace(
+            tts_method=options["tts_method"],
+            m4b_method=options["m4b_method"],
+            encoding_profile=options["encoding_profile"],
+            post_process=options["post_process"],
+            extract_workers=None,
+            max_block_retries=CONFIG["tag_validation"]["MAX_RETRIES"],
+            write_processed_blocks=None,
+            progressive=False,
+            shard_index=None,
+            force=False,
+            batch_api=False,
+        )
+        self.update_job(job_id, status="running", started_at=job["started_at"] or time.time())
+
+        def on_chunk_progress(chunks_done, chunks_total):
+            self.update_job(job_id, progress={"chunks_done": chunks_done, "chunks_total": chunks_total})
+
+        step_runners = get_step_runners(
+            self.openai_client, input_file, book_name, paths, args,
+            self.llm_pool, self.tts_pools[args.tts_method], on_chunk_progress,
+        )
+        stats = job["stats"]
+        completed_steps = []
+        failures = []
+        # Models already loaded by earlier jobs are cached, so this only loads the ones a new TTS method needs
+        tts_warm_up = TTSWarmUp(args.tts_method).start()
+        try:
+            for step, inputs in plan_steps([], input_file, book_name, paths, args, f"[{job_id}] "):
+                self.update_job(job_id, progress={"step": step, "step_title": STEP_TITLES[step]})
+                if step == 3:
+                    tts_warm_up.wait()
+                step_stats = step_runners[step]()
+                record_step(paths, step, inputs, step_stats)
+                stats.update(step_stats)
+                completed_steps.append(step)
+                failures += [f"Step {step}: {key} {step_stats[key]}" for key in STEP_FAILURE_STATS if step_stats.get(key)]
+                self.update_job(job_id, stats=stats, progress={"completed_steps": completed_steps})
+        except Exception as e:
+            error_message = f"[{job_id}] Step {self.get_job(job_id)['progress']['step']} failed: {e}"
+            print(error_message)
+            write_to_error_log(error_message)
+            self.update_job(job_id, status="failed", error=error_message, finished_at=time.time())
+            return
+
+        if failures or not paths["m4b"].exists():
+            error_message = f"[{job_id}] Finished with failures ({', '.join(failures)})" if failures else \
+                f"[{job_id}] Finished without writing {paths['m4b']}"
+            print(error_message)
+            write_to_error_log(error_message)
+            self.update_job(job_id, status="failed", error=error_message, finished_at=time.time())
+            return
+        self.update_job(job_id, status="done", error=None, finished_at=time.time(), progress={"step": None, "step_title": None})
+        print(f"[{job_id}] Done: {paths['m4b']}")
+
+
+job_server = JobServer(CONFIG["job_server"]["JOB_WORKERS"])
+
+
+@asynccontextmanager
+async def lifespan(app):
+    job_server.start()
+    yield
+    job_server.stop()
+
+
+app = FastAPI(title="TTS Book to Audio job server", lifespan=lifespan)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: Request, filename: str, tts_method: str = "local", m4b_method: str = "ffmpeg",
+                     encoding_profile: str = "speech", post_process: bool = False):
+    """
+    Uploads a book as the raw request body and queues its conversion, for example:
+    curl --data-binary @my_book.epub "http://127.0.0.1:8200/jobs?filename=my_book.epub&tts_method=openai"
+    """
+    suffix = Path(filename).suffix.lower()
+    if suffix not in SUPPORTED_INPUT_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type {suffix or filename}. "
+                                                    f"Supported types are {', '.join(SUPPORTED_INPUT_EXTENSIONS)}.")
+    if tts_method not in TTS_METHODS:
+        raise HTTPException(status_code=400, detail=f"tts_method must be one of {', '.join(TTS_METHODS)}.")
+    if m4b_method not in M4B_METHODS:
+        raise HTTPException(status_code=400, detail=f"m4b_method must be one of {', '.join(M4B_METHODS)}.")
+    if encoding_profile not in CONFIG["encoding_profiles"]:
+        raise HTTPException(status_code=400, detail=f"encoding_profile must be one of "
+                                                    f"{', '.join(CONFIG['encoding_profiles'])}.")
+
+    # Name the upload after the job, so books with the same file name do not share outputs
+    job_id = f"{Path(filename).stem}-{uuid.uuid4().hex[:8]}"
+    input_file = f"{job_id}{suffix}"
+    input_path = CONFIG["inputs_path"] / input_file
+    max_bytes = CONFIG["job_server"]["MAX_UPLOAD_MB"] * 1024 * 1024
+    received = 0
+    # The file is written on the threadpool, so a slow disk does not hold up the event loop serving other requests
+    await run_in_threadpool(CONFIG["inputs_path"].mkdir, parents=True, exist_ok=True)
+    f = await run_in_threadpool(open, input_path, "wb")
+    try:
+        async for data in request.stream():
+            received += len(data)
+            if received > max_bytes:
+                break
+            await run_in_threadpool(f.write, data)
+    finally:
+        await run_in_threadpool(f.close)
+    if received > max_bytes:
+        await run_in_threadpool(input_path.unlink, missing_ok=True)
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {CONFIG['job_server']['MAX_UPLOAD_MB']} MB.")
+    if received == 0:
+        await run_in_threadpool(input_path.unlink, missing_ok=True)
+        raise HTTPException(status_code=400, detail="The request body is empty. Send the book as the body.")
+
+    return await run_in_threadpool(job_server.submit, job_id, filename, input_file, {
+        "tts_method": tts_method,
+        "m4b_method": m4b_method,
+        "encoding_profile": encoding_profile,
+        "post_process": post_process,
+    })
+
+
+@app.get("/jobs")
+def list_jobs():
+    """Every job, oldest first."""
+    return job_server.list_jobs()
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """A job's status, the step it is on, and how many of Step 3's chunks are done."""
+    return job_server.get_job(job_id)
+
+
+@app.get("/jobs/{job_id}/download")
+def download_job(job_id: str):
+    """The finished m4b of a job."""
+    job = job_server.get_job(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}, not done.")
+    m4b_path = get_book_paths(job["book_name"])["m4b"]
+    if not m4b_path.exists():
+        raise HTTPException(status_code=410, detail=f"The m4b of job {job_id} no longer exists.")
+    return FileResponse(m4b_path, media_type="audio/mp4", filename=f"{Path(job['filename']).stem}.m4b")
+
+
+if __name__ == "__main__":
+    clear_error_log()
+    parser = argparse.ArgumentParser(
+        description="Serve an HTTP API that queues uploaded books and converts them to m4b audiobooks."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--job-workers", type=int, default=CONFIG["job_server"]["JOB_WORKERS"],
+                        help="Jobs converted at the same time.")
+    parser.add_argument("--llm-provider", choices=list(CONFIG["llm_providers"]), default=CONFIG["llm_provider"],
+                        help="Server that tags dialogue for every job. Local providers need no token.")
+    args = parser.parse_args()
+
+    use_llm_provider(args.llm_provider)
+    missing_api_key = get_missing_llm_api_key()
+    if missing_api_key:
+        print(f"Please set the {missing_api_key} environment variable, or tag with a local server with --llm-provider.")
+        raise SystemExit(1)
+
+    job_server.job_workers = args.job_workers
+    print(f"Serving jobs at http://{args.host}:{args.port} with {args.job_workers} job worker(s)")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
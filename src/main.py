@@ -1,109 +1,122 @@
 import argparse
-import re
-from config import CONFIG
+import hashlib
+from config import CONFIG, use_llm_provider, get_missing_llm_api_key
 from github_openai_client import GitHubOpenAIClient
 from utils import (
     count_tokens,
-    split_into_sentences,
-    extract_character_tags,
+    count_character_tags,
+    iter_paragraphs,
+    map_in_order,
     clean_markdown_code_blocks,
-    split_text_into_chunks,
+    validate_tagged_block,
     remove_suffix
 )
-from to_text import extract_text
+from chunking import iter_blocks, merge_tts_segments
+from to_text import extract_text_to_file
 from datetime import datetime
-from errors import error_log_has_new_errors
+from errors import clear_error_log, error_log_has_new_errors, write_to_error_log
+from fingerprints import get_step_inputs, check_step, record_step, get_tagging_fingerprint
+from tagged_block_cache import TaggedBlockCache
 import json
-from tts import generate_mp3_files
-from to_m4b import combine_mp3s_with_av, combine_mp3s_with_ffmpeg
+from planner import record_throughput
+from segment_index import SegmentIndexWriter, load_segment_index
+from autotune import get_tuned_tts_settings, get_tts_max_characters
+from profiling import StepProfiler
+from audio_index import check_audio_files
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import sys
+import time
 
 
-def split_into_blocks(input_text: str) -> list:
-    """Splits the input text into manageable blocks based on token limits."""
-    paragraphs = re.split(r'\n\s*\n', input_text)
+def tag_block(openai_client, index: int, block: str, max_retries: int, processed_blocks_dir=None) -> tuple:
+    """Tags one block with dialogue tags, re-requesting it while its output fails validation.
 
-    MODEL_MAX_TOKENS = CONFIG["token_limits"]["MODEL_MAX_TOKENS"]
-    MAX_COMPLETION_TOKENS = CONFIG["token_limits"]["MAX_COMPLETION_TOKENS"]
-    TOKEN_BUFFER = CONFIG["token_limits"]["TOKEN_BUFFER"]
-    TTS_MAX_CHARACTERS = CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+    A block fails validation when its tagged output, with tags stripped, no longer matches the
+    source text closely enough (including empty output from a failed request). A block that still
+    fails after max_retries is kept as its untagged source text so no passage goes missing.
 
-    MAX_PROMPT_TOKENS = MODEL_MAX_TOKENS - MAX_COMPLETION_TOKENS - TOKEN_BUFFER
+    Returns a tuple of (tagged_block, is_valid).
+    """
+    MIN_SIMILARITY = CONFIG["tag_validation"]["MIN_SIMILARITY"]
 
-    system_message_token_count = count_tokens(CONFIG["system_message"])
-    user_message_token_count = count_tokens(
-        CONFIG["user_message_prefix"] + CONFIG["user_message_suffix"]
-    )
-
-    blocks = []
-    current_block = ""
-    current_block_token_count = 0
-
-    for paragraph in paragraphs:
-        paragraph_token_count = count_tokens(paragraph)
-
-        if (current_block_token_count + paragraph_token_count + system_message_token_count +
-                user_message_token_count) <= MAX_PROMPT_TOKENS:
-            current_block += ("\n\n" if current_block else "") + paragraph
-            current_block_token_count += paragraph_token_count
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            print(f"Re-requesting block {index} that failed validation (retry {attempt}/{max_retries})...")
         else:
-            if (paragraph_token_count + system_message_token_count +
-                    user_message_token_count) > MAX_PROMPT_TOKENS:
-                sentences = split_into_sentences(paragraph)
-                for sentence in sentences:
-                    sentence_token_count = count_tokens(sentence)
-                    if (current_block_token_count + sentence_token_count +
-                            system_message_token_count + user_message_token_count) <= MAX_PROMPT_TOKENS:
-                        current_block += (" " if current_block else "") + sentence
-                        current_block_token_count += sentence_token_count
-                    else:
-                        if current_block:
-                            blocks.append(current_block)
-                        current_block = sentence
-                        current_block_token_count = sentence_token_count
-            else:
-                if current_block:
-                    blocks.append(current_block)
-                current_block = paragraph
-                current_block_token_count = paragraph_token_count
-
-    if current_block:
-        blocks.append(current_block)
+            print(f"Processing block {index}...")
+        processed_block = openai_client.process_block(block)
+
+        if processed_blocks_dir:
+            write_output_file(processed_block, processed_blocks_dir / f"processed_{index}.txt", True)
+
+        # Clean the processed block by removing any code block wrappers
+        processed_block = clean_markdown_code_blocks(processed_block)
+
+        is_valid, similarity = validate_tagged_block(block, processed_block, MIN_SIMILARITY)
+        if is_valid:
+            return (processed_block, True)
+        print(f"Block {index} failed validation (similarity {similarity:.3f}).")
+
+    error_message = f"Block {index} failed validation after {max_retries} retries. Using untagged source text for this block."
+    print(error_message)
+    write_to_error_log(error_message)
+    return (block, False)
+
+def tag_blocks(openai_client, blocks, max_retries: int, processed_blocks_dir=None, executor=None,
+               tagged_block_cache=None):
+    """Lazily tags blocks with dialogue tags, yielding (tagged_block, is_valid) in order.
+
+    If an executor is passed, block requests are submitted to it so they can share a worker pool
+    with other books. Only a bounded number of blocks are requested ahead of the one being yielded.
+
+    If a TaggedBlockCache is passed, blocks tagged by an earlier run are taken from it instead of
+    being requested again, and newly tagged blocks are added to it.
+    """
+    def tag(item):
+        index, block = item
+        if tagged_block_cache is None:
+            return tag_block(openai_client, index, block, max_retries, processed_blocks_dir)
+        cached_block = tagged_block_cache.get(block)
+        if cached_block is not None:
+            return (cached_block, True)
+        processed_block, is_valid = tag_block(openai_client, index, block, max_retries, processed_blocks_dir)
+        if is_valid:
+            tagged_block_cache.add(block, processed_block)
+        return (processed_block, is_valid)
+
+    return map_in_order(
+        tag,
+        enumerate(blocks, 1),
+        executor,
+        CONFIG["streaming"]["MAX_IN_FLIGHT"],
+    )
 
-    return blocks
+def build_metadata(input_file_name: str) -> dict:
+    """Returns the default audiobook metadata for an input file name."""
+    now = datetime.now()
+    return {
+        "title": input_file_name.replace(".txt", ""),
+        "author": "book-to-audio",
+        "album": input_file_name.replace(".txt", ""),
+        "genre": "Audiobook",
+        "year": now.year,
+    }
 
 def generate_metadata_json(input_file_name: str, metadata_json_path: str):
     """Generates the metadata.json file based on the input file name."""
-    now = datetime.now()
     with open(metadata_json_path, "w", encoding="utf-8") as f:
-        json.dump({
-            "title": input_file_name.replace(".txt", ""),
-            "author": "book-to-audio",
-            "album": input_file_name.replace(".txt", ""),
-            "genre": "Audiobook",
-            "year": now.year,
-        }, f, indent=2)
+        json.dump(build_metadata(input_file_name), f, indent=2)
 
     print(f"Metadata JSON generated and written to {metadata_json_path}")
 
-def generate_characters_json(openai_client, processed_text: str, characters_json_path: str):
-    """Generates the characters.json file based on the processed text,
-    ensuring that characters sharing first or last names use the same voice identifier."""
+def build_characters_map(openai_client, character_frequency_map: dict) -> dict:
+    """Assigns a voice to every character based on their speaking frequency,
+    ensuring that characters sharing first or last names use the same voice identifier.
 
-    # Step 1: Extract all character tags from processed text
-    character_tags = extract_character_tags(processed_text)
-
-    # Step 2: Count speaking frequency for each character
-    character_frequency_map = {}
-    for tag in character_tags:
-        name = tag["name"]
-        gender = tag["gender"]
-        if name in character_frequency_map:
-            character_frequency_map[name]["count"] += 1
-        else:
-            character_frequency_map[name] = {"gender": gender, "count": 1}
+    The frequency map is built incrementally with count_character_tags as tagged blocks are written."""
 
-    # Step 3: Convert the map to a sorted list based on speaking frequency
+    # Step 1: Convert the map to a sorted list based on speaking frequency
     sorted_characters = sorted(
         character_frequency_map.items(),
         key=lambda item: item[1]["count"],
@@ -114,7 +127,7 @@ def generate_characters_json(openai_client, processed_text: str, characters_json
         for name, data in sorted_characters
     ]
 
-    # Step 4: Assign voice identifiers based on gender without name sharing logic
+    # Step 2: Assign voice identifiers based on gender without name sharing logic
     male_voices = CONFIG["voice_identifiers"]["male_voices"]
     female_voices = CONFIG["voice_identifiers"]["female_voices"]
     narrator_voice = CONFIG["voice_identifiers"]["narrator_voice"]
@@ -143,85 +156,20 @@ def generate_characters_json(openai_client, processed_text: str, characters_json
 
         characters_json[name] = assigned_voice
 
-    # Step 5: Process the characters_json with ChatGPT to enforce voice assignment rules
-    processed_characters_json = openai_client.process_characters_json(characters_json)
+    # Step 3: Process the characters_json with ChatGPT to enforce voice assignment rules
+    return openai_client.process_characters_json(characters_json)
 
-    # Step 6: Write the processed characters.json file
+def generate_characters_json(openai_client, character_frequency_map: dict, characters_json_path: str):
+    """Generates the characters.json file with the voice of every character, see build_characters_map."""
+    processed_characters_json = build_characters_map(openai_client, character_frequency_map)
+
+    # Write the processed characters.json file
     with open(characters_json_path, "w", encoding="utf-8") as f:
         json.dump(processed_characters_json, f, indent=2)
 
     print(f"Characters JSON generated and written to {characters_json_path}")
 
 
-def split_text_for_tts(processed_text: str, characters_map: dict) -> list:
-    """Splits the processed text into segments suitable for TTS API requests."""
-    segments = []
-    regex = re.compile(r'<([a-z_]+)-(f|m)>(.*?)<\/\1-\2>', re.DOTALL)
-
-    last_index = 0
-    for match in regex.finditer(processed_text):
-        start, end = match.span()
-        name, gender, dialogue = match.groups()
-
-        # Non-dialogue text before this dialogue
-        if last_index < start:
-            non_dialogue = processed_text[last_index:start]
-            if non_dialogue.strip():
-                segments.append({
-                    "text": non_dialogue.strip(),
-                    "voice": characters_map.get("narrator", CONFIG["voice_identifiers"]["narrator_voice"])
-                })
-
-        # Dialogue text
-        voice = characters_map.get(name, CONFIG["voice_identifiers"]["default_voice"])
-        if dialogue.strip():
-            segments.append({
-                "text": dialogue.strip(),
-                "voice": voice
-            })
-
-        last_index = end
-
-    # Remaining non-dialogue text after the last dialogue
-    if last_index < len(processed_text):
-        non_dialogue = processed_text[last_index:]
-        if non_dialogue.strip():
-            segments.append({
-                "text": non_dialogue.strip(),
-                "voice": characters_map.get("narrator", CONFIG["voice_identifiers"]["narrator_voice"])
-            })
-
-    # Split segments into chunks not exceeding TTS_MAX_CHARACTERS
-    tts_chunks = []
-    current_chunk = ""
-    current_voice = None
-
-    for segment in segments:
-        text = segment["text"]
-        voice = segment["voice"]
-
-        if current_voice and voice != current_voice:
-            if current_chunk.strip():
-                tts_chunks.append({"text": current_chunk.strip(), "voice": current_voice})
-            current_chunk = text
-            current_voice = voice
-        else:
-            current_chunk += " " + text if current_chunk else text
-            current_voice = voice
-
-        # If the current chunk exceeds the max length, split it
-        if len(current_chunk) > CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]:
-            split_chunks = split_text_into_chunks(current_chunk, CONFIG["token_limits"]["TTS_MAX_CHARACTERS"])
-            for split_text in split_chunks:
-                tts_chunks.append({"text": split_text, "voice": current_voice})
-            current_chunk = ""
-            current_voice = None
-
-    if current_chunk.strip():
-        tts_chunks.append({"text": current_chunk.strip(), "voice": current_voice})
-
-    return tts_chunks
-  
 def detect_cover_image(input_file_name):
     # Construct the possible paths for .png and .jpg images
     png_image = CONFIG["inputs_path"] / f"{input_file_name}.png"
@@ -245,22 +193,442 @@ def write_output_file(text: str, output_file_path: str, quiet=False):
         print(f"Processing complete. Output written to {output_file_path}")
 
 
+def get_book_paths(book_name: str) -> dict:
+    """Returns the paths of every file a book's steps read from and write to."""
+    book_output_dir = CONFIG["outputs_path"] / book_name
+    return {
+        "output_dir": book_output_dir,
+        "plaintext": book_output_dir / f"{book_name}_plaintext.txt",
+        "documents_json": book_output_dir / "documents.json",
+        "tagged": book_output_dir / f"{book_name}_tagged.txt",
+        "tagged_blocks": book_output_dir / "tagged_blocks.jsonl",
+        "characters_json": book_output_dir / "characters.json",
+        "metadata_json": book_output_dir / "metadata.json",
+        "processed_blocks_dir": book_output_dir / "processed_blocks",
+        "audio_files_dir": book_output_dir / "audio_files",
+        "segment_index": book_output_dir / "segments.idx",
+        "segment_text": book_output_dir / "segments.bin",
+        "segment_speakers": book_output_dir / "segments.json",
+        "chunks_jsonl": book_output_dir / "chunks.jsonl",
+        "audio_index": book_output_dir / "audio_index.json",
+        "processed_audio_files_dir": book_output_dir / "processed_audio_files",
+        "m4b": book_output_dir / f"{book_name}.m4b",
+    }
+
+def run_step_1(input_file: str, paths: dict, extract_workers=None) -> dict:
+    """Step 1: Process input file into plaintext."""
+    # Stream the input file to {book_name}_plaintext.txt one document at a time
+    documents = extract_text_to_file(
+        CONFIG["inputs_path"] / input_file, paths["plaintext"], paths["documents_json"], extract_workers
+    )
+    print(f"Processing complete. Output written to {paths['plaintext']}")
+    print(f"Extracted {len(documents)} document(s). Document boundaries written to {paths['documents_json']}")
+    return {"characters": sum(document["characters"] for document in documents), "documents": len(documents)}
+
+def tag_blocks_with_batch_api_and_cache(openai_client, blocks, max_retries: int, paths: dict,
+                                        processed_blocks_dir, tagged_block_cache) -> list:
+    """Tags the blocks that are not in the TaggedBlockCache through the batch endpoint, and splices them in order."""
+    from batch_api import tag_blocks_with_batch_api
+
+    blocks = list(blocks)
+    cached_blocks = [tagged_block_cache.get(block) for block in blocks]
+    missing_blocks = [block for block, cached_block in zip(blocks, cached_blocks) if cached_block is None]
+    batch_results = iter(
+        tag_blocks_with_batch_api(openai_client, missing_blocks, max_retries, paths, processed_blocks_dir)
+        if missing_blocks else []
+    )
+    tagged_blocks = []
+    for block, cached_block in zip(blocks, cached_blocks):
+        if cached_block is not None:
+            tagged_blocks.append((cached_block, True))
+            continue
+        processed_block, is_valid = next(batch_results)
+        if is_valid:
+            tagged_block_cache.add(block, processed_block)
+        tagged_blocks.append((processed_block, is_valid))
+    return tagged_blocks
+
+def run_step_2(openai_client, book_name: str, paths: dict, max_block_retries: int,
+               write_processed_blocks=False, executor=None, batch_api=False) -> dict:
+    """Step 2: Tag dialogue in the plaintext and generate characters.json & metadata.json.
+
+    Without a shared executor, as many blocks are tagged at once as the LLM provider's MAX_CONCURRENCY.
+    If batch_api is True, every block is instead submitted at once through the provider's batch endpoint.
+
+    Blocks whose source text was already tagged by an earlier run with the same tagging config are taken
+    from tagged_blocks.jsonl, so after an edit to the plaintext only the blocks around it are tagged again.
+    """
+    # Stream the plaintext file into blocks, counting their tokens to measure tagging throughput
+    block_tokens = 0
+
+    def counted(blocks):
+        nonlocal block_tokens
+        for block in blocks:
+            block_tokens += count_tokens(block)
+            yield block
+
+    blocks = counted(iter_blocks(iter_paragraphs(paths["plaintext"])))
+
+    # Tag each block, re-requesting any that fail validation, and append it to the tagged output
+    # as soon as it is done, counting character tags as we go
+    processed_blocks_dir = paths["processed_blocks_dir"] if write_processed_blocks else None
+    character_frequency_map = {}
+    block_count = 0
+    failed_blocks = 0
+    paths["tagged"].parent.mkdir(parents=True, exist_ok=True)
+    own_executor = None
+    llm_concurrency = CONFIG["rate_limits"]["llm"]["MAX_CONCURRENCY"]
+    tagged_block_cache = TaggedBlockCache(paths["tagged_blocks"], get_tagging_fingerprint())
+    completed = False
+    segment_index_writer = None
+    try:
+        if batch_api:
+            tagged_blocks = tag_blocks_with_batch_api_and_cache(
+                openai_client, blocks, max_block_retries, paths, processed_blocks_dir, tagged_block_cache
+            )
+        else:
+            if executor is None and llm_concurrency > 1:
+                own_executor = executor = ThreadPoolExecutor(llm_concurrency, thread_name_prefix="llm")
+            tagged_blocks = tag_blocks(
+                openai_client, blocks, max_block_retries, processed_blocks_dir, executor, tagged_block_cache
+            )
+        segment_index_writer = SegmentIndexWriter(paths)
+        with open(paths["tagged"], "w", encoding="utf-8") as f:
+            for processed_block, is_valid in tagged_blocks:
+                if block_count > 0:
+                    f.write("\n\n")
+                f.write(processed_block.strip())
+                f.flush()
+                count_character_tags(processed_block, character_frequency_map)
+                # Index the block's segments so Step 3 does not have to parse the tagged text again
+                segment_index_writer.add_block(block_count, processed_block)
+                block_count += 1
+                if not is_valid:
+                    failed_blocks += 1
+        completed = True
+    finally:
+        if segment_index_writer:
+            segment_index_writer.close()
+        tagged_block_cache.close(compact=completed)
+        if own_executor:
+            own_executor.shutdown()
+    print(f"Processed {block_count} blocks. Output written to {paths['tagged']}")
+    if tagged_block_cache.reused:
+        print(f"Reused {tagged_block_cache.reused} of {block_count} blocks tagged by an earlier run")
+        # Only the blocks that were tagged again count towards the tagging throughput
+        block_tokens -= tagged_block_cache.reused_tokens
+
+    # Generate characters.json based on the character tag counts
+    generate_characters_json(openai_client, character_frequency_map, paths["characters_json"])
+
+    # Generate metadata.json
+    generate_metadata_json(book_name, paths["metadata_json"])
+    return {"blocks": block_count, "block_tokens": block_tokens, "failed_blocks": failed_blocks,
+            "reused_blocks": tagged_block_cache.reused}
+
+def get_chunk_manifest_entry(chunk_number: int, chunk: dict) -> dict:
+    """Returns the chunks.jsonl entry of a TTS chunk: its file, voice, length and a hash of its text."""
+    return {
+        "file": f"{chunk_number}.mp3",
+        "voice": chunk["voice"],
+        "characters": len(chunk["text"]),
+        "text_sha256": hashlib.sha256(chunk["text"].encode("utf-8")).hexdigest(),
+    }
+
+def get_shard_chunks_jsonl(paths: dict, shard: tuple):
+    """Returns the path of the chunks.jsonl written by one shard of Step 3, for a (shard_index, shard_count) tuple."""
+    shard_index, shard_count = shard
+    return paths["output_dir"] / f"chunks.shard-{shard_index + 1}-of-{shard_count}.jsonl"
+
+def run_step_3(paths: dict, tts_method: str, executor=None, progressive_book_name=None, shard=None,
+               on_progress=None, encoding_profile="speech") -> dict:
+    """Step 3: Generate TTS audio files from the tagged text.
+
+    If progressive_book_name is passed, the finished chunks are also appended, in order, to a
+    fragmented m4b that can be played while the rest of the book is still being synthesized. It is
+    encoded with encoding_profile.
+
+    If shard is passed as a (shard_index, shard_count) tuple, only that shard's deterministic range
+    of chunks is generated, and its chunks are recorded in its own chunks.shard-<i>-of-<N>.jsonl.
+
+    If on_progress is passed, it is called with (chunks_done, chunks_total) as each chunk finishes.
+
+    Chunks are at most as long as the chunk length tuned for tts_method with --autotune, and without a
+    shared executor, as many chunks are synthesized at once as were tuned for it.
+    """
+    # Imported here so runs that never synthesize, such as --dry-run, do not load torch and the TTS models
+    from tts import generate_mp3_files
+    from progressive import ProgressiveM4bWriter
+
+    # Read characters.json
+    with open(paths["characters_json"], "r", encoding="utf-8") as f:
+        characters_json = json.load(f)
+
+    max_characters = get_tts_max_characters(tts_method)
+    tuned_settings = get_tuned_tts_settings(tts_method)
+    own_executor = None
+    if executor is None and tuned_settings and tuned_settings["TTS_WORKERS"] > 1:
+        own_executor = executor = ThreadPoolExecutor(tuned_settings["TTS_WORKERS"], thread_name_prefix="tts")
+    if tuned_settings:
+        print(f"Using the tuned {tts_method} settings: chunks of up to {max_characters} characters, "
+              f"{tuned_settings['TTS_WORKERS']} request(s) at once")
+
+    # Read the segments from the memory-mapped segment index written by Step 2
+    segment_index = load_segment_index(paths)
+    chunks_jsonl = paths["chunks_jsonl"]
+    first_chunk_number = 1
+    if shard:
+        start_segment, stop_segment, first_chunk_number, stop_chunk_number = segment_index.get_shard(
+            characters_json, *shard, max_characters
+        )
+        print(f"Shard {shard[0] + 1}/{shard[1]}: chunks {first_chunk_number}-{stop_chunk_number - 1} "
+              f"(segments {start_segment}-{stop_segment - 1})")
+        tts_chunks = merge_tts_segments(
+            segment_index.iter_segments(characters_json, start_segment, stop_segment), max_characters
+        )
+        chunks_jsonl = get_shard_chunks_jsonl(paths, shard)
+        chunks_total = stop_chunk_number - first_chunk_number
+
+        # Remove this shard's files from an earlier run, so a chunk that fails now is reported missing
+        for chunk_number in range(first_chunk_number, stop_chunk_number):
+            (paths["audio_files_dir"] / f"{chunk_number}.mp3").unlink(missing_ok=True)
+    else:
+        tts_chunks = merge_tts_segments(segment_index.iter_segments(characters_json), max_characters)
+        # Counting the chunks ahead of time only reads the lengths in the index
+        chunks_total = segment_index.find_chunk_starts(characters_json, max_characters)[-1][1] - 1 \
+            if on_progress else None
+
+    # Lazily split the tagged text into TTS-compatible chunks
+    stats = {"chunks": 0, "tts_characters": 0, "failed_chunks": 0}
+
+    def counted(tts_chunks, manifest):
+        for chunk_number, chunk in enumerate(tts_chunks, first_chunk_number):
+            stats["chunks"] += 1
+            stats["tts_characters"] += len(chunk["text"])
+            # Record which voice each chunk file uses for post-processing
+            manifest.write(json.dumps(get_chunk_manifest_entry(chunk_number, chunk)) + "\n")
+            yield chunk
+
+    progressive_writer = None
+    if progressive_book_name:
+        with open(paths["metadata_json"], "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        progressive_writer = ProgressiveM4bWriter(
+            paths["m4b"], metadata, detect_cover_image(progressive_book_name), encoding_profile=encoding_profile
+        )
+
+    chunks_done = 0
+
+    def on_chunk_done(file_path, generated):
+        nonlocal chunks_done
+        if progressive_writer:
+            if generated:
+                progressive_writer.add_chunk(file_path)
+            else:
+                progressive_writer.add_missing_chunk(file_path)
+        if on_progress:
+            chunks_done += 1
+            on_progress(chunks_done, chunks_total)
+
+    # Generate MP3 files from TTS chunks as they are produced
+    paths["output_dir"].mkdir(parents=True, exist_ok=True)
+    try:
+        with open(chunks_jsonl, "w", encoding="utf-8") as manifest:
+            stats["failed_chunks"] = generate_mp3_files(
+                counted(tts_chunks, manifest), tts_method, paths["audio_files_dir"], executor, on_chunk_done,
+                first_chunk_number,
+            )
+    finally:
+        segment_index.close()
+        if progressive_writer and not progressive_writer.close():
+            stats["failed_encode"] = 1
+        if own_executor:
+            own_executor.shutdown()
+    if not shard:
+        # Remove the chunk files of an earlier run that had more chunks, so Step 4 does not combine them
+        for stale_file in paths["audio_files_dir"].glob("*.mp3"):
+            if stale_file.stem.isdigit() and int(stale_file.stem) > stats["chunks"]:
+                stale_file.unlink()
+    print(f"Total TTS chunks processed: {stats['chunks']}")
+    if progressive_writer:
+        # Step 4 is skipped after a progressive run, so check the chunks and index their durations here
+        # The chunks left out of the m4b include every chunk that failed to generate after the first gap
+        stats["failed_chunks"] = max(stats["failed_chunks"], progressive_writer.failed_chunks)
+        audio_index = check_audio_files(progressive_book_name, paths, paths["audio_files_dir"], ".mp3")
+        if audio_index["bad_chunks"]:
+            stats["bad_chunks"] = len(audio_index["bad_chunks"])
+    return stats
+
+def run_step_4(book_name: str, paths: dict, m4b_method: str, post_process=False, encoding_profile="speech") -> dict:
+    """Step 4: Combine the audio files into an m4b, optionally post-processing them first.
+
+    Every chunk file is first checked from its headers alone, and the m4b is not assembled if any is
+    missing, empty, truncated or corrupt. The durations of the chunks and the start of each chapter are
+    written to audio_index.json.
+    """
+    from to_m4b import combine_mp3s_with_av, combine_mp3s_with_ffmpeg
+    from postprocess import post_process_audio_files
+
+    # Read metadata.json
+    metadata = {}
+    with open(paths["metadata_json"], "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    # Find bad chunk files before spending any time decoding the others
+    audio_index = check_audio_files(book_name, paths, paths["audio_files_dir"], ".mp3")
+    if audio_index["bad_chunks"]:
+      print("Re-synthesize just these chunks with --repair-chunks, then run Step 4 again.")
+      return {"bad_chunks": len(audio_index["bad_chunks"])}
+
+    stats = {}
+    audio_files_dir, extension = paths["audio_files_dir"], ".mp3"
+    if post_process:
+      print("Post-processing audio files...")
+      stats = post_process_audio_files(
+          paths["audio_files_dir"], paths["processed_audio_files_dir"], paths["chunks_jsonl"]
+      )
+      audio_files_dir, extension = paths["processed_audio_files_dir"], ".wav"
+      # Index the processed files instead, so the chapter timestamps match the trimmed and padded audio
+      audio_index = check_audio_files(book_name, paths, audio_files_dir, extension)
+    stats["audio_seconds"] = audio_index["total_seconds"]
+
+    print("Combining audio files into m4b...")
+    # Remove the m4b of an earlier run, so a failed encode cannot leave it looking up to date
+    paths["m4b"].unlink(missing_ok=True)
+    cover_image = detect_cover_image(book_name)
+    if m4b_method == "ffmpeg":
+      stats.update(combine_mp3s_with_ffmpeg(
+          audio_files_dir, paths["m4b"], metadata, cover_image, extension, encoding_profile
+      ))
+    elif m4b_method == "av":
+      stats.update(combine_mp3s_with_av(
+          audio_files_dir, paths["m4b"], metadata, cover_image, extension, encoding_profile
+      ))
+    return stats
+
+STEP_TITLES = {
+    1: "Process input file into plaintext",
+    2: "Determine dialogue tags and generate character.json & metadata.json",
+    3: "Generate TTS audio files from processed text",
+    4: "Combine MP3 files into an m4b",
+}
+
+def get_step_runners(openai_client, input_file: str, book_name: str, paths: dict, args,
+                     llm_pool=None, tts_pool=None, on_chunk_progress=None) -> dict:
+    """
+    Returns a function for each step that runs it for one book with the parsed command line arguments.
+    If on_chunk_progress is passed, Step 3 calls it with (chunks_done, chunks_total) as each chunk finishes.
+    """
+    return {
+        1: lambda: run_step_1(input_file, paths, args.extract_workers),
+        2: lambda: run_step_2(openai_client, book_name, paths, args.max_block_retries,
+                              args.write_processed_blocks, llm_pool, args.batch_api),
+        3: lambda: run_step_3(paths, args.tts_method.lower(), tts_pool, book_name if args.progressive else None,
+                              args.shard_index, on_chunk_progress, args.encoding_profile),
+        4: lambda: run_step_4(book_name, paths, args.m4b_method, args.post_process, args.encoding_profile),
+    }
+
+def plan_steps(steps: list, input_file: str, book_name: str, paths: dict, args, log_prefix=""):
+    """
+    Lazily yields (step, input_fingerprints) for every step that should run, printing why.
+
+    Steps passed with -s always run. Otherwise a step runs only if its outputs are missing or
+    the fingerprints of its inputs changed since it last ran (or --force is passed), and the
+    steps that are skipped are reported. Each step is checked only after the steps before it
+    have run, so a step that rewrites its outputs with identical content does not invalidate
+    the steps after it.
+    """
+    for step in STEP_TITLES:
+        if len(steps) > 0 and step not in steps:
+            continue
+
+        inputs = get_step_inputs(
+            step, input_file, paths, args.tts_method.lower(), args.m4b_method, detect_cover_image(book_name),
+            args.post_process, args.encoding_profile,
+        )
+        if len(steps) > 0:
+            reason = "requested with -s"
+        elif step == 4 and args.progressive:
+            print(f"{log_prefix}Skipping Step {step}: {STEP_TITLES[step]} (the m4b was written progressively in Step 3)")
+            continue
+        elif args.force:
+            reason = "forced with --force"
+        else:
+            should_run, reason = check_step(step, paths, inputs)
+            if not should_run:
+                print(f"{log_prefix}Skipping Step {step}: {STEP_TITLES[step]} ({reason})")
+                continue
+
+        print(f"{log_prefix}Starting Step {step}: {STEP_TITLES[step]} ({reason})")
+        yield step, inputs
+
+
+def run_dry_run(input_files: list, args):
+    """
+    Prints the estimated work, time and cost of Steps 2 and 3 for each book, without calling the LLM or TTS backends.
+
+    Runs Step 1 first for any book whose plaintext is missing or out of date, since the estimate is made from it.
+    Each plan is also written to outputs/<book_name>/plan.json.
+    """
+    from planner import plan_book, print_plan
+    tts_method = args.tts_method.lower()
+    for input_file in input_files:
+        book_name = remove_suffix(input_file)
+        paths = get_book_paths(book_name)
+
+        inputs = get_step_inputs(1, input_file, paths, tts_method, args.m4b_method)
+        should_run, reason = check_step(1, paths, inputs)
+        if should_run:
+            print(f"Starting Step 1: {STEP_TITLES[1]} ({reason})")
+            record_step(paths, 1, inputs, run_step_1(input_file, paths, args.extract_workers))
+
+        plan = plan_book(paths, tts_method)
+        print_plan(book_name, tts_method, plan)
+        with open(paths["output_dir"] / "plan.json", "w", encoding="utf-8") as f:
+            json.dump({"tts_method": tts_method, **plan}, f, indent=2)
+
+
 def main():
+    clear_error_log()
     parser = argparse.ArgumentParser(description="Process text and generate audio.")
     parser.add_argument(
-        "-i", "--input-file", required=True, help="Path to the input file"
+        "-i", "--input-file", help="Path to the input file. Required unless --batch is passed."
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help='Process every supported book in inputs/ (or every file passed to --batch-inputs) with shared LLM and TTS worker pools.',
+    )
+    parser.add_argument(
+        "--batch-inputs",
+        nargs="+",
+        help='Names of the books in inputs/ to process in batch mode. Defaults to every supported book in inputs/.',
     )
     parser.add_argument(
         "-t",
         "--tts-method",
-        choices=["local", "openai", "elevenlabs"],
+        choices=["local", "onnx", "openai", "elevenlabs"],
         default="local",
         help='Text-to-Speech method. Every method other than local requires an API in .env and is not free to use.',
     )
+    parser.add_argument(
+        "-l",
+        "--llm-provider",
+        choices=list(CONFIG["llm_providers"]),
+        default=CONFIG["llm_provider"],
+        help='Server that tags dialogue in Step 2. Local providers need no token. Defaults to LLM_PROVIDER or "github".',
+    )
     parser.add_argument(
         "-s",
         "--steps",
-        help='Steps of script to run (comma-separated) If not passed will run every step.',
+        help='Steps of script to run (comma-separated) If not passed will run every step whose inputs changed since it last ran.',
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help='When --steps is not passed, run every step even if its outputs are up to date.',
     )
     parser.add_argument(
         "-p",
@@ -274,8 +642,76 @@ def main():
         default="ffmpeg",
         help='Sometimes the ffmpeg method fails to combine the audio files. In that case, you can try the av method.',
     )
+    parser.add_argument(
+        "--encoding-profile",
+        choices=list(CONFIG["encoding_profiles"]),
+        default="speech",
+        help='How the m4b is encoded in Step 4, or in Step 3 with --progressive. Profiles are defined in CONFIG["encoding_profiles"].',
+    )
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help='Append audio to a fragmented m4b as Step 3 finishes each chunk, so the book can be played before it is done.',
+    )
+    parser.add_argument(
+        "--post-process",
+        action="store_true",
+        help='Before Step 4, trim silence, normalize loudness per voice and add pauses between the audio files.',
+    )
+    parser.add_argument(
+        "-w",
+        "--extract-workers",
+        type=int,
+        help='Number of processes used to parse EPUB/MOBI documents in Step 1. Parses in-process if not passed.',
+    )
+    parser.add_argument(
+        "-r",
+        "--max-block-retries",
+        type=int,
+        default=CONFIG["tag_validation"]["MAX_RETRIES"],
+        help='How many times a tagged block that fails validation against its source text is re-requested.',
+    )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help='Tag every block of Step 2 in one request to the LLM provider\'s batch endpoint, resubmitting only the blocks that failed.',
+    )
+    parser.add_argument(
+        "--shard",
+        help='Run only Step 3, for shard i of N (as "i/N"), so N machines or processes can share the chunks of a book.',
+    )
+    parser.add_argument(
+        "--merge-shards",
+        type=int,
+        metavar="N",
+        help='Verify that N shards of Step 3 generated every chunk and merge their chunks.jsonl files, then exit.',
+    )
+    parser.add_argument(
+        "--repair-chunks",
+        action="store_true",
+        help='Check the chunk files of the -i book from their headers and re-synthesize only the missing, empty, truncated or corrupt ones.',
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help='Profile each step that runs, writing cProfile dumps, collapsed stacks for flamegraphs and peak memory to outputs/<book_name>/profiles/.',
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help='Estimate the requests, tokens, characters, time and cost of Steps 2 and 3 without calling any backend.',
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help='Measure the best TTS chunk length and concurrency of the --tts-method backend, store them for Step 3, then exit.',
+    )
     args = parser.parse_args()
 
+    if not args.input_file and not args.batch and not args.autotune:
+        print("Please pass an input file with -i, or use --batch to process every book in inputs/.")
+        sys.exit(1)
+
     # Validate that steps is a comma-separated list of integers
     steps = []
     if args.steps:
@@ -284,115 +720,136 @@ def main():
         except ValueError:
             print("Invalid steps argument. Please provide a comma-separated list of integers.")
             sys.exit(1)
+
+    # Validate shard as "i/N" with 1 <= i <= N
+    args.shard_index = None
+    if args.shard:
+        try:
+            shard_number, shard_count = (int(part) for part in args.shard.split("/"))
+        except ValueError:
+            print('Invalid shard argument. Please provide it as "i/N", for example "2/4".')
+            sys.exit(1)
+        if not 1 <= shard_number <= shard_count:
+            print(f'Invalid shard "{args.shard}". The shard number must be between 1 and {shard_count}.')
+            sys.exit(1)
+        if args.batch or args.progressive or any(step != 3 for step in steps):
+            print("--shard only runs Step 3 of a single book, and cannot be combined with --batch or --progressive.")
+            sys.exit(1)
+        args.shard_index = (shard_number - 1, shard_count)
+        steps = [3]
+
+    if args.profile and args.batch:
+        print("--profile profiles the steps of a single book, and cannot be combined with --batch.")
+        sys.exit(1)
+
     if len(steps) > 0:
         print(f"Running steps: {steps}")
 
+    use_llm_provider(args.llm_provider)
+
     # Validate TTS method
     tts_method = args.tts_method.lower()
-    if tts_method not in ["local", "openai", "elevenlabs"]:
-        print(f'Invalid TTS method "{args.tts_method}". Allowed values are "local", "openai", or "elevenlabs".')
+    if tts_method not in ["local", "onnx", "openai", "elevenlabs"]:
+        print(f'Invalid TTS method "{args.tts_method}". Allowed values are "local", "onnx", "openai", or "elevenlabs".')
         sys.exit(1)
 
     # Validate input file directory
     CONFIG["inputs_path"].mkdir(parents=True, exist_ok=True)
     CONFIG["outputs_path"].parent.mkdir(parents=True, exist_ok=True)
 
-    # If input file has any suffix, remove it
-    book_name = remove_suffix(args.input_file)
+    if args.merge_shards:
+        if not args.input_file:
+            print("Please pass the input file whose shards to merge with -i.")
+            sys.exit(1)
+        from shards import merge_shards
+        book_name = remove_suffix(args.input_file)
+        if not merge_shards(args.input_file, book_name, get_book_paths(book_name), args.merge_shards, args):
+            sys.exit(1)
+        return
 
-    # Validate API Key
-    if not CONFIG["api_key"]:
-        print("Please set the GITHUB_TOKEN environment variable.")
+    if args.repair_chunks:
+        if not args.input_file:
+            print("Please pass the input file whose chunks to repair with -i.")
+            sys.exit(1)
+        from audio_index import repair_chunks
+        book_name = remove_suffix(args.input_file)
+        if not repair_chunks(book_name, get_book_paths(book_name), tts_method):
+            sys.exit(1)
+        return
+
+    if args.autotune:
+        from autotune import run_autotune
+        source_text = None
+        if args.input_file:
+            # Calibrate with the book's own text if Step 1 has already extracted it
+            plaintext_path = get_book_paths(remove_suffix(args.input_file))["plaintext"]
+            if plaintext_path.exists():
+                with open(plaintext_path, "r", encoding="utf-8") as f:
+                    source_text = " ".join(f.read(200000).split())
+        if not run_autotune(tts_method, source_text):
+            sys.exit(1)
+        return
+
+    if args.dry_run:
+        if args.batch:
+            from batch import find_batch_inputs
+            input_files = args.batch_inputs or find_batch_inputs()
+        else:
+            input_files = [args.input_file]
+        run_dry_run(input_files, args)
+        return
+
+    # Validate API Key, which local LLM providers do not need
+    missing_api_key = get_missing_llm_api_key()
+    if missing_api_key:
+        print(f"Please set the {missing_api_key} environment variable, or tag with a local server with --llm-provider.")
         sys.exit(1)
 
     # Initialize OpenAI Client
     openai_client = GitHubOpenAIClient()
 
-    # - - - Start Step 1: Process input file into plaintext - - -
-    plaintext_output_file_path = CONFIG["outputs_path"] / book_name / f"{book_name}_plaintext.txt"
-    if len(steps) == 0 or 1 in steps:
-      print("Starting Step 1: Process input file into plaintext")
-      input_plaintext = extract_text(CONFIG["inputs_path"] / args.input_file)
-
-      # Write the processed output to {book_name}_plaintext.txt 
-      write_output_file(input_plaintext, plaintext_output_file_path)
-      
-    # - - - Start Step 2: Process input file into output file with dialogue tags - - -
-    tagged_output_file_path = CONFIG["outputs_path"] / book_name / f"{book_name}_tagged.txt"
-    characters_json_path = CONFIG["outputs_path"] / book_name / "characters.json"
-    metadata_json_path = CONFIG["outputs_path"] / book_name / "metadata.json"
-    if len(steps) == 0 or 2 in steps:
-      print("Starting Step 2: Determine dialogue tags and generate character.json & metadata.json")
-      # Read plaintext file
-      with open(plaintext_output_file_path, "r", encoding="utf-8") as f:
-          input_text = f.read()
-
-      # Split input text into blocks
-      blocks = split_into_blocks(input_text)
-      print(f"Total input text blocks to process: {len(blocks)}")
-
-      # Process each block and accumulate the final output
-      final_output = ""
-      for index, block in enumerate(blocks, 1):
-          print(f"Processing block {index}/{len(blocks)}...")
-          processed_block = openai_client.process_block(block)
-
-          if args.write_processed_blocks:
-            write_output_file(processed_block, CONFIG["outputs_path"] / book_name / "processed_blocks" / f"processed_{index}.txt", True)
-
-          # Clean the processed block by removing any code block wrappers
-          processed_block = clean_markdown_code_blocks(processed_block)
-
-          final_output += processed_block + "\n\n"
-
-      # Write the processed output to output.txt
-      write_output_file(final_output, tagged_output_file_path)
-      print(f"Processed output written to {tagged_output_file_path}")
-
-      # Generate characters.json based on the processed output
-      generate_characters_json(openai_client, final_output, characters_json_path)
-
-      # Generate metadata.json 
-      generate_metadata_json(book_name, metadata_json_path)
-
-    # - - - Start Step 3: Generate TTS audio files from processed text - - -
-    audio_files_output_dir = CONFIG["outputs_path"] / book_name / "audio_files"
-    if len(steps) == 0 or 3 in steps:
-      print("Starting Step 2: Generate TTS audio files from processed text")
-      # Read characters.json
-      with open(characters_json_path, "r", encoding="utf-8") as f:
-          characters_json = json.load(f)
-
-      # Read output.txt
-      with open(tagged_output_file_path, "r", encoding="utf-8") as f:
-          processed_text = f.read()
-
-      # Split text into TTS-compatible chunks
-      tts_chunks = split_text_for_tts(processed_text, characters_json)
-      print(f"Total TTS chunks to process: {len(tts_chunks)}")
-
-      # Generate MP3 files from TTS chunks
-      generate_mp3_files(tts_chunks, tts_method, audio_files_output_dir)
-
-    # - - - Start Step 4: Combine MP3 files into an m4b - - -
-    m4b_output_file = CONFIG["outputs_path"] / book_name / f"{book_name}.m4b"
-    if len(steps) == 0 or 4 in steps:
-      print("Starting Step 3: Combine MP3 files into an m4b")
-      # Read metadata.json
-      metadata = {}
-      with open(metadata_json_path, "r", encoding="utf-8") as f:
-          metadata = json.load(f)
-
-      print("Combining audio files into m4b...")
-      cover_image = detect_cover_image(book_name)
-      if args.m4b_method == "ffmpeg":
-        combine_mp3s_with_ffmpeg(audio_files_output_dir, m4b_output_file, metadata, cover_image)
-      elif args.m4b_method == "av":
-        combine_mp3s_with_av(audio_files_output_dir, m4b_output_file, metadata, cover_image)
-    
+    if args.batch:
+        from batch import find_batch_inputs, run_batch
+        input_files = args.batch_inputs or find_batch_inputs()
+        if not input_files:
+            print(f"No supported books found in {CONFIG['inputs_path']}.")
+            sys.exit(1)
+        run_batch(openai_client, input_files, steps, args)
+        if error_log_has_new_errors():
+            print("\nThere were errors during the run. Please check error.log for more details.")
+        return
+
+    # If input file has any suffix, remove it
+    book_name = remove_suffix(args.input_file)
+    paths = get_book_paths(book_name)
+
+    step_runners = get_step_runners(openai_client, args.input_file, book_name, paths, args)
+
+    # Load and check the TTS models while Steps 1 and 2 run, so Step 3 can start synthesizing at once
+    tts_warm_up = None
+    if not steps or 3 in steps:
+        from tts import TTSWarmUp
+        tts_warm_up = TTSWarmUp(tts_method)
+    for step, inputs in plan_steps(steps, args.input_file, book_name, paths, args):
+        if tts_warm_up and not (step == 1 and args.extract_workers and args.extract_workers > 1):
+            # Step 1's extraction processes are forked, which is not safe while models are loading on a thread
+            tts_warm_up.start()
+        if step == 3 and tts_warm_up:
+            tts_warm_up.wait()
+        start = time.perf_counter()
+        with StepProfiler(paths["output_dir"] / "profiles", step, STEP_TITLES[step]) if args.profile else nullcontext():
+            stats = step_runners[step]()
+        record_throughput(step, tts_method, stats, time.perf_counter() - start)
+        if args.shard_index:
+            # A shard only generates part of Step 3, which is recorded once the shards are merged
+            print(f"Shard {args.shard}: {stats['chunks']} chunks generated, {stats['failed_chunks']} failed. "
+                  f"Run with --merge-shards {args.shard_index[1]} once every shard is done.")
+        else:
+            record_step(paths, step, inputs, stats)
+
     if error_log_has_new_errors():
         print("\nThere were errors during the run. Please check error.log for more details.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,224 @@
+# pipeline.py
+
+import json
+import tempfile
+from pathlib import Path
+from config import CONFIG
+from utils import count_character_tags, iter_block_units
+from to_text import iter_documents, split_document_paragraphs
+from tts import generate_mp3_files
+from to_m4b import combine_mp3s_with_av, combine_mp3s_with_ffmpeg
+from autotune import get_tts_max_characters
+from fingerprints import get_step_inputs, record_step
+from segment_index import build_segment_index
+from chunking import iter_blocks, iter_tts_segments, merge_tts_segments
+from main import (
+    tag_blocks,
+    build_characters_map,
+    build_metadata,
+    get_chunk_manifest_entry,
+    get_book_paths,
+    detect_cover_image,
+)
+
+
+class Pipeline:
+    """
+    Runs the steps of the conversion on in-memory objects, for embedding in a long-lived worker.
+
+    Each step is a method that takes the output of the one before it, so text, tags, voices and chunks are
+    handed over directly instead of through the files the command line writes between steps. Loaded TTS
+    models and rate governors are module-level, so they stay warm across every book a Pipeline converts.
+
+    Example:
+        pipeline = Pipeline(tts_method="local")
+        result = pipeline.run("inputs/my_book.epub", "my_book.m4b")
+
+    Parameters:
+    - openai_client (GitHubOpenAIClient, optional): Client used for tagging. Created on first use if not passed.
+    - tts_method (str): "local", "onnx", "openai" or "elevenlabs".
+    - m4b_method (str): "ffmpeg" or "av".
+    - encoding_profile (str): Name of the profile in CONFIG["encoding_profiles"] used to encode the m4b.
+    - max_block_retries (int): How many times a block that fails validation is re-requested.
+    - llm_executor, tts_executor (Executor, optional): Pools that tagging and synthesis are submitted to.
+    - extract_workers (int, optional): Number of processes used to parse EPUB/MOBI documents.
+    """
+
+    def __init__(self, openai_client=None, tts_method="local", m4b_method="ffmpeg", encoding_profile="speech",
+                 max_block_retries=None, llm_executor=None, tts_executor=None, extract_workers=None):
+        self.openai_client = openai_client
+        self.tts_method = tts_method
+        self.m4b_method = m4b_method
+        self.encoding_profile = encoding_profile
+        self.max_block_retries = CONFIG["tag_validation"]["MAX_RETRIES"] if max_block_retries is None else max_block_retries
+        self.llm_executor = llm_executor
+        self.tts_executor = tts_executor
+        self.extract_workers = extract_workers
+
+    def get_openai_client(self):
+        if self.openai_client is None:
+            from github_openai_client import GitHubOpenAIClient
+            self.openai_client = GitHubOpenAIClient()
+        return self.openai_client
+
+    def extract(self, input_file) -> list:
+        """Step 1: Extracts the documents of a book, each as {"name", "paragraphs"}."""
+        documents = []
+        for document in iter_documents(str(input_file), self.extract_workers):
+            paragraphs = split_document_paragraphs(document["text"])
+            if paragraphs:
+                documents.append({"name": document["name"], "paragraphs": paragraphs})
+        if not documents:
+            raise ValueError(f"No text extracted from {input_file}.")
+        return documents
+
+    def tag(self, paragraphs) -> dict:
+        """
+        Step 2: Tags the dialogue in paragraphs and counts how often each character speaks.
+
+        Returns:
+        - dict: {"blocks": list of tagged blocks, "failed_blocks": int, "character_frequency_map": dict}
+        """
+        blocks = []
+        failed_blocks = 0
+        character_frequency_map = {}
+        for tagged_block, is_valid in tag_blocks(
+            self.get_openai_client(), iter_blocks(paragraphs), self.max_block_retries, None, self.llm_executor
+        ):
+            blocks.append(tagged_block.strip())
+            count_character_tags(tagged_block, character_frequency_map)
+            if not is_valid:
+                failed_blocks += 1
+        return {"blocks": blocks, "failed_blocks": failed_blocks, "character_frequency_map": character_frequency_map}
+
+    def assign_voices(self, character_frequency_map: dict) -> dict:
+        """Step 2: Assigns a voice to the narrator and every character, like characters.json."""
+        return build_characters_map(self.get_openai_client(), character_frequency_map)
+
+    def plan_chunks(self, tagged_blocks, characters_map: dict) -> list:
+        """Step 3: Splits tagged blocks into the TTS chunks Step 3 would synthesize, each as {"text", "voice"}."""
+        return list(merge_tts_segments((
+            segment
+            for block in tagged_blocks
+            for unit in iter_block_units(block)
+            for segment in iter_tts_segments(unit, characters_map)
+        ), get_tts_max_characters(self.tts_method)))
+
+    def synthesize(self, chunks, audio_files_dir) -> int:
+        """Step 3: Synthesizes chunks into numbered audio files in audio_files_dir. Returns the number that failed."""
+        return generate_mp3_files(chunks, self.tts_method, str(audio_files_dir), self.tts_executor)
+
+    def assemble(self, audio_files_dir, output_filename, metadata: dict, cover_image=None) -> dict:
+        """Step 4: Combines the audio files into an m4b. Returns its encoding stats, or {"failed_encode": 1} on failure."""
+        combine = combine_mp3s_with_ffmpeg if self.m4b_method == "ffmpeg" else combine_mp3s_with_av
+        return combine(audio_files_dir, output_filename, metadata, cover_image, ".mp3", self.encoding_profile)
+
+    def run(self, input_file, output_filename, book_name=None, characters_map=None, metadata=None,
+            cover_image=None, persist=False) -> dict:
+        """
+        Converts a book into an m4b in one call.
+
+        Parameters:
+        - input_file (str | Path): Path to the book.
+        - output_filename (str | Path): Path of the m4b to write.
+        - book_name (str, optional): Name of the book. Defaults to the input file name without its suffix.
+        - characters_map (dict, optional): Voices to use instead of assigning them from the tagged text.
+        - metadata (dict, optional): Audiobook metadata. Defaults to the metadata Step 2 generates.
+        - cover_image (Path, optional): Cover image. Defaults to the cover in the inputs directory, if any.
+        - persist (bool): Also write the files the command line writes to outputs/<book_name>/, so the
+          steps can be inspected, edited or resumed with main.py. Otherwise audio is kept in a temporary
+          directory that is removed once the m4b is written.
+
+        Returns:
+        - dict: The characters map, metadata, chunk count and the stats of every step.
+
+        Raises:
+        - RuntimeError: If the m4b could not be encoded.
+        """
+        input_file = Path(input_file)
+        book_name = book_name or input_file.stem
+        paths = get_book_paths(book_name) if persist else None
+
+        documents = self.extract(input_file)
+        paragraphs = [paragraph for document in documents for paragraph in document["paragraphs"]]
+
+        tagged = self.tag(paragraphs)
+        if characters_map is None:
+            characters_map = self.assign_voices(tagged["character_frequency_map"])
+        if metadata is None:
+            metadata = build_metadata(book_name)
+        if cover_image is None:
+            cover_image = detect_cover_image(book_name)
+
+        chunks = self.plan_chunks(tagged["blocks"], characters_map)
+
+        if persist:
+            self.write_outputs(paths, documents, tagged["blocks"], characters_map, metadata, chunks)
+            self.record_steps(paths, input_file, cover_image, [1], {})
+            self.record_steps(paths, input_file, cover_image, [2], {"failed_blocks": tagged["failed_blocks"]})
+            # Remove the chunk files of an earlier run, which assemble would otherwise combine too
+            if paths["audio_files_dir"].exists():
+                for stale_file in paths["audio_files_dir"].glob("*.mp3"):
+                    stale_file.unlink()
+            failed_chunks = self.synthesize(chunks, paths["audio_files_dir"])
+            self.record_steps(paths, input_file, cover_image, [3], {"failed_chunks": failed_chunks})
+            encoding_stats = self.assemble(paths["audio_files_dir"], output_filename, metadata, cover_image)
+            if Path(output_filename).resolve() == paths["m4b"].resolve():
+                self.record_steps(paths, input_file, cover_image, [4], encoding_stats)
+        else:
+            with tempfile.TemporaryDirectory() as audio_files_dir:
+                failed_chunks = self.synthesize(chunks, audio_files_dir)
+                encoding_stats = self.assemble(audio_files_dir, output_filename, metadata, cover_image)
+        if encoding_stats.get("failed_encode"):
+            raise RuntimeError(f"Could not encode {output_filename}. See error.log for details.")
+
+        return {
+            "characters_map": characters_map,
+            "metadata": metadata,
+            "documents": len(documents),
+            "blocks": len(tagged["blocks"]),
+            "failed_blocks": tagged["failed_blocks"],
+            "chunks": len(chunks),
+            "tts_characters": sum(len(chunk["text"]) for chunk in chunks),
+            "failed_chunks": failed_chunks,
+            **encoding_stats,
+        }
+
+    def record_steps(self, paths: dict, input_file: Path, cover_image, steps: list, stats: dict):
+        """Records the fingerprints of persisted steps, so main.py skips them while their inputs are unchanged."""
+        for step in steps:
+            inputs = get_step_inputs(
+                step, input_file.resolve(), paths, self.tts_method, self.m4b_method, cover_image, False,
+                self.encoding_profile,
+            )
+            record_step(paths, step, inputs, stats)
+
+    def write_outputs(self, paths: dict, documents: list, tagged_blocks: list, characters_map: dict, metadata: dict,
+                      chunks: list):
+        """Writes the intermediate files of Steps 1 to 3, and the segment index, in the same layout as the command line."""
+        paths["output_dir"].mkdir(parents=True, exist_ok=True)
+        with open(paths["plaintext"], "w", encoding="utf-8") as f:
+            f.write("\n\n".join("\n\n".join(document["paragraphs"]) for document in documents))
+        document_boundaries = []
+        paragraph_offset = 0
+        for document in documents:
+            document_boundaries.append({
+                "name": document["name"],
+                "start_paragraph": paragraph_offset,
+                "paragraphs": len(document["paragraphs"]),
+                "characters": len("\n\n".join(document["paragraphs"])),
+            })
+            paragraph_offset += len(document["paragraphs"])
+        with open(paths["documents_json"], "w", encoding="utf-8") as f:
+            json.dump(document_boundaries, f, indent=2)
+        with open(paths["tagged"], "w", encoding="utf-8") as f:
+            f.write("\n\n".join(tagged_blocks))
+        with open(paths["characters_json"], "w", encoding="utf-8") as f:
+            json.dump(characters_map, f, indent=2)
+        with open(paths["metadata_json"], "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
+        with open(paths["chunks_jsonl"], "w", encoding="utf-8") as f:
+            for chunk_number, chunk in enumerate(chunks, 1):
+                f.write(json.dumps(get_chunk_manifest_entry(chunk_number, chunk)) + "\n")
+        # Index the segments of the tagged text so Step 3 of main.py can read it without parsing it again
+        build_segment_index(paths)
@@ -0,0 +1,164 @@
+# planner.py
+
+import re
+import json
+import math
+from config import CONFIG
+from utils import count_tokens, iter_paragraphs, iter_tagged_units
+from chunking import iter_blocks, iter_tts_chunks
+from autotune import get_tts_max_characters
+from fingerprints import get_tagging_fingerprint
+from tagged_block_cache import TaggedBlockCache
+
+# Straight or curly double-quoted passages, used to guess dialogue before Step 2 has tagged it
+QUOTED_DIALOGUE = re.compile(r'(“[^”]*”|"[^"]*")')
+UNTAGGED_SPEAKER = "untagged_speaker"
+
+
+def throughput_path():
+    return CONFIG["outputs_path"] / "throughput.json"
+
+
+def load_throughput() -> dict:
+    """Reads the throughput measured in previous runs from outputs/throughput.json."""
+    if not throughput_path().exists():
+        return {"llm": {}, "tts": {}}
+    with open(throughput_path(), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def record_throughput(step: int, tts_method: str, stats: dict, seconds: float):
+    """Adds the work done by a finished step, and how long it took, to outputs/throughput.json."""
+    if step == 2 and stats.get("block_tokens"):
+        section, backend, amount_key, amount = "llm", CONFIG["model"], "tokens", stats["block_tokens"]
+    elif step == 3 and stats.get("tts_characters"):
+        section, backend, amount_key, amount = "tts", tts_method, "characters", stats["tts_characters"]
+    else:
+        return
+
+    throughput = load_throughput()
+    totals = throughput[section].setdefault(backend, {amount_key: 0, "seconds": 0.0})
+    totals[amount_key] += amount
+    totals["seconds"] += seconds
+    CONFIG["outputs_path"].mkdir(parents=True, exist_ok=True)
+    with open(throughput_path(), "w", encoding="utf-8") as f:
+        json.dump(throughput, f, indent=2)
+
+
+def get_rate(section: str, backend: str, amount_key: str) -> tuple:
+    """Returns (amount per second, source) from previous runs, or from the configured defaults."""
+    totals = load_throughput()[section].get(backend)
+    if totals and totals["seconds"] > 0:
+        return (totals[amount_key] / totals["seconds"], "previous runs")
+    return (CONFIG["planner"]["DEFAULT_THROUGHPUT"][section].get(backend, 1.0), "default estimate")
+
+
+def iter_estimated_tagged_units(plaintext_path):
+    """Yields plaintext paragraphs with quoted passages wrapped in placeholder tags, as a stand-in for Step 2."""
+    for paragraph in iter_paragraphs(plaintext_path):
+        yield QUOTED_DIALOGUE.sub(rf'<{UNTAGGED_SPEAKER}-f>\1</{UNTAGGED_SPEAKER}-f>', paragraph)
+
+
+def plan_book(paths: dict, tts_method: str) -> dict:
+    """
+    Estimates the work, time and cost of Steps 2 and 3 for a book without calling any backend.
+
+    Runs the same block and chunk planners as Steps 2 and 3. Blocks already in the book's tagged block
+    cache are left out of the Step 2 requests, since Step 2 reuses them. If the book has not been tagged
+    yet, the chunks are planned from the plaintext with quoted passages treated as dialogue of an unknown
+    speaker.
+    """
+    token_limits = CONFIG["token_limits"]
+    prompt_overhead = count_tokens(
+        f"{CONFIG['system_message']}\n\n{CONFIG['user_message_prefix']}{CONFIG['user_message_suffix']}"
+    )
+
+    # Step 2: the blocks sent to the LLM
+    tagged_block_cache = TaggedBlockCache(paths["tagged_blocks"], get_tagging_fingerprint(), read_only=True)
+    block_count = 0
+    cached_blocks = 0
+    block_tokens = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    for block in iter_blocks(iter_paragraphs(paths["plaintext"])):
+        block_count += 1
+        if tagged_block_cache.get(block) is not None:
+            cached_blocks += 1
+            continue
+        tokens = count_tokens(block)
+        block_tokens += tokens
+        prompt_tokens += prompt_overhead + tokens
+        # The tagged block is the source text plus the tags
+        completion_tokens += min(
+            token_limits["MAX_COMPLETION_TOKENS"], math.ceil(tokens * (1 + CONFIG["planner"]["TAG_TOKEN_OVERHEAD"]))
+        )
+
+    # Step 3: the chunks sent to the TTS backend
+    if paths["tagged"].exists() and paths["characters_json"].exists():
+        with open(paths["characters_json"], "r", encoding="utf-8") as f:
+            characters_map = json.load(f)
+        tts_chunks = iter_tts_chunks(iter_tagged_units(paths["tagged"]), characters_map, get_tts_max_characters(tts_method))
+        chunk_source = "tagged text"
+    else:
+        tts_chunks = iter_tts_chunks(iter_estimated_tagged_units(paths["plaintext"]), {}, get_tts_max_characters(tts_method))
+        chunk_source = "plaintext with quoted dialogue, speakers not yet tagged"
+
+    chunk_count = 0
+    characters_per_voice = {}
+    for chunk in tts_chunks:
+        chunk_count += 1
+        characters_per_voice[chunk["voice"]] = characters_per_voice.get(chunk["voice"], 0) + len(chunk["text"])
+    tts_characters = sum(characters_per_voice.values())
+
+    # Time and cost
+    llm_rate, llm_rate_source = get_rate("llm", CONFIG["model"], "tokens")
+    tts_rate, tts_rate_source = get_rate("tts", tts_method, "characters")
+    pricing = CONFIG["planner"]["PRICING"]
+    llm_pricing = pricing["llm"].get(CONFIG["model"], {"PROMPT_PER_1M_TOKENS": 0, "COMPLETION_PER_1M_TOKENS": 0})
+
+    return {
+        "blocks": block_count,
+        "cached_blocks": cached_blocks,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tts_requests": chunk_count,
+        "tts_characters": tts_characters,
+        "characters_per_voice": dict(sorted(characters_per_voice.items(), key=lambda item: -item[1])),
+        "chunk_source": chunk_source,
+        "step_2_seconds": round(block_tokens / llm_rate, 1),
+        "step_2_rate_source": llm_rate_source,
+        "step_3_seconds": round(tts_characters / tts_rate, 1),
+        "step_3_rate_source": tts_rate_source,
+        "step_2_cost": round(
+            prompt_tokens / 1e6 * llm_pricing["PROMPT_PER_1M_TOKENS"]
+            + completion_tokens / 1e6 * llm_pricing["COMPLETION_PER_1M_TOKENS"], 2
+        ),
+        "step_3_cost": round(tts_characters / 1e6 * pricing["tts"].get(tts_method, 0), 2),
+    }
+
+
+def format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+
+def print_plan(book_name: str, tts_method: str, plan: dict):
+    """Prints a dry-run plan."""
+    print(f"\nDry run for {book_name} (TTS method: {tts_method})")
+    cached = f" ({plan['cached_blocks']} already tagged)" if plan["cached_blocks"] else ""
+    print(f"  Step 2: {plan['blocks']} blocks{cached}, {plan['prompt_tokens']:,} prompt tokens, "
+          f"~{plan['completion_tokens']:,} completion tokens")
+    print(f"  Step 3: {plan['tts_requests']} TTS requests, {plan['tts_characters']:,} characters "
+          f"(from {plan['chunk_source']})")
+    untagged = plan["chunk_source"].startswith("plaintext")
+    for voice, characters in plan["characters_per_voice"].items():
+        label = voice
+        if voice == CONFIG["voice_identifiers"]["narrator_voice"]:
+            label = f"{voice} (narrator)"
+        elif untagged and voice == CONFIG["voice_identifiers"]["default_voice"]:
+            label = f"{voice} (untagged dialogue)"
+        print(f"    {label}: {characters:,} characters")
+    print(f"  Estimated time: Step 2 {format_duration(plan['step_2_seconds'])} ({plan['step_2_rate_source']}), "
+          f"Step 3 {format_duration(plan['step_3_seconds'])} ({plan['step_3_rate_source']})")
+    print(f"  Estimated cost: Step 2 ${plan['step_2_cost']:.2f}, Step 3 ${plan['step_3_cost']:.2f}")
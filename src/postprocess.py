@@ -0,0 +1,210 @@
+# postprocess.py
+
+import os
+import json
+import wave
+import numpy as np
+from pydub import AudioSegment
+from config import CONFIG
+from errors import write_to_error_log
+
+
+def read_chunk_samples(file_path, frame_rate=None):
+    """
+    Reads a chunk's audio as mono float32 samples in [-1, 1].
+
+    WAV data (which local VITS writes, even to .mp3 paths) is read directly with the wave module.
+    Anything else is decoded with pydub. If frame_rate is passed the audio is resampled to it.
+
+    Returns:
+        tuple: (samples, frame_rate)
+    """
+    with open(file_path, "rb") as f:
+        is_wav = f.read(4) == b"RIFF"
+
+    if is_wav:
+        with wave.open(str(file_path), "rb") as wav_file:
+            channels = wav_file.getnchannels()
+            sample_width = wav_file.getsampwidth()
+            rate = wav_file.getframerate()
+            data = wav_file.readframes(wav_file.getnframes())
+        if sample_width == 2 and (frame_rate is None or frame_rate == rate):
+            samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1)
+            return samples, rate
+
+    segment = AudioSegment.from_file(file_path).set_channels(1).set_sample_width(2)
+    if frame_rate:
+        segment = segment.set_frame_rate(frame_rate)
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32) / 32768.0
+    return samples, segment.frame_rate
+
+
+def write_chunk_samples(file_path, samples, frame_rate):
+    """Writes mono float32 samples to a 16-bit WAV file."""
+    data = (np.clip(samples, -1.0, 1.0) * 32767.0).astype(np.int16)
+    with wave.open(str(file_path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes(data.tobytes())
+
+
+def analyze_batch(batch_samples, frame_length, silence_threshold):
+    """
+    Finds the speech bounds and loudness of a batch of chunks in one vectorized pass.
+
+    The chunks are padded to a whole number of frames and concatenated, so the per-frame energy of every
+    chunk in the batch is computed with a single reduceat.
+
+    Returns:
+        list: For each chunk, a dict with the "start" and "end" sample of its speech, the "sum_squares"
+        and "count" of its speech samples, and its "peak".
+    """
+    frame_counts = np.array([max(1, -(-len(samples) // frame_length)) for samples in batch_samples])
+    padded = np.zeros(int(frame_counts.sum()) * frame_length, dtype=np.float32)
+    chunk_frame_starts = np.concatenate(([0], np.cumsum(frame_counts)[:-1]))
+    for samples, frame_start in zip(batch_samples, chunk_frame_starts):
+        offset = frame_start * frame_length
+        padded[offset:offset + len(samples)] = samples
+
+    squares = padded * padded
+    frame_energy = squares.reshape(-1, frame_length).sum(axis=1)
+    frame_active = frame_energy / frame_length > silence_threshold ** 2
+    frame_index = np.arange(len(frame_energy))
+
+    first_active = np.minimum.reduceat(np.where(frame_active, frame_index, len(frame_index)), chunk_frame_starts)
+    last_active = np.maximum.reduceat(np.where(frame_active, frame_index, -1), chunk_frame_starts)
+    active_sum_squares = np.add.reduceat(np.where(frame_active, frame_energy, 0.0), chunk_frame_starts)
+    active_count = np.add.reduceat(frame_active.astype(np.int64), chunk_frame_starts) * frame_length
+    peaks = np.maximum.reduceat(np.abs(padded).reshape(-1, frame_length).max(axis=1), chunk_frame_starts)
+
+    results = []
+    for i, samples in enumerate(batch_samples):
+        if last_active[i] < 0:
+            # The whole chunk is silent
+            results.append({"start": 0, "end": 0, "sum_squares": 0.0, "count": 0, "peak": 0.0})
+            continue
+        results.append({
+            "start": int((first_active[i] - chunk_frame_starts[i]) * frame_length),
+            "end": int(min(len(samples), (last_active[i] - chunk_frame_starts[i] + 1) * frame_length)),
+            "sum_squares": float(active_sum_squares[i]),
+            "count": int(active_count[i]),
+            "peak": float(peaks[i]),
+        })
+    return results
+
+
+def read_chunk_voices(chunks_jsonl_path) -> dict:
+    """Reads the voice of each chunk file from the chunks.jsonl manifest written by Step 3."""
+    voices = {}
+    if chunks_jsonl_path.exists():
+        with open(chunks_jsonl_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    chunk = json.loads(line)
+                    voices[chunk["file"]] = chunk["voice"]
+    return voices
+
+
+def post_process_audio_files(audio_files_dir, processed_audio_files_dir, chunks_jsonl_path) -> dict:
+    """
+    Trims silence, normalizes loudness per voice and adds fixed pauses to every chunk, writing WAV files.
+
+    Runs in two batched passes over the chunks. The first decodes each batch, finds the speech bounds and
+    loudness of every chunk, and writes the trimmed chunks. The second computes one gain per voice from the
+    loudness of all its chunks, then applies the gains and pauses to each batch of trimmed chunks at once.
+
+    Parameters:
+    - audio_files_dir (Path): Directory of the chunk files generated by Step 3.
+    - processed_audio_files_dir (Path): Directory the processed <chunk_number>.wav files are written to.
+    - chunks_jsonl_path (Path): Manifest of the voice used for each chunk.
+
+    Returns:
+    - dict: Stats about the processed chunks.
+    """
+    settings = CONFIG["post_processing"]
+    batch_size = settings["BATCH_SIZE"]
+    silence_threshold = 10 ** (settings["SILENCE_THRESHOLD_DBFS"] / 20)
+
+    # Only the numbered chunk files of Step 3, so other files in the directory are left alone
+    chunk_files = sorted(
+        (f for f in os.listdir(audio_files_dir) if f.lower().endswith(".mp3") and os.path.splitext(f)[0].isdigit()),
+        key=lambda f: int(os.path.splitext(f)[0]),
+    )
+    if not chunk_files:
+        raise ValueError(f"No MP3 files found in {audio_files_dir}.")
+    voices = read_chunk_voices(chunks_jsonl_path)
+
+    processed_audio_files_dir.mkdir(parents=True, exist_ok=True)
+    for stale_file in processed_audio_files_dir.glob("*.wav"):
+        stale_file.unlink()
+
+    # Pass 1: trim silence and measure loudness, batch by batch
+    frame_rate = None
+    chunk_stats = []
+    for batch_start in range(0, len(chunk_files), batch_size):
+        batch_files = chunk_files[batch_start:batch_start + batch_size]
+        batch_samples = []
+        for file_name in batch_files:
+            try:
+                samples, frame_rate = read_chunk_samples(audio_files_dir / file_name, frame_rate)
+            except Exception as e:
+                error_message = f"Failed to read {file_name} for post-processing, it will be silent: {e}"
+                write_to_error_log(error_message)
+                print(error_message)
+                samples = np.zeros(0, dtype=np.float32)
+            batch_samples.append(samples)
+
+        frame_length = max(1, int((frame_rate or 22050) * settings["FRAME_MS"] / 1000))
+        keep_silence = int((frame_rate or 22050) * settings["KEEP_SILENCE_MS"] / 1000)
+        for file_name, samples, stats in zip(batch_files, batch_samples,
+                                             analyze_batch(batch_samples, frame_length, silence_threshold)):
+            start = max(0, stats["start"] - keep_silence)
+            end = min(len(samples), stats["end"] + keep_silence) if stats["end"] else 0
+            write_chunk_samples(processed_audio_files_dir / f"{os.path.splitext(file_name)[0]}.wav",
+                                samples[start:end], frame_rate or 22050)
+            stats["voice"] = voices.get(file_name, "unknown")
+            stats["trimmed_samples"] = len(samples) - (end - start)
+            chunk_stats.append(stats)
+        print(f"Analyzed chunks {batch_start + 1}-{batch_start + len(batch_files)}/{len(chunk_files)}")
+
+    frame_rate = frame_rate or 22050
+
+    # One gain per voice, from the loudness of the speech in all of its chunks
+    voice_gains = {}
+    for voice in {stats["voice"] for stats in chunk_stats}:
+        sum_squares = sum(stats["sum_squares"] for stats in chunk_stats if stats["voice"] == voice)
+        count = sum(stats["count"] for stats in chunk_stats if stats["voice"] == voice)
+        if count == 0:
+            voice_gains[voice] = 1.0
+            continue
+        voice_dbfs = 10 * np.log10(max(sum_squares / count, 1e-12))
+        gain_db = np.clip(settings["TARGET_DBFS"] - voice_dbfs, -settings["MAX_GAIN_DB"], settings["MAX_GAIN_DB"])
+        voice_gains[voice] = float(10 ** (gain_db / 20))
+
+    # Never push a chunk's peak over the ceiling
+    peak_ceiling = 10 ** (settings["PEAK_CEILING_DBFS"] / 20)
+    chunk_gains = np.array([
+        min(voice_gains[stats["voice"]], peak_ceiling / stats["peak"]) if stats["peak"] > 0 else 1.0
+        for stats in chunk_stats
+    ], dtype=np.float32)
+
+    # Pass 2: apply the gains and pauses to each batch of trimmed chunks at once
+    pause = np.zeros(int(frame_rate * settings["PAUSE_MS"] / 1000), dtype=np.float32)
+    for batch_start in range(0, len(chunk_files), batch_size):
+        batch_paths = [processed_audio_files_dir / f"{os.path.splitext(file_name)[0]}.wav"
+                       for file_name in chunk_files[batch_start:batch_start + batch_size]]
+        batch_samples = [read_chunk_samples(path)[0] for path in batch_paths]
+        lengths = np.array([len(samples) for samples in batch_samples])
+
+        gained = np.concatenate(batch_samples + [np.zeros(0, dtype=np.float32)])
+        gained *= np.repeat(chunk_gains[batch_start:batch_start + len(batch_paths)], lengths)
+        for path, samples in zip(batch_paths, np.split(gained, np.cumsum(lengths)[:-1])):
+            write_chunk_samples(path, np.concatenate((samples, pause)), frame_rate)
+
+    trimmed_seconds = sum(stats["trimmed_samples"] for stats in chunk_stats) / frame_rate
+    print(f"Post-processed {len(chunk_files)} chunks: trimmed {trimmed_seconds:.1f}s of silence, "
+          f"normalized {len(voice_gains)} voice(s)")
+    return {"post_processed_chunks": len(chunk_files), "trimmed_seconds": round(trimmed_seconds, 2)}
@@ -0,0 +1,168 @@
+# profiling.py
+
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from config import CONFIG
+
+# Leaf files of threads that are only waiting on a lock, left out of the hottest frames
+WAITING_FILES = ("threading.py", "queue.py")
+
+
+def read_rss_bytes():
+    """Returns the resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_frame_name(frame) -> str:
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    if file_name == "__init__.py":
+        # Name the package, such as re/__init__.py
+        file_name = f"{os.path.basename(os.path.dirname(code.co_filename))}/{file_name}"
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})"
+
+
+def get_thread_group(name: str) -> str:
+    """Groups the threads of a pool under one root frame, e.g. llm_0 and llm_3 under llm."""
+    return re.sub(r"[-_ ]\d.*$", "", name) or name
+
+
+def to_mb(size):
+    return round(size / (1024 * 1024), 1) if size is not None else None
+
+
+class StepProfiler:
+    """
+    Profiles one step of a book while it runs, as a context manager.
+
+    A sampling thread records the stack of every thread each SAMPLE_INTERVAL_SECONDS, so the time spent on
+    the LLM and TTS worker threads is profiled along with the main thread, along with the peak resident
+    memory. cProfile also traces every call of the main thread, and tracemalloc the peak memory allocated
+    by Python. When the step finishes, these are written to the profiles directory:
+
+    - step-<n>.prof: the cProfile stats, for pstats, snakeviz or gprof2dot.
+    - step-<n>.collapsed: the sampled stacks in the collapsed format of flamegraph.pl and speedscope,
+      one line of semicolon-separated frames per stack, rooted at the thread, followed by its sample count.
+    - summary.json: the wall time, peak memory and hottest frames of every step profiled.
+    """
+
+    def __init__(self, profiles_dir, step: int, title: str):
+        self.profiles_dir = profiles_dir
+        self.step = step
+        self.title = title
+        self.stacks = Counter()
+        self.peak_rss = read_rss_bytes()
+        self.stop_sampling = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.profile = cProfile.Profile() if CONFIG["profiling"]["DETERMINISTIC"] else None
+        self.started_tracemalloc = False
+
+    def sample(self):
+        interval = CONFIG["profiling"]["SAMPLE_INTERVAL_SECONDS"]
+        sampler_id = threading.get_ident()
+        while not self.stop_sampling.wait(interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(get_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(get_thread_group(thread_names.get(thread_id, "thread")))
+                self.stacks[";".join(reversed(stack))] += 1
+            rss = read_rss_bytes()
+            if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+                self.peak_rss = rss
+
+    def __enter__(self):
+        if CONFIG["profiling"]["TRACEMALLOC"]:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        self.sampler.start()
+        if self.profile:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile:
+            self.profile.disable()
+        seconds = time.perf_counter() - self.start
+        self.stop_sampling.set()
+        self.sampler.join()
+        peak_traced = None
+        if tracemalloc.is_tracing():
+            peak_traced = tracemalloc.get_traced_memory()[1]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        try:
+            self.write(seconds, peak_traced)
+        except OSError as e:
+            print(f"Could not write the profile of Step {self.step}: {e}")
+        return False
+
+    def get_top_frames(self) -> list:
+        """Returns the frames most samples ended in, as a share of the samples of threads that were not waiting."""
+        leaf_frames = Counter()
+        for stack, samples in self.stacks.items():
+            leaf_frame = stack.rsplit(";", 1)[-1]
+            if not any(f"({waiting_file}:" in leaf_frame for waiting_file in WAITING_FILES):
+                leaf_frames[leaf_frame] += samples
+        busy_samples = sum(leaf_frames.values())
+        return [
+            {"frame": frame, "samples": samples, "percent": round(100 * samples / busy_samples, 1)}
+            for frame, samples in leaf_frames.most_common(CONFIG["profiling"]["TOP_FRAMES"])
+        ]
+
+    def write(self, seconds: float, peak_traced):
+        self.profiles_dir.mkdir(parents=True, exist_ok=True)
+        collapsed_path = self.profiles_dir / f"step-{self.step}.collapsed"
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write(f"{stack} {samples}\n")
+        profile_path = None
+        if self.profile:
+            profile_path = self.profiles_dir / f"step-{self.step}.prof"
+            pstats.Stats(self.profile).dump_stats(str(profile_path))
+
+        summary_path = self.profiles_dir / "summary.json"
+        summary = {}
+        if summary_path.exists():
+            with open(summary_path, "r", encoding="utf-8") as f:
+                summary = json.load(f)
+        top_frames = self.get_top_frames()
+        summary[str(self.step)] = {
+            "title": self.title,
+            "seconds": round(seconds, 3),
+            "samples": sum(self.stacks.values()),
+            "peak_traced_mb": to_mb(peak_traced),
+            "peak_rss_mb": to_mb(self.peak_rss),
+            "collapsed": collapsed_path.name,
+            "profile": profile_path.name if profile_path else None,
+            "top_frames": top_frames,
+        }
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+        memory = [f"{to_mb(peak_traced)} MB allocated by Python" if peak_traced is not None else None,
+                  f"{to_mb(self.peak_rss)} MB resident" if self.peak_rss is not None else None]
+        memory = ", ".join(part for part in memory if part)
+        print(f"Step {self.step} took {seconds:.1f}s{f', peak memory {memory}' if memory else ''}. Hottest frames:")
+        for top_frame in top_frames[:5]:
+            print(f"  {top_frame['percent']:5.1f}%  {top_frame['frame']}")
+        print(f"Profile written to {collapsed_path}{f' and {profile_path.name}' if profile_path else ''}")
@@ -0,0 +1,113 @@
+# progressive.py
+
+import subprocess
+import numpy as np
+from errors import write_to_error_log
+from postprocess import read_chunk_samples
+from to_m4b import get_encoding_parameters, set_metadata
+
+# iTunes-style tags the mp4 muxer writes from -metadata, by metadata.json key
+FFMPEG_METADATA_KEYS = {
+    "title": "title",
+    "author": "artist",
+    "album": "album",
+    "genre": "genre",
+    "year": "date",
+}
+
+
+class ProgressiveM4bWriter:
+    """
+    Appends chunk audio to a fragmented m4b while Step 3 is still synthesizing, so the book can be
+    listened to before every chunk is done.
+
+    Chunks must be added in order. The first chunk decides the sample rate and starts an ffmpeg process
+    that encodes PCM from its stdin, with an encoding profile from CONFIG["encoding_profiles"], into an
+    MP4 with an empty moov and short fragments, which players can open at any point. The metadata and the cover, as an attached picture, are written when the file
+    is created, and the tags are written again when it is finalized.
+
+    Once a chunk cannot be appended, no later chunk is appended either, so the m4b never skips a passage
+    without it being reported. failed_chunks counts the chunks that are missing from it.
+    """
+
+    def __init__(self, output_filename, metadata: dict, cover_image=None, fragment_seconds: int = 10,
+                 encoding_profile="speech"):
+        self.output_filename = output_filename
+        self.metadata = metadata
+        self.cover_image = cover_image
+        self.encoding_profile = encoding_profile
+        self.fragment_seconds = fragment_seconds
+        self.process = None
+        self.sample_rate = None
+        self.chunks_written = 0
+        self.failed_chunks = 0
+
+    def start(self, sample_rate: int):
+        """Starts the ffmpeg encoder for the given sample rate."""
+        self.sample_rate = sample_rate
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-y',  # Overwrite output files without asking
+            '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(sample_rate), '-ac', '1',
+            '-i', 'pipe:0',
+        ]
+        if self.cover_image:
+            ffmpeg_cmd += ['-i', str(self.cover_image), '-map', '0:a', '-map', '1:v',
+                           '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+        ffmpeg_cmd += get_encoding_parameters(self.encoding_profile)
+        ffmpeg_cmd += [
+            '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+            '-frag_duration', str(self.fragment_seconds * 1_000_000),
+        ]
+        for key, ffmpeg_key in FFMPEG_METADATA_KEYS.items():
+            if key in self.metadata:
+                ffmpeg_cmd += ['-metadata', f"{ffmpeg_key}={self.metadata[key]}"]
+        ffmpeg_cmd += ['-f', 'mp4', str(self.output_filename)]
+
+        self.process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def add_chunk(self, file_path):
+        """Decodes a finished chunk and appends its audio to the m4b, unless an earlier chunk is missing from it."""
+        if self.failed_chunks:
+            self.failed_chunks += 1
+            return
+        try:
+            samples, sample_rate = read_chunk_samples(file_path, self.sample_rate)
+            if self.process is None:
+                self.start(sample_rate)
+            self.process.stdin.write((np.clip(samples, -1.0, 1.0) * 32767.0).astype(np.int16).tobytes())
+            self.process.stdin.flush()
+            self.chunks_written += 1
+        except Exception as e:
+            self.failed_chunks += 1
+            error_message = (f"Error appending {file_path} to the progressive m4b: {e}. "
+                             f"The later chunks are not appended, run Step 4 to combine every chunk.")
+            write_to_error_log(error_message)
+            print(error_message)
+
+    def add_missing_chunk(self, file_path):
+        """Records a chunk that failed to generate, which leaves the rest of the m4b out too."""
+        if not self.failed_chunks:
+            error_message = (f"{file_path} was not generated, so it and the later chunks are not appended to the "
+                             f"progressive m4b. Run Step 4 to combine every chunk once they are generated.")
+            write_to_error_log(error_message)
+            print(error_message)
+        self.failed_chunks += 1
+
+    def close(self) -> bool:
+        """Finishes encoding and writes the tags again. Returns whether ffmpeg finished the file."""
+        if self.process is None:
+            return False
+        self.process.stdin.close()
+        stderr = self.process.stderr.read().decode("utf-8", errors="replace")
+        if self.process.wait() != 0:
+            error_message = f"FFmpeg error while writing the progressive m4b: {stderr}"
+            write_to_error_log(error_message)
+            print(error_message)
+            return False
+
+        # Players that ignore the attached picture of a fragmented file read the cover from the tags
+        set_metadata(self.output_filename, self.metadata, self.cover_image)
+        print(f"Progressive audiobook with {self.chunks_written} chunks saved to: {self.output_filename}")
+        return True
@@ -0,0 +1,235 @@
+# rate_governor.py
+
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+import httpx
+from openai import APIConnectionError, APITimeoutError
+from config import CONFIG
+
+# Status codes that mean the request can be sent again unchanged
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Status codes that mean the backend is overloaded, so fewer requests should be in flight
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Durations in OpenAI-style reset headers, such as "1s", "6m0s" or "250ms"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# The governor of each API, with the limits it was built from
+governors = {}
+governors_lock = threading.Lock()
+
+
+def parse_duration(value) -> float:
+    """Parses a rate limit reset duration, either plain seconds or like "6m0s", into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers) -> float:
+    """Returns how many seconds a response asks to wait before retrying, or None."""
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    seconds = parse_duration(retry_after)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_error_status_and_headers(error: Exception) -> tuple:
+    """Returns the HTTP status code and response headers of a failed API call, if it has them."""
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if status is None:
+        status = getattr(response, "status_code", None)
+    return status, headers
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at a rate per minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount from the bucket, possibly going into debt, and returns the seconds to wait until it is covered."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateGovernor:
+    """
+    Paces every request sent to one API, shared by all the threads that call it.
+
+    Requests wait for a request-per-minute and a unit-per-minute (tokens or characters) token bucket,
+    and for a free slot under a concurrency limit. The limit grows by one slot per round of successful
+    requests and halves when the API throttles, and every caller pauses for as long as a 429 response's
+    Retry-After (or a rate limit header reporting no remaining quota) asks. Failed requests that can be
+    retried are sent again after an exponential backoff with full jitter.
+    """
+
+    def __init__(self, name: str, requests_per_minute=None, units_per_minute=None, max_concurrency: int = 4,
+                 min_concurrency: int = 1, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.unit_bucket = TokenBucket(units_per_minute) if units_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.active = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, units: float):
+        """Waits until the buckets and the concurrency limit allow another request, then takes a slot."""
+        with self.condition:
+            wait = 0.0
+            if self.request_bucket:
+                wait = max(wait, self.request_bucket.reserve(1))
+            if self.unit_bucket and units:
+                wait = max(wait, self.unit_bucket.reserve(units))
+        if wait > 0:
+            time.sleep(wait)
+
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.active >= int(self.concurrency):
+                    self.condition.wait()
+                else:
+                    break
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds: float):
+        """Holds back every caller for the given number of seconds."""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers):
+        """Pauses until the quota resets when the rate limit headers report that none is left."""
+        if not headers:
+            return
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is not None and reset and int(float(remaining)) <= 0:
+                self.pause(reset)
+
+    def on_success(self, headers):
+        with self.condition:
+            # Additive increase: one more slot after about one round of successful requests
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self.observe_headers(headers)
+
+    def on_failure(self, status, headers, attempt: int) -> float:
+        """Adapts to a failed request and returns how long to wait before retrying it."""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = parse_retry_after(headers)
+        delay = max(backoff, retry_after or 0.0)
+        if status in THROTTLE_STATUS_CODES:
+            with self.condition:
+                # Multiplicative decrease
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            self.pause(delay)
+        self.observe_headers(headers)
+        return delay
+
+    def is_retryable(self, error: Exception, status) -> bool:
+        if status is not None:
+            return status in RETRYABLE_STATUS_CODES
+        return isinstance(error, (APIConnectionError, APITimeoutError, httpx.TransportError, ConnectionError, TimeoutError))
+
+    def call(self, request, units: float = 0, description: str = "request"):
+        """
+        Sends a request through the governor, retrying it if it fails in a way that can be retried.
+
+        Args:
+            request (callable): Sends the request. If its return value has headers (such as a raw
+                OpenAI response), the rate limit headers are used to pace later requests.
+            units (float): Tokens or characters the request uses, counted against the unit limit.
+            description (str): What is being requested, used in retry messages.
+
+        Returns:
+            The return value of request.
+        """
+        attempt = 0
+        while True:
+            self.acquire(units)
+            try:
+                response = request()
+            except Exception as e:
+                self.release()
+                status, headers = get_error_status_and_headers(e)
+                if attempt >= self.max_retries or not self.is_retryable(e, status):
+                    raise
+                delay = self.on_failure(status, headers, attempt)
+                attempt += 1
+                print(f"{self.name}: {description} failed ({status or type(e).__name__}), retrying in {delay:.1f}s "
+                      f"(attempt {attempt} of {self.max_retries})")
+                time.sleep(delay)
+                continue
+            self.release()
+            self.on_success(getattr(response, "headers", None))
+            return response
+
+
+def get_rate_governor(name: str) -> RateGovernor:
+    """
+    Returns the governor shared by every request to an API, configured from CONFIG["rate_limits"][name].
+    A new governor is built when those limits are replaced, such as by use_llm_provider switching the
+    LLM provider, so the limits and backoff of one provider are never applied to another.
+    """
+    with governors_lock:
+        limits = CONFIG["rate_limits"][name]
+        if name not in governors or governors[name][0] is not limits:
+            governors[name] = (limits, RateGovernor(
+                name,
+                requests_per_minute=limits["REQUESTS_PER_MINUTE"],
+                units_per_minute=limits["UNITS_PER_MINUTE"],
+                max_concurrency=limits["MAX_CONCURRENCY"],
+                max_retries=CONFIG["rate_limits"]["MAX_RETRIES"],
+                base_delay=CONFIG["rate_limits"]["BASE_DELAY_SECONDS"],
+                max_delay=CONFIG["rate_limits"]["MAX_DELAY_SECONDS"],
+            ))
+        return governors[name][1]
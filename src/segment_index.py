@@ -0,0 +1,207 @@
+# segment_index.py
+
+import json
+import mmap
+import numpy as np
+from config import CONFIG
+from fingerprints import fingerprint_file
+from utils import iter_speaker_segments, iter_tagged_units, iter_block_units, split_text_into_chunks
+
+# One fixed-size record per narration or dialogue segment of the tagged text
+SEGMENT_DTYPE = np.dtype([
+    ("offset", "<u8"),  # Byte offset of the segment's text in segments.bin
+    ("length", "<u4"),  # Length of the segment's text in bytes
+    ("characters", "<u4"),  # Length of the segment's text in characters
+    ("speaker", "<u4"),  # Index into the speakers table, 0 is the narrator
+    ("block", "<u4"),  # Step 2 block the segment was tagged in
+])
+INDEX_VERSION = 1
+
+
+class SegmentIndexWriter:
+    """
+    Writes the segment index of a book's tagged text while Step 2 tags it, one block at a time.
+
+    The index is made of three files: segments.idx holds a fixed-size record for every segment,
+    segments.bin holds the UTF-8 text of the segments back to back, and segments.json holds the
+    speakers table along with the fingerprint of the tagged text the index was built from.
+    """
+
+    def __init__(self, paths: dict):
+        self.paths = paths
+        self.speakers = [None]
+        self.speaker_ids = {None: 0}
+        self.offset = 0
+        self.segments = 0
+        self.records_file = open(paths["segment_index"], "wb")
+        self.text_file = open(paths["segment_text"], "wb")
+
+    def add_unit(self, block_id: int, unit: str):
+        """Adds the segments of a piece of tagged text that does not split a tag."""
+        records = []
+        for text, name in iter_speaker_segments(unit):
+            if name not in self.speaker_ids:
+                self.speaker_ids[name] = len(self.speakers)
+                self.speakers.append(name)
+            data = text.encode("utf-8")
+            self.text_file.write(data)
+            records.append((self.offset, len(data), len(text), self.speaker_ids[name], block_id))
+            self.offset += len(data)
+        if records:
+            self.records_file.write(np.array(records, dtype=SEGMENT_DTYPE).tobytes())
+            self.segments += len(records)
+
+    def add_block(self, block_id: int, tagged_block: str):
+        """Adds the segments of a tagged block, split into units the same way Step 3 reads the tagged file."""
+        for unit in iter_block_units(tagged_block):
+            self.add_unit(block_id, unit)
+
+    def close(self):
+        """Finishes the index and records the fingerprint of the tagged text it describes."""
+        self.records_file.close()
+        self.text_file.close()
+        with open(self.paths["segment_speakers"], "w", encoding="utf-8") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "segments": self.segments,
+                "tagged_fingerprint": fingerprint_file(self.paths["tagged"]),
+                "speakers": self.speakers,
+            }, f, indent=2)
+
+
+def build_segment_index(paths: dict):
+    """
+    Builds the segment index from the tagged text file, for tagged text that was edited by hand or
+    written before the index existed. Each tagged unit is recorded as its own block.
+    """
+    writer = SegmentIndexWriter(paths)
+    try:
+        for unit_id, unit in enumerate(iter_tagged_units(paths["tagged"])):
+            writer.add_unit(unit_id, unit)
+    finally:
+        writer.close()
+
+
+class SegmentIndex:
+    """A memory-mapped segment index. Segments are read straight from the mapped files, by position."""
+
+    def __init__(self, paths: dict):
+        with open(paths["segment_speakers"], "r", encoding="utf-8") as f:
+            header = json.load(f)
+        self.speakers = header["speakers"]
+        if header["segments"]:
+            self.records = np.memmap(paths["segment_index"], dtype=SEGMENT_DTYPE, mode="r")
+        else:
+            self.records = np.zeros(0, dtype=SEGMENT_DTYPE)
+        self.text_file = open(paths["segment_text"], "rb")
+        self.text = mmap.mmap(self.text_file.fileno(), 0, access=mmap.ACCESS_READ) if self.records.size else b""
+
+    def __len__(self):
+        return len(self.records)
+
+    def segment_text(self, i: int) -> str:
+        record = self.records[i]
+        offset = int(record["offset"])
+        return self.text[offset:offset + int(record["length"])].decode("utf-8")
+
+    def speaker_voices(self, characters_map: dict) -> np.ndarray:
+        """Returns the voice of every speaker in the speakers table, the same way Step 3 assigns voices to tags."""
+        return np.array([
+            characters_map.get("narrator", CONFIG["voice_identifiers"]["narrator_voice"]) if name is None
+            else characters_map.get(name, CONFIG["voice_identifiers"]["default_voice"])
+            for name in self.speakers
+        ], dtype=object)
+
+    def iter_segments(self, characters_map: dict, start: int = 0, stop: int = None):
+        """Yields the segments from start up to stop with their voices, like iter_tts_segments."""
+        voices = self.speaker_voices(characters_map)
+        for i in range(start, len(self.records) if stop is None else stop):
+            yield {"text": self.segment_text(i), "voice": voices[self.records[i]["speaker"]]}
+
+    def find_chunk_starts(self, characters_map: dict, max_characters: int = None) -> list:
+        """
+        Finds every segment where a new TTS chunk starts with nothing carried over from earlier segments.
+
+        Mirrors how merge_tts_segments merges segments into chunks, using only the lengths in the index
+        except where a chunk is long enough to be split, so TTS work can start at any of these segments.
+
+        Returns:
+            list: (segment, chunk_number) of every such segment, and finally (len(self), total_chunks + 1).
+        """
+        max_characters = max_characters or CONFIG["token_limits"]["TTS_MAX_CHARACTERS"]
+        voices = self.speaker_voices(characters_map)[self.records["speaker"]] if len(self.records) else []
+        characters = self.records["characters"]
+
+        starts = []
+        chunks = 0
+        current_length = 0
+        current_voice = None
+        run_start = 0
+        for i in range(len(self.records)):
+            voice = voices[i]
+            if current_voice and voice != current_voice:
+                chunks += 1
+                current_length = 0
+            if current_length == 0:
+                starts.append((i, chunks + 1))
+                run_start = i
+                current_length = int(characters[i])
+            else:
+                current_length += 1 + int(characters[i])
+            current_voice = voice
+
+            if current_length > max_characters:
+                text = " ".join(self.segment_text(j) for j in range(run_start, i + 1))
+                chunks += len(split_text_into_chunks(text, max_characters))
+                current_length = 0
+                current_voice = None
+        if current_length:
+            chunks += 1
+        starts.append((len(self.records), chunks + 1))
+        return starts
+
+    def get_shard(self, characters_map: dict, shard: int, shard_count: int, max_characters: int = None) -> tuple:
+        """
+        Deterministically picks the contiguous range of chunks synthesized by one of shard_count shards.
+
+        The book is cut at the chunk starts closest to equal shares of its characters, so every machine
+        given the same index and characters.json agrees on the ranges.
+
+        Args:
+            shard (int): Index of the shard, from 0 to shard_count - 1.
+            max_characters (int, optional): Longest chunk, CONFIG["token_limits"]["TTS_MAX_CHARACTERS"] if not passed.
+
+        Returns:
+            tuple: (start_segment, stop_segment, first_chunk_number, stop_chunk_number), where the stops
+            are exclusive.
+        """
+        starts = self.find_chunk_starts(characters_map, max_characters)
+        segments = np.array([segment for segment, _ in starts], dtype=np.int64)
+        cumulative = np.concatenate(([0], np.cumsum(self.records["characters"], dtype=np.int64)))
+        positions = cumulative[segments[:-1]]
+        total = cumulative[-1]
+
+        first = int(np.searchsorted(positions, total * shard / shard_count, side="left"))
+        stop = len(positions) if shard == shard_count - 1 else \
+            int(np.searchsorted(positions, total * (shard + 1) / shard_count, side="left"))
+        return (starts[first][0], starts[stop][0], starts[first][1], starts[stop][1])
+
+    def close(self):
+        if self.records.size:
+            self.text.close()
+        self.text_file.close()
+        self.records = None
+
+
+def load_segment_index(paths: dict) -> SegmentIndex:
+    """Memory-maps the segment index, first rebuilding it if it is missing or the tagged text changed since."""
+    up_to_date = False
+    if paths["segment_speakers"].exists() and paths["segment_index"].exists() and paths["segment_text"].exists():
+        with open(paths["segment_speakers"], "r", encoding="utf-8") as f:
+            header = json.load(f)
+        up_to_date = header.get("version") == INDEX_VERSION \
+            and header.get("tagged_fingerprint") == fingerprint_file(paths["tagged"])
+    if not up_to_date:
+        print(f"Building the segment index of {paths['tagged']}...")
+        build_segment_index(paths)
+    return SegmentIndex(paths)
@@ -0,0 +1,83 @@
+# shards.py
+
+import json
+from errors import write_to_error_log
+from utils import format_chunk_ranges
+from fingerprints import get_step_inputs, record_step
+from segment_index import load_segment_index
+from autotune import get_tts_max_characters
+from chunking import merge_tts_segments
+from main import get_chunk_manifest_entry, get_shard_chunks_jsonl, detect_cover_image
+
+
+def merge_shards(input_file: str, book_name: str, paths: dict, shard_count: int, args) -> bool:
+    """
+    Verifies that the shards of Step 3 generated every chunk of the book and merges their chunks.jsonl files.
+
+    The expected chunks are planned again from the segment index and characters.json. Each must be recorded
+    with the same text and voice in one of the shards' chunks.shard-<i>-of-<N>.jsonl files, and its audio
+    file must exist and not be empty. If every chunk is present, chunks.jsonl is written and Step 3 is
+    recorded as done, so Step 4 can run as usual.
+
+    Returns:
+        bool: Whether every chunk is present.
+    """
+    with open(paths["characters_json"], "r", encoding="utf-8") as f:
+        characters_json = json.load(f)
+
+    # Chunks recorded by the shards, by file name
+    recorded = {}
+    for shard_index in range(shard_count):
+        shard_chunks_jsonl = get_shard_chunks_jsonl(paths, (shard_index, shard_count))
+        if not shard_chunks_jsonl.exists():
+            print(f"Shard {shard_index + 1}/{shard_count} has not written {shard_chunks_jsonl.name}.")
+            continue
+        with open(shard_chunks_jsonl, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                recorded[entry["file"]] = entry
+
+    segment_index = load_segment_index(paths)
+    expected = []
+    missing = []
+    mismatched = []
+    tts_characters = 0
+    try:
+        tts_chunks = merge_tts_segments(
+            segment_index.iter_segments(characters_json), get_tts_max_characters(args.tts_method.lower())
+        )
+        for chunk_number, chunk in enumerate(tts_chunks, 1):
+            entry = get_chunk_manifest_entry(chunk_number, chunk)
+            expected.append(entry)
+            tts_characters += entry["characters"]
+            file_path = paths["audio_files_dir"] / entry["file"]
+            if entry["file"] not in recorded or not file_path.exists() or file_path.stat().st_size == 0:
+                missing.append(chunk_number)
+            elif recorded[entry["file"]] != entry:
+                mismatched.append(chunk_number)
+    finally:
+        segment_index.close()
+
+    if missing or mismatched:
+        if missing:
+            error_message = f"{book_name}: {len(missing)} of {len(expected)} chunks are missing: {format_chunk_ranges(missing)}"
+            print(error_message)
+            write_to_error_log(error_message)
+        if mismatched:
+            error_message = (f"{book_name}: {len(mismatched)} chunks were generated from different text or voices "
+                             f"than the current segment index and characters.json: {format_chunk_ranges(mismatched)}")
+            print(error_message)
+            write_to_error_log(error_message)
+        print("Re-run the shards that generated these chunks, then merge again.")
+        return False
+
+    with open(paths["chunks_jsonl"], "w", encoding="utf-8") as f:
+        for entry in expected:
+            f.write(json.dumps(entry) + "\n")
+
+    inputs = get_step_inputs(
+        3, input_file, paths, args.tts_method.lower(), args.m4b_method, detect_cover_image(book_name), args.post_process
+    )
+    record_step(paths, 3, inputs, {"chunks": len(expected), "tts_characters": tts_characters})
+    print(f"All {len(expected)} chunks from {shard_count} shards are present. Merged them into {paths['chunks_jsonl']}.")
+    return True
@@ -0,0 +1,404 @@
+import io
+import re
+import json
+import time
+import wave
+import random
+import itertools
+import asyncio
+import argparse
+import threading
+from email import policy
+from email.parser import BytesParser
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from config import CONFIG, get_elevenlabs_voice_map
+from utils import count_tokens
+
+# Straight or curly double-quoted passages, tagged as dialogue in canned chat responses
+QUOTED_DIALOGUE = re.compile(r'(“[^”]*”|"[^"]*")')
+CANNED_SPEAKERS = ["stand_in_speaker_one-m", "stand_in_speaker_two-f"]
+
+app = FastAPI(title="TTS Book to Audio stand-in server")
+
+
+class StandInSettings:
+    """Latency, fault injection and canned responses of the stand-in server, set from the command line."""
+
+    def __init__(self, args=None):
+        self.latency = getattr(args, "latency", 0.0)
+        self.jitter = getattr(args, "jitter", 0.0)
+        self.tokens_per_second = getattr(args, "tokens_per_second", 0.0)
+        self.characters_per_second = getattr(args, "characters_per_second", 0.0)
+        self.error_rate = getattr(args, "error_rate", 0.0)
+        self.rate_limit_rate = getattr(args, "rate_limit_rate", 0.0)
+        self.requests_per_minute = getattr(args, "requests_per_minute", None)
+        self.retry_after = getattr(args, "retry_after", 1.0)
+        self.batch_seconds = getattr(args, "batch_seconds", 2.0)
+        self.chat_response = None
+        self.audio_response = None
+        if getattr(args, "chat_response_file", None):
+            with open(args.chat_response_file, "r", encoding="utf-8") as f:
+                self.chat_response = f.read()
+        if getattr(args, "audio_file", None):
+            with open(args.audio_file, "rb") as f:
+                self.audio_response = f.read()
+
+
+settings = StandInSettings()
+stats = {"requests": 0, "rate_limited": 0, "errors": 0, "chat_completions": 0, "speech": 0, "characters": 0,
+         "batches": 0, "batch_requests": 0, "batch_requests_failed": 0}
+stats_lock = threading.Lock()
+request_times = []
+
+# Files uploaded for or written by batches, and the batches, by id
+files = {}
+batches = {}
+
+
+def count(key: str, amount: int = 1):
+    with stats_lock:
+        stats[key] += amount
+
+
+def check_faults():
+    """Returns a 429 or 500 response if one should be injected for this request, otherwise None."""
+    count("requests")
+    now = time.monotonic()
+    with stats_lock:
+        # Enforce a real requests-per-minute limit over a sliding window, like the real APIs
+        while request_times and now - request_times[0] > 60:
+            request_times.pop(0)
+        over_limit = settings.requests_per_minute and len(request_times) >= settings.requests_per_minute
+        if not over_limit:
+            request_times.append(now)
+
+    if over_limit or random.random() < settings.rate_limit_rate:
+        count("rate_limited")
+        retry_after = 60 - (now - request_times[0]) if over_limit else settings.retry_after
+        return JSONResponse(
+            {"error": {"message": "Rate limit exceeded (stand-in).", "type": "rate_limit_error", "code": "429"}},
+            status_code=429,
+            headers={
+                "retry-after": f"{max(retry_after, 0.0):.3f}",
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": f"{max(retry_after, 0.0):.3f}s",
+            },
+        )
+    if random.random() < settings.error_rate:
+        count("errors")
+        return JSONResponse(
+            {"error": {"message": "Internal server error (stand-in).", "type": "server_error", "code": "500"}},
+            status_code=500,
+        )
+    return None
+
+
+def rate_limit_headers() -> dict:
+    """Returns OpenAI-style rate limit headers for a successful response."""
+    if not settings.requests_per_minute:
+        return {}
+    with stats_lock:
+        remaining = max(0, settings.requests_per_minute - len(request_times))
+    return {
+        "x-ratelimit-limit-requests": str(settings.requests_per_minute),
+        "x-ratelimit-remaining-requests": str(remaining),
+        "x-ratelimit-reset-requests": "60s",
+    }
+
+
+async def simulate_latency(work: float, rate: float):
+    """Waits the base latency, plus jitter, plus the time to produce work units at rate per second."""
+    delay = settings.latency + random.uniform(0, settings.jitter)
+    if rate:
+        delay += work / rate
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def canned_tagged_block(block: str) -> str:
+    """Tags every quoted passage of a block as dialogue, alternating between two stand-in speakers."""
+    speakers = itertools.cycle(CANNED_SPEAKERS)
+
+    def tag(match):
+        speaker = next(speakers)
+        return f"<{speaker}>{match.group(1)}</{speaker}>"
+
+    return QUOTED_DIALOGUE.sub(tag, block)
+
+
+def canned_completion(prompt: str) -> str:
+    """Answers a tagging or characters.json prompt the way the real model is asked to."""
+    if settings.chat_response is not None:
+        return settings.chat_response
+    if prompt.startswith(CONFIG["characters_json_system_message"]):
+        # Return the characters unchanged, already in the expected format
+        characters_json = prompt[len(CONFIG["characters_json_system_message"]):]
+        characters_json = characters_json[:len(characters_json) - len(CONFIG["user_message_suffix"])]
+        return f"```json\n{characters_json}\n```"
+    start = prompt.rfind(CONFIG["user_message_prefix"])
+    block = prompt[start + len(CONFIG["user_message_prefix"]):] if start != -1 else prompt
+    if block.endswith(CONFIG["user_message_suffix"]):
+        block = block[:len(block) - len(CONFIG["user_message_suffix"])]
+    return canned_tagged_block(block)
+
+
+def canned_audio(text: str) -> bytes:
+    """Returns a WAV tone about as long as the text would take to read, or the --audio-file contents."""
+    if settings.audio_response is not None:
+        return settings.audio_response
+    sample_rate = 22050
+    duration = max(0.5, len(text) / 15)
+    t = np.arange(int(sample_rate * duration)) / sample_rate
+    samples = (0.1 * np.sin(2 * np.pi * 220 * t) * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def chat_completion_body(body: dict) -> dict:
+    """Returns a chat completion answering a request body, with its canned content and token usage."""
+    prompt = "\n\n".join(message["content"] for message in body["messages"])
+    completion = canned_completion(prompt)
+    prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(completion)
+    return {
+        "id": f"chatcmpl-stand-in-{stats['requests']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", CONFIG["model"]),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": completion},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI-compatible chat completions, as used by GitHubOpenAIClient."""
+    fault = check_faults()
+    if fault:
+        return fault
+    completion = chat_completion_body(await request.json())
+    await simulate_latency(completion["usage"]["completion_tokens"], settings.tokens_per_second)
+    count("chat_completions")
+    return JSONResponse(completion, headers=rate_limit_headers())
+
+
+def store_file(content: bytes, filename: str, purpose: str) -> dict:
+    file_id = f"file-stand-in-{len(files) + 1}"
+    files[file_id] = {
+        "content": content,
+        "object": {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        },
+    }
+    return files[file_id]["object"]
+
+
+@app.post("/files")
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    """OpenAI-compatible file upload, as used to upload batch input files. Parses the multipart body itself."""
+    fault = check_faults()
+    if fault:
+        return fault
+    header = f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode("utf-8")
+    message = BytesParser(policy=policy.HTTP).parsebytes(header + await request.body())
+    fields = {}
+    filename = "upload"
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        fields[name] = part.get_payload(decode=True)
+        if name == "file":
+            filename = part.get_filename() or filename
+    if "file" not in fields:
+        return JSONResponse({"error": {"message": "Missing file.", "type": "invalid_request_error"}}, status_code=400)
+    return JSONResponse(store_file(fields["file"], filename, fields.get("purpose", b"batch").decode("utf-8")))
+
+
+@app.get("/files/{file_id}/content")
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    if file_id not in files:
+        return JSONResponse({"error": {"message": f"No file {file_id}.", "type": "invalid_request_error"}}, status_code=404)
+    return Response(files[file_id]["content"], media_type="application/jsonl")
+
+
+async def run_batch(batch: dict):
+    """Answers every request of a batch after --batch-seconds, failing each with the --error-rate."""
+    batch["status"] = "in_progress"
+    batch["in_progress_at"] = int(time.time())
+    await asyncio.sleep(settings.batch_seconds)
+    output_lines = []
+    error_lines = []
+    for line in files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        count("batch_requests")
+        if random.random() < settings.error_rate:
+            count("batch_requests_failed")
+            batch["request_counts"]["failed"] += 1
+            error_lines.append({
+                "id": f"batch_req_{len(output_lines) + len(error_lines) + 1}",
+                "custom_id": entry["custom_id"],
+                "response": {"status_code": 500, "body": {"error": {"message": "Internal server error (stand-in).",
+                                                                    "type": "server_error"}}},
+                "error": None,
+            })
+            continue
+        batch["request_counts"]["completed"] += 1
+        output_lines.append({
+            "id": f"batch_req_{len(output_lines) + len(error_lines) + 1}",
+            "custom_id": entry["custom_id"],
+            "response": {"status_code": 200, "request_id": entry["custom_id"], "body": chat_completion_body(entry["body"])},
+            "error": None,
+        })
+    if output_lines:
+        batch["output_file_id"] = store_file(
+            "".join(json.dumps(line) + "\n" for line in output_lines).encode("utf-8"), "output.jsonl", "batch_output"
+        )["id"]
+    if error_lines:
+        batch["error_file_id"] = store_file(
+            "".join(json.dumps(line) + "\n" for line in error_lines).encode("utf-8"), "errors.jsonl", "batch_output"
+        )["id"]
+    batch["status"] = "completed"
+    batch["completed_at"] = int(time.time())
+
+
+@app.post("/batches")
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """OpenAI-compatible batches, as used by --batch-api. Batches finish after --batch-seconds."""
+    fault = check_faults()
+    if fault:
+        return fault
+    body = await request.json()
+    if body.get("input_file_id") not in files:
+        return JSONResponse({"error": {"message": "Unknown input_file_id.", "type": "invalid_request_error"}},
+                            status_code=400)
+    total = sum(1 for line in files[body["input_file_id"]]["content"].splitlines() if line.strip())
+    batch_id = f"batch_stand_in_{len(batches) + 1}"
+    batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": body["endpoint"],
+        "input_file_id": body["input_file_id"],
+        "completion_window": body["completion_window"],
+        "status": "validating",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "in_progress_at": None,
+        "completed_at": None,
+        "request_counts": {"total": total, "completed": 0, "failed": 0},
+        "metadata": body.get("metadata"),
+    }
+    count("batches")
+    asyncio.create_task(run_batch(batches[batch_id]))
+    return JSONResponse(batches[batch_id])
+
+
+@app.get("/batches/{batch_id}")
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    if batch_id not in batches:
+        return JSONResponse({"error": {"message": f"No batch {batch_id}.", "type": "invalid_request_error"}},
+                            status_code=404)
+    return JSONResponse(batches[batch_id])
+
+
+@app.post("/audio/speech")
+@app.post("/v1/audio/speech")
+async def audio_speech(request: Request):
+    """OpenAI-compatible speech synthesis, as used by the 'openai' TTS method."""
+    fault = check_faults()
+    if fault:
+        return fault
+    body = await request.json()
+    await simulate_latency(len(body["input"]), settings.characters_per_second)
+    count("speech")
+    count("characters", len(body["input"]))
+    return Response(canned_audio(body["input"]), media_type="audio/mpeg", headers=rate_limit_headers())
+
+
+@app.get("/v1/voices")
+async def elevenlabs_voices():
+    """ElevenLabs voice list, used to resolve the voice names in the ElevenLabs voice mapping."""
+    return JSONResponse({
+        "voices": [{"voice_id": f"stand-in-{name.lower()}", "name": name} for name in get_elevenlabs_voice_map().values()]
+    })
+
+
+@app.post("/v1/text-to-speech/{voice_id}")
+@app.post("/v1/text-to-speech/{voice_id}/stream")
+async def elevenlabs_text_to_speech(voice_id: str, request: Request):
+    """ElevenLabs speech synthesis, as used by the 'elevenlabs' TTS method."""
+    fault = check_faults()
+    if fault:
+        return fault
+    body = await request.json()
+    await simulate_latency(len(body["text"]), settings.characters_per_second)
+    count("speech")
+    count("characters", len(body["text"]))
+    return Response(canned_audio(body["text"]), media_type="audio/mpeg")
+
+
+@app.get("/stats")
+async def get_stats():
+    """Counts of the requests served and the faults injected since the server started."""
+    with stats_lock:
+        return JSONResponse(dict(stats))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve stand-ins for the OpenAI chat completions and speech APIs and the ElevenLabs API, "
+                    "for load testing without paying for real traffic."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.2, help="Base seconds before every response.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Up to this many random seconds added to the latency.")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0,
+                        help="Completion tokens generated per second. 0 to not depend on the length.")
+    parser.add_argument("--characters-per-second", type=float, default=200.0,
+                        help="Characters synthesized per second. 0 to not depend on the length.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429.")
+    parser.add_argument("--requests-per-minute", type=int,
+                        help="Answer requests over this per-minute limit with a 429, like the real APIs.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds of injected 429s.")
+    parser.add_argument("--chat-response-file", help="Return this file's contents as every chat completion.")
+    parser.add_argument("--audio-file", help="Return this audio file for every speech request.")
+    parser.add_argument("--batch-seconds", type=float, default=2.0,
+                        help="Seconds a batch stays in progress before its results are written.")
+    args = parser.parse_args()
+
+    settings = StandInSettings(args)
+    print(f"Point the clients at the stand-ins with:\n"
+          f"  GITHUB_MODELS_BASE_URL=http://{args.host}:{args.port}\n"
+          f"  OPENAI_BASE_URL=http://{args.host}:{args.port}/v1\n"
+          f"  ELEVENLABS_BASE_URL=http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
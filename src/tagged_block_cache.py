@@ -0,0 +1,83 @@
+# tagged_block_cache.py
+
+import os
+import json
+import hashlib
+import threading
+from utils import count_tokens
+
+
+class TaggedBlockCache:
+    """
+    Keeps the tagged text of every block Step 2 tagged successfully, so a re-run of Step 2 after the
+    plaintext was edited only re-tags the blocks whose source text changed and splices them in between
+    the blocks that did not.
+
+    Blocks are keyed by a hash of their source text and of the tagging config, so blocks tagged with
+    another model or prompt are never reused. Entries are appended to outputs/<book_name>/tagged_blocks.jsonl
+    as soon as a block is tagged, so an interrupted run keeps them too, and close() drops the entries of
+    blocks the book no longer has.
+
+    With read_only, the cache is only looked up, as by a dry run, and its file is left unchanged.
+    """
+
+    def __init__(self, path, tagging_fingerprint: str, read_only=False):
+        self.path = path
+        self.tagging_fingerprint = tagging_fingerprint
+        self.entries = {}
+        self.used = set()
+        self.reused = 0
+        self.reused_tokens = 0
+        self.lock = threading.Lock()
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    # The last line may have been cut short by an interrupted run
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["key"]] = entry["tagged"]
+        self.file = None
+        if not read_only:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    def get_key(self, block: str) -> str:
+        return hashlib.sha256(f"{self.tagging_fingerprint}\n{block}".encode("utf-8")).hexdigest()
+
+    def get(self, block: str):
+        """Returns the tagged text of a block tagged by an earlier run, or None."""
+        key = self.get_key(block)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.used.add(key)
+            self.reused += 1
+            self.reused_tokens += count_tokens(block)
+            return self.entries[key]
+
+    def add(self, block: str, tagged_block: str):
+        """Records the tagged text of a block that passed validation."""
+        key = self.get_key(block)
+        with self.lock:
+            self.used.add(key)
+            if key in self.entries:
+                return
+            self.entries[key] = tagged_block
+            self.file.write(json.dumps({"key": key, "tagged": tagged_block}) + "\n")
+            self.file.flush()
+
+    def close(self, compact=True):
+        """Closes the cache. If compact is True, it is rewritten with only the blocks used by this run."""
+        if self.file is None:
+            return
+        self.file.close()
+        if not compact:
+            return
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for key, tagged_block in self.entries.items():
+                if key in self.used:
+                    f.write(json.dumps({"key": key, "tagged": tagged_block}) + "\n")
+        os.replace(temp_path, self.path)
@@ -3,6 +3,8 @@ from pathlib import Path
 import re
 import subprocess
 import tempfile
+import time
+from config import CONFIG
 from errors import write_to_error_log
 import av
 from pydub import AudioSegment
@@ -16,10 +18,42 @@ def get_root_directory():
 
 def numerical_sort_key(file_name):
     """Extracts the numeric part of the file name for proper sorting."""
-    match = re.findall(r'(\d+)', file_name)
-    return int(match[-2]) if match else file_name
+    match = re.findall(r'(\d+)', os.path.splitext(file_name)[0])
+    return int(match[-1]) if match else file_name
 
-def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_image=None):
+def get_encoding_parameters(encoding_profile: str) -> list:
+    """Returns the ffmpeg audio encoding arguments of a profile in CONFIG["encoding_profiles"]."""
+    profile = CONFIG["encoding_profiles"][encoding_profile]
+    parameters = ['-c:a', profile["CODEC"]]
+    if profile["PROFILE"]:
+        parameters += ['-profile:a', profile["PROFILE"]]
+    if profile["BITRATE"]:
+        parameters += ['-b:a', profile["BITRATE"]]
+    if profile["CHANNELS"]:
+        parameters += ['-ac', str(profile["CHANNELS"])]
+    if profile["SAMPLE_RATE"]:
+        parameters += ['-ar', str(profile["SAMPLE_RATE"])]
+    return parameters
+
+def export_m4b(combined_audio, output_filename, encoding_profile: str) -> dict:
+    """Encodes the combined audio to an M4B with an encoding profile, and reports its size and encode time."""
+    start = time.perf_counter()
+    combined_audio.export(output_filename, format="mp4", parameters=get_encoding_parameters(encoding_profile))
+    encode_seconds = time.perf_counter() - start
+
+    m4b_bytes = os.path.getsize(output_filename)
+    audio_seconds = len(combined_audio) / 1000
+    print(f"Encoded {audio_seconds / 3600:.2f} hours of audio with the '{encoding_profile}' profile in "
+          f"{encode_seconds:.1f}s: {m4b_bytes / 1024 / 1024:.1f} MB "
+          f"({m4b_bytes * 8 / 1000 / max(audio_seconds, 1e-9):.0f} kbps)")
+    return {
+        "encoding_profile": encoding_profile,
+        "m4b_bytes": m4b_bytes,
+        "encode_seconds": round(encode_seconds, 2),
+    }
+
+def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_image=None, extension=".mp3",
+                             encoding_profile="speech"):
     """
     Combine MP3 files using ffmpeg and export as an M4B audiobook with metadata.
 
@@ -28,12 +62,17 @@ def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_ima
     - output_filename (str): Path for the output M4B file.
     - metadata (dict): Dictionary containing metadata (e.g., title, author).
     - cover_image (Path, optional): Path to the cover image file.
+    - extension (str, optional): Extension of the audio files to combine, e.g. ".wav" for post-processed files.
+    - encoding_profile (str, optional): Name of the profile in CONFIG["encoding_profiles"] used to encode the M4B.
+
+    Returns:
+    - dict: The encoding profile, size in bytes and encode time of the M4B, or {"failed_encode": 1} if it failed.
     """
     try:
         # Get the list of mp3 files and sort them using the custom key
-        mp3_files = [f for f in os.listdir(mp3_directory) if f.lower().endswith(".mp3")]
+        mp3_files = [f for f in os.listdir(mp3_directory) if f.lower().endswith(extension)]
         if not mp3_files:
-            raise ValueError("No MP3 files found in the specified directory.")
+            raise ValueError(f"No {extension} files found in the specified directory.")
 
         sorted_files = sorted(mp3_files, key=numerical_sort_key)
 
@@ -47,7 +86,7 @@ def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_ima
             list_filename = list_file.name
 
         # Define the path for the concatenated mp3 (temporary)
-        concatenated_mp3 = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3').name
+        concatenated_mp3 = tempfile.NamedTemporaryFile(delete=False, suffix=extension).name
 
         # Build the ffmpeg command to concatenate mp3s
         ffmpeg_cmd = [
@@ -72,22 +111,25 @@ def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_ima
             )
 
         # Use pydub to convert the concatenated mp3 to M4B
-        combined_audio = AudioSegment.from_mp3(concatenated_mp3)
-        combined_audio.export(output_filename, format="mp4", codec="aac")
+        combined_audio = AudioSegment.from_file(concatenated_mp3)
+        encoding_stats = export_m4b(combined_audio, output_filename, encoding_profile)
 
         # Set metadata on the M4B file
         set_metadata(output_filename, metadata, cover_image)
 
         print(f"Combined audiobook saved to: {output_filename}")
+        return encoding_stats
 
     except subprocess.CalledProcessError as e:
         error_message = f"FFmpeg error: {e.stderr}\nIf you're seeing this error try running step 4 with the -m av flag."
         write_to_error_log(error_message)
         print(error_message)
+        return {"failed_encode": 1}
     except Exception as e:
         error_message = f"Error processing MP3s with ffmpeg: {e}\nIf you're seeing this error try running step 4 with the -m av flag."
         write_to_error_log(error_message)
         print(error_message)
+        return {"failed_encode": 1}
     finally:
         # Clean up temporary files
         try:
@@ -100,7 +142,8 @@ def combine_mp3s_with_ffmpeg(mp3_directory, output_filename, metadata, cover_ima
             write_to_error_log(error_message)
             print(error_message)
 
-def combine_mp3s_with_av(mp3_directory, output_filename, metadata, cover_image=None):
+def combine_mp3s_with_av(mp3_directory, output_filename, metadata, cover_image=None, extension=".mp3",
+                         encoding_profile="speech"):
     """
     Combine MP3 files using av python liv and export as an M4B audiobook with metadata.
 
@@ -111,11 +154,16 @@ def combine_mp3s_with_av(mp3_directory, output_filename, metadata, cover_image=N
     - output_filename (str): Path for the output M4B file.
     - metadata (dict): Dictionary containing metadata (e.g., title, author).
     - cover_image (Path, optional): Path to the cover image file.
+    - extension (str, optional): Extension of the audio files to combine, e.g. ".wav" for post-processed files.
+    - encoding_profile (str, optional): Name of the profile in CONFIG["encoding_profiles"] used to encode the M4B.
+
+    Returns:
+    - dict: The encoding profile, size in bytes and encode time of the M4B, or {"failed_encode": 1} if it failed.
     """
     combined_audio = AudioSegment.empty()
 
     # Get the list of mp3 files and sort them using the custom key
-    mp3_files = [f for f in os.listdir(mp3_directory) if f.endswith(".mp3")]
+    mp3_files = [f for f in os.listdir(mp3_directory) if f.lower().endswith(extension)]
     sorted_files = sorted(mp3_files, key=numerical_sort_key)
 
     for filename in sorted_files:
@@ -153,19 +201,26 @@ def combine_mp3s_with_av(mp3_directory, output_filename, metadata, cover_image=N
                 )
                 combined_audio += audio_segment
 
-            # Export the final combined audio as an M4B file
-            combined_audio.export(output_filename, format="mp4", codec="aac")
-
         except Exception as e:
             error_message = f"Error processing {filename} with av: {e}\n\If you're seeing this error try running step 4 with the -m ffmpeg flag."
             write_to_error_log(error_message)
             print(error_message)
-            return
+            return {"failed_encode": 1}
+
+    # Export the final combined audio as an M4B file, once every file has been decoded
+    try:
+        encoding_stats = export_m4b(combined_audio, output_filename, encoding_profile)
+    except Exception as e:
+        error_message = f"Error encoding the M4B with the '{encoding_profile}' profile: {e}"
+        write_to_error_log(error_message)
+        print(error_message)
+        return {"failed_encode": 1}
 
     # Set metadata on the M4B file
     set_metadata(output_filename, metadata, cover_image)
     
     print(f"Combined audiobook saved to: {output_filename}")
+    return encoding_stats
 
 def set_metadata(file_path, metadata, cover_image=None):
     """Set metadata like title, author, etc., and optionally embed cover art in the M4B file."""
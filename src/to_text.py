@@ -1,9 +1,167 @@
 import os
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
 from ebooklib import epub, ITEM_DOCUMENT
 from mobi import Mobi
 import PyPDF2
 import html2text
 from bs4 import BeautifulSoup
+from utils import map_in_order
+
+# lxml is optional but parses EPUB documents several times faster than the builtin parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# MOBI files mark the boundary between sections (usually chapters) with a page break
+MOBI_SECTION_BREAK = re.compile(rb'<mbp:pagebreak\s*/?>', re.IGNORECASE)
+
+
+def parse_epub_document(content):
+    """Extracts the text of a single EPUB (X)HTML document."""
+    return BeautifulSoup(content, HTML_PARSER).get_text()
+
+
+def parse_mobi_section(content):
+    """Extracts the text of a single MOBI HTML section."""
+    return html2text.html2text(content.decode('utf-8', errors='replace'))
+
+
+def iter_epub_documents(file_path):
+    """Yields (name, body content) for each document of an EPUB in spine (reading) order."""
+    book = epub.read_epub(file_path)
+    items = [book.get_item_with_id(idref) for idref, _ in book.spine]
+    items = [item for item in items if item is not None and item.get_type() == ITEM_DOCUMENT]
+    if not items:
+        # Some EPUBs have no usable spine, fall back to manifest order
+        items = list(book.get_items_of_type(ITEM_DOCUMENT))
+    for item in items:
+        yield item.get_name(), item.get_body_content()
+
+
+def iter_mobi_sections(file_path):
+    """Yields (name, html) for each section of a MOBI, decoding one text record at a time."""
+    reader = Mobi(file_path)
+    try:
+        reader.load_pdb_headers()
+        reader.load_record_list()
+        reader.load_record0()
+        reader.load_mobi_headers()
+
+        buffer = bytearray()
+        search_from = 0
+        section_index = 1
+        for record_index in range(1, reader.palm_header["record_count"] + 1):
+            buffer += reader.read_text_record(record_index)
+            match = MOBI_SECTION_BREAK.search(buffer, search_from)
+            while match:
+                yield f"section_{section_index}", bytes(buffer[:match.start()])
+                section_index += 1
+                del buffer[:match.end()]
+                match = MOBI_SECTION_BREAK.search(buffer)
+            # A page break may straddle two records, so only rescan the tail of what is buffered
+            search_from = max(0, len(buffer) - 32)
+        if buffer:
+            yield f"section_{section_index}", bytes(buffer)
+    finally:
+        reader.close()
+
+
+def iter_documents(file_path, workers=None):
+    """
+    Lazily extracts text from an input file one document at a time.
+
+    EPUB files yield one document per spine item and MOBI files one per section, so document
+    boundaries (usually chapters) are kept. Plaintext and PDF files yield a single document.
+
+    Parameters:
+        file_path (str): Path to the input file.
+        workers (int, optional): Number of processes used to parse EPUB/MOBI documents in parallel.
+
+    Yields:
+        dict: {"name": str, "text": str} for each document.
+
+    Raises:
+        ValueError: If the file type is unsupported or if there's an error during extraction.
+    """
+    if not os.path.isfile(file_path):
+        raise ValueError(f"The file {file_path} does not exist.")
+
+    _, ext = os.path.splitext(file_path)
+    ext = ext.lower()
+
+    if ext == '.epub':
+        sources, parse, format_name = iter_epub_documents(file_path), parse_epub_document, "EPUB"
+    elif ext == '.mobi':
+        sources, parse, format_name = iter_mobi_sections(file_path), parse_mobi_section, "MOBI"
+    else:
+        yield {"name": os.path.basename(file_path), "text": extract_text(file_path)}
+        return
+
+    executor = ProcessPoolExecutor(workers) if workers and workers > 1 else None
+    try:
+        names = []
+
+        def sources_with_names():
+            for name, content in sources:
+                names.append(name)
+                yield content
+
+        texts = map_in_order(parse, sources_with_names(), executor, (workers or 1) * 2)
+        for index, text in enumerate(texts):
+            yield {"name": names[index], "text": text}
+    except Exception as e:
+        raise ValueError(f"Error reading {format_name} file: {e}")
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def split_document_paragraphs(text):
+    """Splits a document's text into the paragraphs that Step 2 will read from the plaintext file."""
+    return [paragraph for paragraph in re.split(r'\n\s*\n', text.strip()) if paragraph.strip()]
+
+
+def extract_text_to_file(file_path, output_path, documents_json_path, workers=None):
+    """
+    Extracts text from an input file and streams it to output_path one document at a time.
+
+    Documents are separated by a blank line, and their boundaries are written to documents_json_path
+    as the index of their first paragraph, their paragraph count and their character count.
+
+    Returns:
+        list: The document boundaries written to documents_json_path.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    documents = []
+    paragraph_offset = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for document in iter_documents(file_path, workers):
+            paragraphs = split_document_paragraphs(document["text"])
+            if not paragraphs:
+                continue
+            text = "\n\n".join(paragraphs)
+            if documents:
+                f.write("\n\n")
+            f.write(text)
+            documents.append({
+                "name": document["name"],
+                "start_paragraph": paragraph_offset,
+                "paragraphs": len(paragraphs),
+                "characters": len(text),
+            })
+            paragraph_offset += len(paragraphs)
+
+    if not documents:
+        raise ValueError(f"No text extracted from {file_path}.")
+
+    with open(documents_json_path, "w", encoding="utf-8") as f:
+        json.dump(documents, f, indent=2)
+    return documents
+
 
 def extract_text(file_path):
     """
@@ -44,37 +202,12 @@ def extract_text(file_path):
         # Plaintext file
         return read_plaintext(file_path)
 
-    elif ext == '.epub':
-        # EPUB file
-        try:
-            book = epub.read_epub(file_path)
-            texts = []
-            for item in book.get_items_of_type(ITEM_DOCUMENT):
-                soup = BeautifulSoup(item.get_body_content(), 'html.parser')
-                texts.append(soup.get_text())
-            return '\n'.join(texts)
-        except Exception as e:
-            raise ValueError(f"Error reading EPUB file: {e}")
-
-    elif ext == '.mobi':
-        reader = None
-        try:
-            reader = Mobi(file_path)
-            output = reader.read()  # bytearray containing the decoded MOBI file
-            reader.close()
-            decoded_text = output.decode('utf-8', errors='replace')  # Decode with UTF-8, replacing errors
-            # Parse the HTML and extract the text
-            text = html2text.html2text(decoded_text)
-            # soup = BeautifulSoup(decoded_text, 'html.parser')
-            # text = soup.get_text()
-            if not text.strip():
-                raise ValueError("No text extracted from MOBI file.")
-            return text
-        except Exception as e:
-            raise ValueError(f"Error reading MOBI file: {e}")
-        finally:
-            if reader:
-                reader.close()
+    elif ext in ('.epub', '.mobi'):
+        # EPUB and MOBI files are extracted one document at a time
+        text = '\n\n'.join(document["text"] for document in iter_documents(file_path))
+        if ext == '.mobi' and not text.strip():
+            raise ValueError("Error reading MOBI file: No text extracted from MOBI file.")
+        return text
 
     elif ext == '.pdf':
         # PDF file
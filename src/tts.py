@@ -1,25 +1,44 @@
 import os
+import threading
+import numpy as np
+import torch
 from dotenv import load_dotenv
 from TTS.api import TTS
 from errors import write_to_error_log
 from openai import OpenAI
 from elevenlabs.client import ElevenLabs
 from elevenlabs import save
-from config import get_vits_voice_map, get_openai_voice_map, get_elevenlabs_voice_map
+from utils import map_in_order, iter_batches
+from rate_governor import get_rate_governor
+from postprocess import write_chunk_samples
+from config import CONFIG, get_vits_voice_map, get_openai_voice_map, get_elevenlabs_voice_map
 
 load_dotenv()  # Load environment variables from .env
 
 openai_client = None
 elevenlabs_client = None
 
+# Loaded local TTS models, shared by every chunk (and every book in batch mode)
+local_tts_models = {}
+local_tts_models_lock = threading.Lock()
+
+# ONNX Runtime sessions of exported local TTS models
+onnx_sessions = {}
+onnx_sessions_lock = threading.Lock()
+
+# TTS methods whose models and clients were warmed up without errors
+warmed_up_methods = set()
+
 def get_openai_client():
     global openai_client
     # Validate that the OpenAI API key is set in the environment
     if not os.environ.get("OPENAI_API_KEY"):
         raise ValueError("OpenAI API key not found in environment variables. For 'openai' TTS method, set the OPENAI_API_KEY in the .env file.")
     if openai_client is None:
+        # Retries are left to the rate governor, which sees every 429 and paces all threads together
         openai_client = OpenAI(
             api_key=os.environ.get("OPENAI_API_KEY"),
+            max_retries=0,
         )
     return openai_client
 
@@ -40,9 +59,206 @@ def get_elevenlabs_client():
     if elevenlabs_client is None:
         elevenlabs_client = ElevenLabs(
             api_key=os.environ.get("ELEVENLABS_API_KEY"),
+            base_url=os.environ.get("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io"),
         )
     return elevenlabs_client
 
+def get_local_tts_model(model_name):
+    """
+    Load a Coqui TTS model once and return it along with a lock that serializes inference on it.
+
+    Args:
+        model_name (str): The Coqui model name, e.g. "tts_models/en/vctk/vits".
+
+    Returns:
+        tuple: The loaded TTS instance and its threading.Lock.
+    """
+    with local_tts_models_lock:
+        if model_name not in local_tts_models:
+            local_tts_models[model_name] = (TTS(model_name), threading.Lock())
+        return local_tts_models[model_name]
+
+def get_onnx_vits_session(model_name):
+    """
+    Return an ONNX Runtime session for a Coqui VITS model, exporting the model to ONNX the first time.
+
+    The export is cached in CONFIG["onnx"]["CACHE_DIR"] so it only happens once per model. The PyTorch
+    model is still loaded for its tokenizer and speaker IDs.
+
+    Args:
+        model_name (str): The Coqui model name, e.g. "tts_models/en/vctk/vits".
+
+    Returns:
+        tuple: The onnxruntime.InferenceSession and the loaded TTS instance.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ValueError("onnxruntime is not installed. For the 'onnx' TTS method, run: pipenv install onnxruntime onnx")
+
+    with onnx_sessions_lock:
+        if model_name not in onnx_sessions:
+            tts, tts_lock = get_local_tts_model(model_name)
+            onnx_settings = CONFIG["onnx"]
+            onnx_path = onnx_settings["CACHE_DIR"] / f"{model_name.replace('/', '--')}.onnx"
+            if not onnx_path.exists():
+                print(f"Exporting {model_name} to ONNX (only happens once)...")
+                onnx_path.parent.mkdir(parents=True, exist_ok=True)
+                with tts_lock:
+                    tts.synthesizer.tts_model.export_onnx(output_path=str(onnx_path), verbose=False)
+
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = onnx_settings["INTRA_OP_THREADS"]
+            session_options.inter_op_num_threads = onnx_settings["INTER_OP_THREADS"]
+            session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            session = onnxruntime.InferenceSession(
+                str(onnx_path), sess_options=session_options, providers=["CPUExecutionProvider"]
+            )
+            onnx_sessions[model_name] = (session, tts)
+        return onnx_sessions[model_name]
+
+def synthesize_with_onnx(text, model_name, speaker):
+    """
+    Synthesize text with the ONNX export of a Coqui VITS model, one sentence at a time like Coqui does.
+
+    Returns:
+        tuple: The float32 samples and their sample rate.
+    """
+    session, tts = get_onnx_vits_session(model_name)
+    model = tts.synthesizer.tts_model
+    input_names = {session_input.name for session_input in session.get_inputs()}
+    scales = np.array(
+        [model.inference_noise_scale, model.length_scale, model.inference_noise_scale_dp], dtype=np.float32
+    )
+    sample_rate = tts.synthesizer.output_sample_rate
+    pause = np.zeros(int(sample_rate * CONFIG["onnx"]["SENTENCE_PAUSE_MS"] / 1000), dtype=np.float32)
+
+    pieces = []
+    for sentence in tts.synthesizer.split_into_sentences(text):
+        token_ids = np.array([model.tokenizer.text_to_ids(sentence)], dtype=np.int64)
+        inputs = {
+            "input": token_ids,
+            "input_lengths": np.array([token_ids.shape[1]], dtype=np.int64),
+            "scales": scales,
+            "sid": np.array([model.speaker_manager.name_to_id[speaker]], dtype=np.int64),
+        }
+        audio = session.run(["output"], {name: value for name, value in inputs.items() if name in input_names})[0]
+        pieces.append(audio.reshape(-1).astype(np.float32))
+        pieces.append(pause)
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32), sample_rate
+
+def bucket_sentences(sentences):
+    """
+    Groups sentences that are already sorted by token count into batches for padded inference.
+
+    A batch is closed when it is full, when its padded size would exceed MAX_BATCH_TOKENS, or when
+    its longest sentence would be more than MAX_LENGTH_RATIO times its shortest, to limit padding.
+    """
+    settings = CONFIG["local_batching"]
+    batch = []
+    for sentence in sentences:
+        length = len(sentence["token_ids"])
+        if batch and (
+            len(batch) >= settings["BATCH_SIZE"]
+            or (len(batch) + 1) * length > settings["MAX_BATCH_TOKENS"]
+            or length > len(batch[0]["token_ids"]) * settings["MAX_LENGTH_RATIO"]
+        ):
+            yield batch
+            batch = []
+        batch.append(sentence)
+    if batch:
+        yield batch
+
+def run_padded_vits_batch(model, batch, speaker_id):
+    """Synthesizes a batch of tokenized sentences for one speaker in a single padded forward pass.
+
+    Each sentence's audio is cut from the padded output using the output lengths from the model's y_mask.
+    """
+    lengths = [len(sentence["token_ids"]) for sentence in batch]
+    token_ids = torch.zeros(len(batch), max(lengths), dtype=torch.long)
+    for row, sentence in enumerate(batch):
+        token_ids[row, :lengths[row]] = torch.tensor(sentence["token_ids"], dtype=torch.long)
+
+    with torch.no_grad():
+        outputs = model.inference(token_ids, aux_input={
+            "x_lengths": torch.tensor(lengths, dtype=torch.long),
+            "speaker_ids": torch.tensor([speaker_id] * len(batch), dtype=torch.long),
+        })
+
+    audio = outputs["model_outputs"].squeeze(1).cpu().numpy()
+    audio_lengths = (outputs["y_mask"].sum(dim=[1, 2]) * model.config.audio.hop_length).long().tolist()
+    for row, sentence in enumerate(batch):
+        sentence["audio"] = audio[row, :min(audio_lengths[row], audio.shape[1])]
+
+def synthesize_local_chunks(chunks):
+    """
+    Synthesizes several chunks with the local models using padded batched inference.
+
+    Every chunk is split into sentences, the sentences of all chunks are grouped by model and speaker,
+    sorted and bucketed by length, and each bucket runs as one forward pass. The sentence audio is then
+    put back together in the original order of each chunk and written like Coqui's tts_to_file would.
+
+    Args:
+        chunks (list): (output_file, text, voice) for each chunk.
+
+    Returns:
+        list: None for each chunk that was written, or the error message for each chunk that failed.
+    """
+    vits_voice_map = get_vits_voice_map()
+    errors = [None] * len(chunks)
+    chunk_sentences = [[] for _ in chunks]
+    groups = {}
+
+    for chunk_index, (_, text, voice) in enumerate(chunks):
+        vits_voice = vits_voice_map.get(voice)
+        if not vits_voice:
+            errors[chunk_index] = f"Voice '{voice}' not found in VITS voice mapping."
+            continue
+        try:
+            tts, _ = get_local_tts_model(vits_voice["model"])
+            model = tts.synthesizer.tts_model
+            speaker_id = model.speaker_manager.name_to_id[vits_voice["speaker"]]
+            for sentence_text in tts.synthesizer.split_into_sentences(text):
+                sentence = {"chunk_index": chunk_index, "token_ids": model.tokenizer.text_to_ids(sentence_text)}
+                chunk_sentences[chunk_index].append(sentence)
+                groups.setdefault((vits_voice["model"], speaker_id), []).append(sentence)
+        except Exception as e:
+            errors[chunk_index] = f"Failed to prepare text for local batched synthesis: {e}"
+
+    for (model_name, speaker_id), sentences in groups.items():
+        tts, tts_lock = get_local_tts_model(model_name)
+        model = tts.synthesizer.tts_model
+        sentences.sort(key=lambda sentence: len(sentence["token_ids"]))
+        for batch in bucket_sentences(sentences):
+            try:
+                with tts_lock:
+                    run_padded_vits_batch(model, batch, speaker_id)
+            except Exception as batch_error:
+                # Fall back to one sentence at a time so one bad sentence only fails its own chunk
+                for sentence in batch:
+                    try:
+                        with tts_lock:
+                            run_padded_vits_batch(model, [sentence], speaker_id)
+                    except Exception as e:
+                        errors[sentence["chunk_index"]] = f"Failed to convert text to speech locally: {e} (batch error: {batch_error})"
+
+    for chunk_index, (output_file, text, voice) in enumerate(chunks):
+        if errors[chunk_index]:
+            continue
+        tts, _ = get_local_tts_model(vits_voice_map[voice]["model"])
+        pause = np.zeros(int(tts.synthesizer.output_sample_rate * CONFIG["local_batching"]["SENTENCE_PAUSE_MS"] / 1000))
+        wav = []
+        for sentence in chunk_sentences[chunk_index]:
+            wav.append(sentence["audio"])
+            wav.append(pause)
+        try:
+            tts.synthesizer.save_wav(np.concatenate(wav) if wav else pause, output_file)
+        except Exception as e:
+            errors[chunk_index] = f"Failed to write locally synthesized audio: {e}"
+
+    return errors
+
 def convert_text_to_speech(text, voice="male_1", method="local", output_file=None):
     """
     Convert text to speech and write the audio data directly to a file.
@@ -50,7 +266,7 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
     Args:
         text (str): The input text to convert to speech.
         voice (str): The voice model to use for conversion.
-        method (str): The method to use for conversion, "openai", "local", or "elevenlabs".
+        method (str): The method to use for conversion, "openai", "local", "onnx", or "elevenlabs".
         output_file (str): The file path where the audio data will be saved.
 
     Returns:
@@ -63,11 +279,15 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
         openai_voice_map = get_openai_voice_map()
         openai_voice = openai_voice_map.get(voice, "echo")  # Default to "echo" if not found
         try:
-            response = client.audio.speech.create(
-                model="tts-1-hd",
-                input=text,
-                voice=openai_voice,
-                response_format="mp3",
+            response = get_rate_governor("openai").call(
+                lambda: client.audio.speech.with_raw_response.create(
+                    model="tts-1-hd",
+                    input=text,
+                    voice=openai_voice,
+                    response_format="mp3",
+                ),
+                units=len(text),
+                description="speech request",
             )
             # Write the response content directly to the output file
             if output_file:
@@ -90,16 +310,17 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
             raise ValueError(f"Voice '{voice}' not found in VITS voice mapping.")
 
         try:
-            # Initialize TTS model
-            tts = TTS(vits_voice["model"])
+            # Get the (cached) TTS model
+            tts, tts_lock = get_local_tts_model(vits_voice["model"])
             
             # Generate speech and save directly to the provided output file path
             if output_file:
-                tts.tts_to_file(
-                    text=text,
-                    speaker=vits_voice["speaker"],
-                    file_path=output_file
-                )
+                with tts_lock:
+                    tts.tts_to_file(
+                        text=text,
+                        speaker=vits_voice["speaker"],
+                        file_path=output_file
+                    )
             else:
                 error_message = "Output file path must be provided for local method."
                 write_to_error_log(error_message)
@@ -109,6 +330,26 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
             write_to_error_log(error_message)
             raise Exception(error_message)
 
+    elif method == "onnx":
+        # The ONNX backend runs the same models as the local method, so it uses the VITS voice mapping
+        vits_voice_map = get_vits_voice_map()
+        vits_voice = vits_voice_map.get(voice)
+        if not vits_voice:
+            raise ValueError(f"Voice '{voice}' not found in VITS voice mapping.")
+
+        try:
+            if output_file:
+                samples, sample_rate = synthesize_with_onnx(text, vits_voice["model"], vits_voice["speaker"])
+                write_chunk_samples(output_file, samples, sample_rate)
+            else:
+                error_message = "Output file path must be provided for onnx method."
+                write_to_error_log(error_message)
+                raise ValueError(error_message)
+        except Exception as e:
+            error_message = f"Failed to convert text to speech locally with ONNX Runtime: {e}"
+            write_to_error_log(error_message)
+            raise Exception(error_message)
+
     elif method == "elevenlabs":
         client = get_elevenlabs_client()
 
@@ -119,16 +360,22 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
             raise ValueError(f"Voice '{voice}' not found in ElevenLabs voice mapping.")
 
         try:
-            # Generate speech using ElevenLabs API
-            audio = client.generate(
-                text=text,
-                voice=elevenlabs_voice,
-                model="eleven_multilingual_v2"
-            )
-
             # Write the audio data directly to the output file
             if output_file:
-                save(audio, output_file)
+                # The audio is streamed while it is saved, so both go through the rate governor
+                get_rate_governor("elevenlabs").call(
+                    lambda: save(
+                        # Generate speech using ElevenLabs API
+                        client.generate(
+                            text=text,
+                            voice=elevenlabs_voice,
+                            model="eleven_multilingual_v2"
+                        ),
+                        output_file,
+                    ),
+                    units=len(text),
+                    description="speech request",
+                )
             else:
                 error_message = "Output file path must be provided for elevenlabs method."
                 write_to_error_log(error_message)
@@ -139,14 +386,121 @@ def convert_text_to_speech(text, voice="male_1", method="local", output_file=Non
             raise Exception(error_message)
 
     else:
-        raise ValueError(f"Invalid TTS method '{method}'. Choose 'local', 'openai', or 'elevenlabs'.")
+        raise ValueError(f"Invalid TTS method '{method}'. Choose 'local', 'onnx', 'openai', or 'elevenlabs'.")
+
+def warm_up_tts(method: str) -> list:
+    """
+    Loads and checks everything the voice map of a TTS method needs, so Step 3 can start synthesizing at once.
+
+    Local models are downloaded if needed, loaded into the shared model cache and run on a short sentence for
+    every speaker in the voice map. ONNX models are also exported and their sessions opened. For the remote
+    methods the client is created, which checks the API key, and the ElevenLabs voice names are looked up.
+
+    Returns:
+        list: An error message for every model, speaker or client that failed. Each is also printed and
+        written to the error log as soon as it happens.
+    """
+    if method in warmed_up_methods:
+        return []
+    errors = []
 
-def generate_mp3_files(tts_chunks: list, method: str, audio_files_dir: str):
-    """Generates MP3 files from TTS chunks."""
+    def report(error_message):
+        errors.append(error_message)
+        print(error_message)
+        write_to_error_log(error_message)
+
+    if method in ("local", "onnx"):
+        voices = list(get_vits_voice_map().values())
+        for model_name in dict.fromkeys(voice["model"] for voice in voices):
+            try:
+                if method == "onnx":
+                    get_onnx_vits_session(model_name)
+                else:
+                    get_local_tts_model(model_name)
+            except Exception as e:
+                report(f"TTS warm-up: failed to load {model_name}: {e}")
+                continue
+            for speaker in dict.fromkeys(voice["speaker"] for voice in voices if voice["model"] == model_name):
+                try:
+                    if method == "onnx":
+                        synthesize_with_onnx("Hello.", model_name, speaker)
+                    else:
+                        tts, tts_lock = get_local_tts_model(model_name)
+                        with tts_lock:
+                            tts.tts(text="Hello.", speaker=speaker)
+                except Exception as e:
+                    report(f"TTS warm-up: {model_name} failed to synthesize with speaker {speaker}: {e}")
+    elif method == "openai":
+        try:
+            get_openai_client()
+        except Exception as e:
+            report(f"TTS warm-up: {e}")
+    elif method == "elevenlabs":
+        try:
+            client = get_elevenlabs_client()
+            available_voices = {voice.name for voice in client.voices.get_all().voices}
+            for voice_name in dict.fromkeys(get_elevenlabs_voice_map().values()):
+                if voice_name not in available_voices:
+                    report(f"TTS warm-up: ElevenLabs voice '{voice_name}' is not available to this account.")
+        except Exception as e:
+            report(f"TTS warm-up: {e}")
+    if not errors:
+        warmed_up_methods.add(method)
+    return errors
+
+class TTSWarmUp:
+    """
+    Runs warm_up_tts on a background thread, so models load while Steps 1 and 2 run.
+
+    The thread is a daemon, so a run that ends without reaching Step 3 does not wait for it.
+    """
+
+    def __init__(self, method: str):
+        self.method = method
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, name="tts-warm-up", daemon=True)
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return self
+        print(f"Loading the {self.method} TTS models in the background...")
+        self.started = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        self.errors = warm_up_tts(self.method)
+
+    def wait(self) -> list:
+        """Waits for the warm-up to finish, running it here if it was not started, and returns its errors."""
+        if not self.started:
+            self.started = True
+            self.run()
+        elif self.thread.is_alive():
+            print(f"Waiting for the {self.method} TTS models to finish loading...")
+            self.thread.join()
+        if self.errors:
+            print(f"The {self.method} TTS warm-up failed {len(self.errors)} time(s); Step 3 is likely to fail the same way.")
+        return self.errors
+
+def generate_mp3_files(tts_chunks, method: str, audio_files_dir: str, executor=None, on_chunk_done=None,
+                       first_chunk_number=1):
+    """Generates MP3 files from TTS chunks.
+
+    tts_chunks may be any iterable, including a generator, so chunks are synthesized as they are produced.
+    With the local method, windows of chunks are synthesized together with padded batched inference.
+    If an executor is passed, chunks are submitted to it so they can share a worker pool with other books.
+    If on_chunk_done is passed, it is called with (file_path, generated) for every chunk, in order.
+    Files are numbered from first_chunk_number, so a range of a book's chunks can be generated on its own.
+
+    Returns the number of chunks that failed to generate.
+    """
     os.makedirs(audio_files_dir, exist_ok=True)
 
-    for i, chunk in enumerate(tts_chunks, 1):
-        print(f"Generating MP3 file for chunk {i}/{len(tts_chunks)}...")
+    def generate(item):
+        i, chunk = item
+        print(f"Generating MP3 file for chunk {i}...")
         text = chunk["text"]
         voice = chunk["voice"]
         file_name = f"{i}.mp3"
@@ -156,9 +510,46 @@ def generate_mp3_files(tts_chunks: list, method: str, audio_files_dir: str):
             # Call the TTS conversion and pass the file path directly
             convert_text_to_speech(text, voice, method, output_file=file_path)
             print(f"Generated MP3 file: {file_name}")
+            return True
         except Exception as e:
             error_message = f"Failed to generate MP3 for chunk {i}: {e}"
             write_to_error_log(error_message)
             print(error_message)
+            return False
+
+    def generate_window(window):
+        # Synthesize a window of chunks together with padded batched inference
+        print(f"Generating MP3 files for chunks {window[0][0]}-{window[-1][0]}...")
+        errors = synthesize_local_chunks([
+            (os.path.join(audio_files_dir, f"{i}.mp3"), chunk["text"], chunk["voice"]) for i, chunk in window
+        ])
+        results = []
+        for (i, _), error in zip(window, errors):
+            if error:
+                error_message = f"Failed to generate MP3 for chunk {i}: {error}"
+                write_to_error_log(error_message)
+                print(error_message)
+            else:
+                print(f"Generated MP3 file: {i}.mp3")
+            results.append(error is None)
+        return results
+
+    if method == "local" and CONFIG["local_batching"]["BATCH_SIZE"] > 1:
+        windows = iter_batches(enumerate(tts_chunks, first_chunk_number), CONFIG["local_batching"]["WINDOW_CHUNKS"])
+        results = (
+            generated
+            for window_results in map_in_order(generate_window, windows, executor, CONFIG["streaming"]["MAX_IN_FLIGHT"])
+            for generated in window_results
+        )
+    else:
+        results = map_in_order(generate, enumerate(tts_chunks, first_chunk_number), executor, CONFIG["streaming"]["MAX_IN_FLIGHT"])
+
+    failed_chunks = 0
+    for i, generated in enumerate(results, first_chunk_number):
+        if not generated:
+            failed_chunks += 1
+        if on_chunk_done:
+            on_chunk_done(os.path.join(audio_files_dir, f"{i}.mp3"), generated)
 
     print(f"All MP3 files have been generated in the '{audio_files_dir}' directory.")
+    return failed_chunks
@@ -1,5 +1,7 @@
 import re
 import os
+from collections import deque
+from difflib import SequenceMatcher
 from tiktoken import get_encoding
 
 # Initialize the GPT-3 encoder
@@ -25,6 +27,84 @@ def extract_character_tags(text: str) -> list:
     return [{"name": name, "gender": gender} for name, gender in matches]
 
 
+def count_character_tags(text: str, character_frequency_map: dict) -> dict:
+    """Adds the character tags found in text to a running map of name -> {"gender", "count"}."""
+    for tag in extract_character_tags(text):
+        name = tag["name"]
+        if name in character_frequency_map:
+            character_frequency_map[name]["count"] += 1
+        else:
+            character_frequency_map[name] = {"gender": tag["gender"], "count": 1}
+    return character_frequency_map
+
+
+def iter_speaker_segments(tagged_text: str):
+    """Yields (text, name) for the narration and dialogue of tagged text, in order.
+
+    The name is the character tag of dialogue, or None for narration. Text is stripped and
+    segments that are only whitespace are skipped.
+    """
+    regex = re.compile(r'<([a-z_]+)-(f|m)>(.*?)<\/\1-\2>', re.DOTALL)
+
+    last_index = 0
+    for match in regex.finditer(tagged_text):
+        start, end = match.span()
+        name, gender, dialogue = match.groups()
+
+        # Non-dialogue text before this dialogue
+        if last_index < start:
+            non_dialogue = tagged_text[last_index:start]
+            if non_dialogue.strip():
+                yield (non_dialogue.strip(), None)
+
+        # Dialogue text
+        if dialogue.strip():
+            yield (dialogue.strip(), name)
+
+        last_index = end
+
+    # Remaining non-dialogue text after the last dialogue
+    if last_index < len(tagged_text):
+        non_dialogue = tagged_text[last_index:]
+        if non_dialogue.strip():
+            yield (non_dialogue.strip(), None)
+
+
+def strip_character_tags(text: str) -> str:
+    """Removes opening and closing character tags, leaving the tagged text in place."""
+    return re.sub(r'</?[a-z_]+-(?:f|m)>', '', text)
+
+
+def normalize_text_for_comparison(text: str) -> list:
+    """Normalizes text into a list of words so tagged output can be compared to its source.
+
+    Curly quotes and apostrophes are folded into their straight equivalents and all
+    whitespace is collapsed, since neither difference is audible once spoken.
+    """
+    text = text.translate(str.maketrans({
+        "\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"',
+    }))
+    return text.split()
+
+
+def validate_tagged_block(source: str, tagged: str, min_similarity: float) -> tuple:
+    """Checks that a tagged block still contains the text of its source block.
+
+    Returns a tuple of (is_valid, similarity) where similarity is the ratio of matching
+    words between the source and the tagged output with its tags stripped.
+    """
+    source_words = normalize_text_for_comparison(source)
+    tagged_words = normalize_text_for_comparison(strip_character_tags(clean_markdown_code_blocks(tagged)))
+
+    if not tagged_words:
+        return (not source_words, 1.0 if not source_words else 0.0)
+    if source_words == tagged_words:
+        return (True, 1.0)
+
+    similarity = SequenceMatcher(None, source_words, tagged_words, autojunk=False).ratio()
+    return (similarity >= min_similarity, similarity)
+
+
 def clean_markdown_code_blocks(text: str) -> str:
     """Removes wrapping Markdown code block delimiters like ``` or ```markdown."""
     # ^\s*```(?:markdown)?\s*\n? => Matches the opening ``` with optional 'markdown' specifier and optional whitespace/newline
@@ -89,3 +169,90 @@ def remove_suffix(file_name: str) -> str:
     name, extension = os.path.splitext(file_name)
     # Return the name part only, effectively removing the suffix
     return name
+
+
+def split_paragraphs(lines):
+    """Lazily groups lines of text into paragraphs, splitting on blank lines."""
+    paragraph_lines = []
+    for line in lines:
+        if line.strip():
+            paragraph_lines.append(line)
+        elif paragraph_lines:
+            yield "".join(paragraph_lines).rstrip("\n")
+            paragraph_lines = []
+    if paragraph_lines:
+        yield "".join(paragraph_lines).rstrip("\n")
+
+
+def iter_paragraphs(file_path):
+    """Lazily reads a text file one paragraph at a time, splitting on blank lines."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        yield from split_paragraphs(f)
+
+
+def join_tagged_units(paragraphs):
+    """Lazily joins paragraphs of tagged text while a character tag is still open."""
+    opening_tag = re.compile(r'<[a-z_]+-(?:f|m)>')
+    closing_tag = re.compile(r'</[a-z_]+-(?:f|m)>')
+
+    unit = ""
+    for paragraph in paragraphs:
+        unit += ("\n\n" if unit else "") + paragraph
+        if len(opening_tag.findall(unit)) <= len(closing_tag.findall(unit)):
+            yield unit
+            unit = ""
+    if unit:
+        yield unit
+
+
+def iter_block_units(tagged_block: str):
+    """Lazily splits a tagged block into the same units iter_tagged_units reads from the tagged file."""
+    yield from join_tagged_units(split_paragraphs(tagged_block.strip().splitlines(keepends=True)))
+
+
+def iter_tagged_units(file_path):
+    """Lazily reads tagged text one paragraph at a time, joining paragraphs while a character tag is still open."""
+    yield from join_tagged_units(iter_paragraphs(file_path))
+
+
+def map_in_order(fn, items, executor=None, max_in_flight=1):
+    """Lazily maps fn over items, yielding the results in order.
+
+    If an executor is passed, at most max_in_flight items are submitted ahead of the result
+    being yielded, so neither the items nor the results are ever all held in memory.
+    """
+    if executor is None:
+        for item in items:
+            yield fn(item)
+        return
+
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def iter_batches(items, batch_size):
+    """Lazily groups items into lists of up to batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def format_chunk_ranges(chunk_numbers: list) -> str:
+    """Formats sorted chunk numbers as compact ranges, such as "3, 7-12, 40"."""
+    ranges = []
+    for number in chunk_numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ", ".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)